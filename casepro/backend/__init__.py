@@ -1,4 +1,15 @@
 from abc import ABCMeta, abstractmethod
+from enum import Enum
+
+
+class PushStatus(Enum):
+    """
+    The outcome of pushing an outgoing message to a backend
+    """
+
+    SENT = 1
+    RETRYABLE = 2  # wasn't sent but might be if pushed again
+    FAILED = 3  # wasn't sent and won't be if pushed again
 
 
 class BaseBackend(object):
@@ -76,6 +87,7 @@ class BaseBackend(object):
         :param org: the org
         :param outgoing: the outgoing messages
         :param as_broadcast: whether outgoing messages differ only by recipient and so can be sent as single broadcast
+        :return: list of tuples of each message and its PushStatus
         """
 
     @abstractmethod
@@ -242,6 +254,9 @@ class NoopBackend(BaseBackend):  # pragma: no cover
     def pull_messages(self, org, modified_after, modified_before, as_handled=False, progress_callback=None):
         return self.NO_CHANGES
 
+    def push_outgoing(self, org, outgoing, as_broadcast=False):
+        return [(msg, PushStatus.SENT) for msg in outgoing]
+
     def fetch_contact_messages(self, org, contact, created_after, created_before):
         return []
 
@@ -1,7 +1,13 @@
 import functools
+import logging
 import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from itertools import chain
+from uuid import UUID
 
 import dateutil.parser
 import pytz
@@ -13,11 +19,18 @@ from django.conf.urls import url
 from django.db import IntegrityError, transaction
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from django_redis import get_redis_connection
 
-from . import BaseBackend
+from . import BaseBackend, PushStatus
 from ..contacts.models import URN, Contact
 from ..msgs.models import Message
-from ..utils import json_decode, uuid_to_int
+from ..statistics.models import DailyCount, datetime_to_date
+from ..utils import json_decode, json_encode, uuid_to_int
+
+IDENTITY_INVALIDATIONS_KEY = "identity-cache-invalidations"
+JUNEBUG_INBOUND_QUEUE_KEY = "junebug-inbound:%d"
+
+logger = logging.getLogger(__name__)
 
 
 class HubMessageSender(object):
@@ -51,27 +64,141 @@ class HubMessageSender(object):
             "outbound_created_on": outgoing.created_on.isoformat(),
         }
 
+    def is_enabled(self):
+        return bool(self.base_url and self.auth_token)
+
     def send_helpdesk_outgoing_message(self, outgoing, to_addr):
-        if self.base_url and self.auth_token:
-            json_data = self.build_outgoing_message_json(outgoing, to_addr)
-            self.session.post("%s/jembi/helpdesk/outgoing/" % self.base_url, json=json_data)
+        if self.is_enabled():
+            self.post_helpdesk_outgoing_message(self.build_outgoing_message_json(outgoing, to_addr))
+
+    def post_helpdesk_outgoing_message(self, json_data):
+        self.session.post("%s/jembi/helpdesk/outgoing/" % self.base_url, json=json_data)
+
+
+class IdentityCache(object):
+    """
+    Thread-safe cache of identities and their addresses which is shared by all identity store clients in a process.
+    Entries expire after a TTL, and the least recently used entries are evicted once there are more than max_size.
+    Each entry depends on one or more identities, and is dropped when any of them is invalidated. Invalidations are
+    also recorded in Redis so that caches in other processes pick them up within sync_interval seconds.
+    """
+
+    def __init__(self, ttl, max_size, sync_interval=1.0):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sync_interval = sync_interval
+        self.entries = OrderedDict()  # key -> (expires_on, identity ids, value)
+        self.lock = threading.Lock()
+        self.last_synced = time.time()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Gets the cached value for the given key, or None if it isn't cached or has expired
+        """
+        self._sync()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, identity_ids):
+        """
+        Caches a value which will be dropped when any of the given identities is invalidated
+        """
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, frozenset(identity_ids), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, identity_id):
+        """
+        Drops all entries which depend on the given identity, in this process and in other processes
+        """
+        now = time.time()
+        r = get_redis_connection()
+        r.zadd(IDENTITY_INVALIDATIONS_KEY, {identity_id: now})
+        r.zremrangebyscore(IDENTITY_INVALIDATIONS_KEY, "-inf", now - self.ttl - self.sync_interval)
+
+        self._drop([identity_id])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.last_synced = time.time()
+
+    def _sync(self):
+        """
+        Drops entries for identities invalidated by other processes since the last sync
+        """
+        now = time.time()
+        if now - self.last_synced < self.sync_interval:
+            return
+
+        since, self.last_synced = self.last_synced, now
+        invalidated = get_redis_connection().zrangebyscore(IDENTITY_INVALIDATIONS_KEY, since, "+inf")
+        if invalidated:
+            self._drop([i.decode("utf-8") for i in invalidated])
+
+    def _drop(self, identity_ids):
+        identity_ids = set(identity_ids)
+        with self.lock:
+            for key in [k for k, e in self.entries.items() if e[1] & identity_ids]:
+                del self.entries[key]
+
+
+_identity_cache = None
+
+
+def get_identity_cache():
+    """
+    Gets the identity cache of this process
+    """
+    global _identity_cache
+
+    if _identity_cache is None:
+        _identity_cache = IdentityCache(
+            getattr(settings, "IDENTITY_CACHE_TTL", 300), getattr(settings, "IDENTITY_CACHE_SIZE", 10000)
+        )
+    return _identity_cache
 
 
 class IdentityStore(object):
     """Implements required methods for accessing the identity data in the identity store."""
 
-    def __init__(self, base_url, auth_token, address_type):
+    def __init__(self, base_url, auth_token, address_type, cache=None):
         """
         base_url: the base URL where the identity store is located
         auth_token: the token that should be used for authorized access
         address_type: the address type of the addresses that we want
+        cache: the cache of identities and addresses, defaults to the one shared by this process
         """
         self.base_url = base_url.rstrip("/")
         self.address_type = address_type
+        self.cache = cache or get_identity_cache()
+        self.max_workers = getattr(settings, "IDENTITY_RESOLVE_WORKERS", 8)
         self.session = requests.Session()
         self.session.headers.update({"Authorization": "Token %s" % auth_token})
         self.session.headers.update({"Content-Type": "application/json"})
 
+        # let every worker of the batch resolver keep a connection open
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.max_workers, 10))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     def get_paginated_response(self, url, params={}, **kwargs):
         """Get the results of all pages of a response. Returns an iterator that returns each of the items."""
         while url is not None:
@@ -85,13 +212,26 @@ class IdentityStore(object):
 
     def get_identity(self, uuid):
         """Returns the details of the identity."""
+        key = (self.base_url, "identity", uuid)
+        identity = self.cache.get(key)
+        if identity is not None:
+            return identity
+
         r = self.session.get("%s/api/v1/identities/%s/" % (self.base_url, uuid))
         if r.status_code == 404:
             return None
-        return r.json()
+
+        identity = r.json()
+        self.cache.set(key, identity, [uuid])
+        return identity
 
     def get_addresses(self, uuid):
         """Get the list of addresses that a message to an identity specified by uuid should be sent to."""
+        key = (self.base_url, "addresses", self.address_type, uuid)
+        addresses = self.cache.get(key)
+        if addresses is not None:
+            return iter(addresses)
+
         identity = self.get_identity(uuid)
         if identity and identity.get("communicate_through") is not None:
             identity = self.get_identity(identity["communicate_through"])
@@ -99,7 +239,23 @@ class IdentityStore(object):
             "%s/api/v1/identities/%s/addresses/%s" % (self.base_url, identity["id"], self.address_type),
             params={"default": True},
         )
-        return (a["address"] for a in addresses if a.get("address") is not None)
+        addresses = tuple(a["address"] for a in addresses if a.get("address") is not None)
+
+        self.cache.set(key, addresses, {uuid, identity["id"]})
+        return iter(addresses)
+
+    def get_addresses_for_identities(self, uuids):
+        """
+        Gets the addresses of each of the given identities, resolving those that aren't cached concurrently.
+        Returns a dict of lists of addresses by identity uuid.
+        """
+        uuids = list(OrderedDict.fromkeys(uuids))
+        if len(uuids) <= 1 or self.max_workers <= 1:
+            return {uuid: list(self.get_addresses(uuid)) for uuid in uuids}
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(uuids))) as executor:
+            results = executor.map(lambda uuid: list(self.get_addresses(uuid)), uuids)
+            return dict(zip(uuids, results))
 
     def get_identities_for_address(self, address, address_type=None):
         if address_type is None:
@@ -224,14 +380,24 @@ class JunebugMessageSendingError(Exception):
 
 
 class JunebugMessageSender(object):
+    RETRY_BACKOFF = 0.5  # seconds before the first retry of a failed post, doubling for each retry after that
+
     def __init__(self, base_url, channel_id, from_address, identity_store):
         self.base_url = base_url
         self.channel_id = channel_id
         self.from_address = from_address
         self.identity_store = identity_store
+        self.max_workers = getattr(settings, "JUNEBUG_SEND_WORKERS", 8)
+        self.max_retries = getattr(settings, "JUNEBUG_SEND_RETRIES", 3)
+        self.timeout = getattr(settings, "JUNEBUG_SEND_TIMEOUT", 10)
         self.session = requests.Session()
         self.hub_message_sender = HubMessageSender(settings.JUNEBUG_HUB_BASE_URL, settings.JUNEBUG_HUB_AUTH_TOKEN)
 
+        # let every sending worker keep a connection open
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.max_workers, 10))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     @property
     def url(self):
         return "%s/channels/%s/messages/" % (self.base_url.rstrip("/"), self.channel_id)
@@ -243,20 +409,116 @@ class JunebugMessageSender(object):
             raise JunebugMessageSendingError("Invalid URN: %s" % urn)
         return type_, address
 
-    def send_message(self, message):
+    def get_addresses(self, message, addresses=None):
+        """
+        Gets the addresses to send a message to, i.e. its URN or otherwise the addresses of its contact, which can be
+        given if they have already been resolved
+        """
         if message.urn:
             _, to_addr = self.split_urn(message.urn)
-            addresses = [to_addr]
+            return [to_addr]
         elif message.contact and message.contact.uuid:
-            uuid = message.contact.uuid
-            addresses = self.identity_store.get_addresses(uuid)
+            if addresses is None:
+                addresses = self.identity_store.get_addresses(message.contact.uuid)
+            return list(addresses)
         else:
             # If we don't have an URN for a message, we cannot send it.
             raise JunebugMessageSendingError("Cannot send message without URN: %r" % message)
+
+    def send_message(self, message, addresses=None):
+        """
+        Sends a message to its URN or otherwise to the addresses of its contact, which can be given if they have already
+        been resolved
+        """
+        error = self._send(message, self._get_posts(message, self.get_addresses(message, addresses)))
+        if error:
+            raise JunebugMessageSendingError("Unable to send message: %s" % error)
+
+    def send_messages(self, messages, addresses_by_uuid=None):
+        """
+        Sends many messages concurrently, each one to its URN or otherwise to the addresses of its contact, which can
+        be given by contact UUID if they have already been resolved. Failures to send individual messages, including
+        messages which can't be addressed, are returned rather than raised.
+        :return: list of tuples of each message and the error which stopped it being sent, or None if it was sent
+        """
+        addresses_by_uuid = addresses_by_uuid or {}
+        results = []
+
+        # work out everything to post here, as building hub posts needs the database which workers can't use
+        sends = []
+        for message in messages:
+            uuid = message.contact.uuid if message.contact else None
+            try:
+                addresses = self.get_addresses(message, addresses_by_uuid.get(uuid))
+            except JunebugMessageSendingError as e:
+                logger.warning("Unable to send outgoing message #%s: %s" % (message.pk, str(e)))
+                results.append((message, e))
+            else:
+                sends.append((message, self._get_posts(message, addresses)))
+
+        if len(sends) <= 1 or self.max_workers <= 1:
+            results += [(message, self._send(message, posts)) for message, posts in sends]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(sends))) as executor:
+                errors = executor.map(lambda send: self._send(*send), sends)
+                results += [(message, error) for (message, posts), error in zip(sends, errors)]
+
+        return results
+
+    def _get_posts(self, message, addresses):
+        """
+        Gets the Junebug post for each of the given addresses along with the hub post that should follow it, if any
+        """
+        posts = []
         for to_addr in addresses:
             data = {"to": to_addr, "from": self.from_address, "content": message.text}
-            self.session.post(self.url, json=data)
-            self.hub_message_sender.send_helpdesk_outgoing_message(message, to_addr)
+            hub_data = None
+            if self.hub_message_sender.is_enabled():
+                hub_data = self.hub_message_sender.build_outgoing_message_json(message, to_addr)
+            posts.append((data, hub_data))
+        return posts
+
+    def _send(self, message, posts):
+        """
+        Makes the given posts for a message, stopping at the first which fails
+        :return: the error if a post failed, otherwise None
+        """
+        for data, hub_data in posts:
+            try:
+                self._post(data)
+            except requests.RequestException as e:
+                logger.warning("Unable to send outgoing message #%s to Junebug: %s" % (message.pk, str(e)))
+                return e
+
+            if hub_data:
+                try:
+                    self.hub_message_sender.post_helpdesk_outgoing_message(hub_data)
+                except requests.RequestException as e:
+                    # the message itself was still sent
+                    logger.warning("Unable to post outgoing message #%s to the hub: %s" % (message.pk, str(e)))
+
+        return None
+
+    def _post(self, data):
+        """
+        Posts a message to Junebug, retrying with exponential backoff if it times out, can't connect or responds with a
+        server error
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.RETRY_BACKOFF * 2 ** (attempt - 1))
+
+            try:
+                response = self.session.post(self.url, json=data, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                continue
+
+            if response.status_code < 500 or attempt == self.max_retries:
+                break
+
+        response.raise_for_status()
 
 
 class JunebugBackend(BaseBackend):
@@ -351,9 +613,32 @@ class JunebugBackend(BaseBackend):
         :param org: the org
         :param outgoing: the outgoing messages
         :param as_broadcast: whether outgoing messages differ only by recipient and so can be sent as single broadcast
+        :return: list of tuples of each message and its PushStatus
+        """
+        # resolve the addresses of all contacts being sent to without URNs at once rather than message by message
+        uuids = [m.contact.uuid for m in outgoing if not m.urn and m.contact and m.contact.uuid]
+        addresses = self.identity_store.get_addresses_for_identities(uuids)
+
+        results = self.message_sender.send_messages(outgoing, addresses)
+
+        return [(message, self._get_push_status(error)) for message, error in results]
+
+    @staticmethod
+    def _get_push_status(error):
         """
-        for message in outgoing:
-            self.message_sender.send_message(message)
+        Gets the push status of a message from the error which stopped it being sent, if any. Messages which can't be
+        addressed or which Junebug rejects won't be sent by retrying them.
+        """
+        if error is None:
+            return PushStatus.SENT
+        elif isinstance(error, JunebugMessageSendingError):
+            return PushStatus.FAILED
+        elif isinstance(error, requests.HTTPError) and error.response is not None:
+            status_code = error.response.status_code
+            if status_code < 500 and status_code != 429:
+                return PushStatus.FAILED
+
+        return PushStatus.RETRYABLE
 
     @staticmethod
     def _identity_equal(identity, contact):
@@ -552,16 +837,15 @@ def received_junebug_message(request):
     except ValueError as e:
         return JsonResponse({"reason": "JSON decode error", "details": str(e)}, status=400)
 
+    if getattr(settings, "JUNEBUG_INBOUND_QUEUED", False):
+        return queue_junebug_message(request.org, data)
+
     from_addr = URN.normalize_phone(data.get("from"))
 
     identity_store = IdentityStore(
         settings.IDENTITY_API_ROOT, settings.IDENTITY_AUTH_TOKEN, settings.IDENTITY_ADDRESS_TYPE
     )
-    identities = identity_store.get_identities_for_address(from_addr)
-    try:
-        identity = next(identities)
-    except StopIteration:
-        identity = identity_store.create_identity(["%s:%s" % (settings.IDENTITY_ADDRESS_TYPE, from_addr)])
+    identity = get_or_create_identity(identity_store, from_addr)
     contact = Contact.get_or_create(request.org, identity.get("id"))
 
     message_id = uuid_to_int(data.get("message_id"))
@@ -612,6 +896,158 @@ def received_junebug_message(request):
     return JsonResponse(msg.as_json())
 
 
+def get_or_create_identity(identity_store, address):
+    """
+    Gets the first identity with the given address, creating one if there isn't one
+    """
+    identity = next(identity_store.get_identities_for_address(address), None)
+    if identity is None:
+        identity = identity_store.create_identity(["%s:%s" % (settings.IDENTITY_ADDRESS_TYPE, address)])
+    return identity
+
+
+def queue_junebug_message(org, data):
+    """
+    Validates an MO message from Junebug and queues it in Redis for ingest_queued_messages to create, so that the
+    webhook can respond without waiting on the Identity Store or the database
+    """
+    try:
+        from_addr = URN.normalize_phone(data["from"])
+        message_id = UUID(hex=data["message_id"]).hex
+        timestamp = dateutil.parser.parse(data["timestamp"]) if "timestamp" in data else datetime.now(pytz.utc)
+    except (KeyError, TypeError, ValueError, OverflowError) as e:
+        return JsonResponse({"reason": "Invalid message", "details": str(e)}, status=400)
+
+    if not timestamp.tzinfo:
+        # Assume UTC
+        timestamp = pytz.utc.localize(timestamp)
+
+    item = {"from": from_addr, "message_id": message_id, "content": data.get("content") or "", "timestamp": timestamp}
+
+    # if the queue was empty, then there may be no ingest task running to take this message
+    if get_redis_connection().rpush(JUNEBUG_INBOUND_QUEUE_KEY % org.pk, json_encode(item)) == 1:
+        from casepro.msgs.tasks import ingest_junebug_messages
+
+        ingest_junebug_messages.delay(org.pk)
+
+    return JsonResponse({"queued": True}, status=202)
+
+
+def ingest_queued_messages(org, batch_size, time_limit=None):
+    """
+    Creates the messages queued by queue_junebug_message for the given org, a batch at a time. Each batch is only
+    removed from the queue once its messages have been created, and messages which already exist are ignored, so a
+    batch which fails part way through is just retried by the next run.
+    :param time_limit: the number of seconds after which no new batches are started, or None for no limit
+    :return: tuple of the number of messages created and the number of duplicates ignored
+    """
+    r = get_redis_connection()
+    queue_key = JUNEBUG_INBOUND_QUEUE_KEY % org.pk
+    identity_store = IdentityStore(
+        settings.IDENTITY_API_ROOT, settings.IDENTITY_AUTH_TOKEN, settings.IDENTITY_ADDRESS_TYPE
+    )
+
+    start = time.time()
+    num_created, num_duplicates = 0, 0
+
+    while time_limit is None or time.time() - start < time_limit:
+        items = r.lrange(queue_key, 0, batch_size - 1)
+        if not items:
+            break
+
+        created, duplicates = _ingest_batch(org, identity_store, [json_decode(i) for i in items])
+        num_created += created
+        num_duplicates += duplicates
+
+        r.ltrim(queue_key, len(items), -1)
+
+    return num_created, num_duplicates
+
+
+def _ingest_batch(org, identity_store, items):
+    """
+    Creates the messages for a batch of queued items, looking up the identity of each distinct address only once
+    :return: tuple of the number of messages created and the number of duplicates ignored
+    """
+    # resolve the identities of the batch's addresses concurrently
+    addresses = list(OrderedDict.fromkeys(i["from"] for i in items))
+    with ThreadPoolExecutor(max_workers=max(min(identity_store.max_workers, len(addresses)), 1)) as executor:
+        identities = executor.map(lambda address: get_or_create_identity(identity_store, address), addresses)
+        identity_ids = {address: identity["id"] for address, identity in zip(addresses, identities)}
+
+    contacts_by_uuid = Contact.bulk_get_or_create(org, [(uuid, None) for uuid in set(identity_ids.values())])
+
+    # a message is a duplicate if there's already one with its backend id and the same contact, text and time,
+    # otherwise a message with its backend id means that we have to pick another, just like the webhook does
+    existing = Message.objects.filter(org=org, backend_id__in=[uuid_to_int(i["message_id"]) for i in items])
+    taken = {
+        m.backend_id: (m.contact_id, m.text, m.created_on) for m in existing.only("contact", "text", "created_on")
+    }
+
+    messages = []
+    clashing = []
+    for item in items:
+        contact = contacts_by_uuid[identity_ids[item["from"]]]
+        message = Message(
+            org=org,
+            backend_id=uuid_to_int(item["message_id"]),
+            contact=contact,
+            type=Message.TYPE_INBOX,
+            text=item["content"],
+            created_on=dateutil.parser.parse(item["timestamp"]),
+            has_labels=True,
+        )
+
+        match = taken.get(message.backend_id)
+        if match == (contact.pk, message.text, message.created_on):
+            continue
+        elif match:
+            clashing.append(message)
+        else:
+            taken[message.backend_id] = (contact.pk, message.text, message.created_on)
+
+        messages.append(message)
+
+    # a clashing message may already have been created with a random backend id by an earlier attempt at this batch,
+    # so it's also a duplicate if there's a message with its contact, text and time whatever the backend id
+    if clashing:
+        ingested = set(
+            Message.objects.filter(
+                org=org,
+                contact__in={m.contact_id for m in clashing},
+                created_on__in={m.created_on for m in clashing},
+            ).values_list("contact", "text", "created_on")
+        )
+        duplicates = set()  # ids of the message objects as unsaved models aren't hashable
+        for message in clashing:
+            key = (message.contact_id, message.text, message.created_on)
+            if key in ingested:
+                duplicates.add(id(message))
+            ingested.add(key)
+
+        clashing = [m for m in clashing if id(m) not in duplicates]
+        messages = [m for m in messages if id(m) not in duplicates]
+
+    for message in clashing:
+        for i in range(10):
+            message_id = random.randint(0, 2147483647)
+            if message_id not in taken and not Message.objects.filter(org=org, backend_id=message_id).exists():
+                message.backend_id = message_id
+                taken[message_id] = (message.contact.pk, message.text, message.created_on)
+                break
+        else:
+            raise IntegrityError("Unable to find a unique backend id for a queued message")
+
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+
+        # bulk creation doesn't send post_save signals so record daily counts of incoming messages here
+        counts = Counter((datetime_to_date(m.created_on, org), (org,)) for m in messages)
+        DailyCount.record_counts(DailyCount.TYPE_INCOMING, counts)
+
+    return len(messages), len(items) - len(messages)
+
+
 def seed_auth_token():
     return settings.IDENTITY_AUTH_TOKEN
 
@@ -634,6 +1070,9 @@ def receive_identity_store_optout(request):
     except KeyError:
         return JsonResponse({"reason": 'Both "identity" and "optout_type" must be specified.'}, status=400)
 
+    # whatever the type of optout, the identity's details have changed so we shouldn't keep sending to cached ones
+    get_identity_cache().invalidate(identity_id)
+
     # The identity store currently doesn't specify the response format or do
     # anything with the response.
 
@@ -1,13 +1,26 @@
+import logging
+import smtplib
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+
 from dash.utils import chunks, is_dict_equal
-from dash.utils.sync import BaseSyncer, sync_local_to_changes, sync_local_to_set
+from dash.utils.sync import BaseSyncer, SyncOutcome, sync_from_remote, sync_local_to_changes, sync_local_to_set
+from django.conf import settings
+from django.db import transaction
 from django.utils.timezone import now
+from temba_client.exceptions import TembaBadRequestError, TembaException
 
 from casepro.contacts.models import Contact, Field, Group
-from casepro.msgs.models import Label, Message, Outgoing
+from casepro.msgs.models import Label, Labelling, Message, Outgoing
 from casepro.orgs_ext.models import Flow
+from casepro.statistics.models import DailyCount, buffered_counts, datetime_to_date
+from casepro.utils import bulk_update
 from casepro.utils.email import send_raw_email
+from casepro.utils.sync import get_sync_session, sync_session
+
+from . import BaseBackend, PushStatus
 
-from . import BaseBackend
+logger = logging.getLogger(__name__)
 
 # no concept of flagging in RapidPro so that is modelled with a label
 SYSTEM_LABEL_FLAGGED = "Flagged"
@@ -32,12 +45,23 @@ class ContactSyncer(BaseSyncer):
     model = Contact
     prefetch_related = ("groups",)
 
+    def __init__(self, backend, bulk_groups=False):
+        """
+        :param bulk_groups: whether group memberships are left for sync_page to reconcile for a whole page of contacts
+            rather than being updated by the post save signal handler of each contact
+        """
+        super(ContactSyncer, self).__init__(backend)
+
+        self.bulk_groups = bulk_groups
+        if bulk_groups:
+            self.prefetch_related = ()
+
     def local_kwargs(self, org, remote):
         # groups and fields are updated via a post save signal handler
         groups = [(g.uuid, g.name) for g in remote.groups]
         fields = {k: v for k, v in remote.fields.items() if v is not None}  # don't include none values
 
-        return {
+        kwargs = {
             "org": org,
             "uuid": remote.uuid,
             "name": remote.name,
@@ -46,8 +70,11 @@ class ContactSyncer(BaseSyncer):
             "is_stopped": remote.stopped,
             "is_stub": False,
             "fields": fields,
-            Contact.SAVE_GROUPS_ATTR: groups,
         }
+        if not self.bulk_groups:
+            kwargs[Contact.SAVE_GROUPS_ATTR] = groups
+
+        return kwargs
 
     def update_required(self, local, remote, remote_as_kwargs):
         if (
@@ -59,11 +86,31 @@ class ContactSyncer(BaseSyncer):
         ):
             return True
 
-        if {g.uuid for g in local.groups.all()} != {g.uuid for g in remote.groups}:
+        if not self.bulk_groups and {g.uuid for g in local.groups.all()} != {g.uuid for g in remote.groups}:
             return True
 
         return not is_dict_equal(local.get_fields(), remote.fields, ignore_none_values=True)
 
+    def sync_page(self, org, remotes):
+        """
+        Syncs a page of remote contacts, each individually except for their group memberships, which are reconciled
+        for the whole page at once. Contacts whose only change is their groups count as updated.
+        :return: dict of outcome counts
+        """
+        remotes_by_uuid = {r.uuid: r for r in remotes}
+        outcomes = {uuid: sync_from_remote(org, self, remote) for uuid, remote in remotes_by_uuid.items()}
+
+        contacts = list(Contact.objects.filter(org=org, uuid__in=remotes_by_uuid.keys()).only("id", "uuid"))
+        groups_by_contact = {c: [(g.uuid, g.name) for g in remotes_by_uuid[c.uuid].groups] for c in contacts}
+
+        changed = Contact.bulk_set_groups(org, groups_by_contact)
+
+        for contact in contacts:
+            if contact.pk in changed and outcomes[contact.uuid] == SyncOutcome.ignored:
+                outcomes[contact.uuid] = SyncOutcome.updated
+
+        return Counter(outcomes.values())
+
     def delete_local(self, local):
         local.release()
 
@@ -194,6 +241,272 @@ class MessageSyncer(BaseSyncer):
     def delete_local(self, local):
         local.release()
 
+    def sync_page(self, org, remotes):
+        """
+        Syncs local messages against a page of remote messages with a fixed number of queries, rather than saving each
+        message individually. Has the same outcomes as calling sync_from_remote for each remote message, including the
+        effects of the message save signal handlers which aren't sent for bulk operations. If a message appears more
+        than once in the page, only its last occurrence is synced and the others are ignored.
+        :return: dict of counts by sync outcome
+        """
+        outcome_counts = defaultdict(int)
+
+        remotes_by_id = {}
+        for remote in remotes:
+            if remote.id in remotes_by_id:
+                outcome_counts[SyncOutcome.ignored] += 1
+            remotes_by_id[remote.id] = remote
+
+        if not remotes_by_id:
+            return outcome_counts
+
+        # lock in a consistent order so that concurrent syncs can't deadlock
+        with ExitStack() as stack:
+            for backend_id in sorted(remotes_by_id.keys()):
+                stack.enter_context(self.lock(org, backend_id))
+
+            # the page is committed as a whole, along with the daily counts it records, before it's unlocked
+            stack.enter_context(transaction.atomic())
+            stack.enter_context(buffered_counts())
+
+            existing = self.fetch_all(org).filter(backend_id__in=remotes_by_id.keys())
+            existing = existing.select_related(*self.select_related).prefetch_related(*self.prefetch_related)
+            existing_by_id = {m.backend_id: m for m in existing}
+
+            to_create, to_update, to_delete = [], [], []
+            for backend_id, remote in remotes_by_id.items():
+                local = existing_by_id.get(backend_id)
+                kwargs = self.local_kwargs(org, remote)
+
+                if local:
+                    local.org = org
+
+                    if kwargs:
+                        if self.update_required(local, remote, kwargs) or not local.is_active:
+                            to_update.append((local, kwargs))
+                            continue
+                    elif local.is_active:
+                        to_delete.append(local)
+                        continue
+                elif kwargs:
+                    to_create.append(kwargs)
+                    continue
+
+                outcome_counts[SyncOutcome.ignored] += 1
+
+            all_kwargs = to_create + [kwargs for local, kwargs in to_update]
+            contact_uuid_names = [k[Message.SAVE_CONTACT_ATTR] for k in all_kwargs]
+            session = get_sync_session(org)
+            if session:
+                contacts_by_uuid = session.get_contacts(contact_uuid_names)
+            else:
+                contacts_by_uuid = Contact.bulk_get_or_create(org, contact_uuid_names)
+
+            labels_by_uuid = self._get_or_create_labels(
+                org, [l for k in all_kwargs for l in k[Message.SAVE_LABELS_ATTR]]
+            )
+
+            created = self._bulk_create(org, to_create, contacts_by_uuid, labels_by_uuid)
+            updated = self._bulk_update(org, to_update, contacts_by_uuid, labels_by_uuid)
+            deleted = self._bulk_delete(org, to_delete)
+
+        outcome_counts[SyncOutcome.created] += created
+        outcome_counts[SyncOutcome.updated] += updated
+        outcome_counts[SyncOutcome.deleted] += deleted
+        return outcome_counts
+
+    @staticmethod
+    def _get_or_create_labels(org, uuid_names):
+        """
+        Resolves the labels referenced by incoming messages, creating stubs for unknown labels unless there's a local
+        non-synced label with the same name
+        :return: dict of synced labels (or none if label shouldn't be applied) by UUID
+        """
+        session = get_sync_session(org)
+        org_labels = session.get_labels() if session else list(org.labels.all())
+        org_labels_by_uuid = {l.uuid: l for l in org_labels}
+        org_unsynced_names = {l.name for l in org_labels if not l.is_synced}
+
+        labels_by_uuid = {}
+        stubs = []
+        for uuid, name in dict(uuid_names).items():
+            label = org_labels_by_uuid.get(uuid)
+            if not label and name not in org_unsynced_names:
+                label = Label(org=org, uuid=uuid, name=name, is_active=False)
+                stubs.append(label)
+
+            labels_by_uuid[uuid] = label if label and label.is_synced else None
+
+        Label.objects.bulk_create(stubs)
+
+        if session:
+            for label in stubs:
+                session.add_label(label)
+
+        return labels_by_uuid
+
+    def _bulk_create(self, org, to_create, contacts_by_uuid, labels_by_uuid):
+        if not to_create:
+            return 0
+
+        messages = []
+        for kwargs in to_create:
+            kwargs = dict(kwargs)
+            contact_uuid = kwargs.pop(Message.SAVE_CONTACT_ATTR)[0]
+            kwargs.pop(Message.SAVE_LABELS_ATTR)
+
+            messages.append(Message(contact=contacts_by_uuid[contact_uuid], **kwargs))
+
+        Message.objects.bulk_create(messages)
+
+        # record daily counts of incoming messages, grouped by day
+        counts = Counter((datetime_to_date(m.created_on, org), (org,)) for m in messages)
+        DailyCount.record_counts(DailyCount.TYPE_INCOMING, counts)
+
+        messages_by_label = defaultdict(list)
+        for message, kwargs in zip(messages, to_create):
+            for label_uuid, label_name in kwargs[Message.SAVE_LABELS_ATTR]:
+                label = labels_by_uuid[label_uuid]
+                if label:
+                    messages_by_label[label].append(message)
+
+        for label, label_messages in messages_by_label.items():
+            Message.label_all(org, label_messages, label)
+
+        return len(messages)
+
+    def _bulk_update(self, org, to_update, contacts_by_uuid, labels_by_uuid):
+        if not to_update:
+            return 0
+
+        fields = set()
+        add_messages_by_label = defaultdict(list)
+        remove_messages_by_label = defaultdict(list)
+
+        for message, kwargs in to_update:
+            kwargs = dict(kwargs)
+            contact_uuid = kwargs.pop(Message.SAVE_CONTACT_ATTR)[0]
+            new_label_uuids = {l[0] for l in kwargs.pop(Message.SAVE_LABELS_ATTR)}
+
+            for field, value in kwargs.items():
+                setattr(message, field, value)
+                fields.add(field)
+
+            message.contact = contacts_by_uuid[contact_uuid]
+            message.is_active = True
+
+            # remove this message from any synced labels not in the new set, and add it to any new ones
+            cur_labels_by_uuid = {l.uuid: l for l in message.labels.all() if l.uuid}
+
+            for label in cur_labels_by_uuid.values():
+                if label.uuid not in new_label_uuids and label.is_synced:
+                    remove_messages_by_label[label].append(message)
+
+            for label_uuid in new_label_uuids:
+                label = labels_by_uuid[label_uuid]
+                if label_uuid not in cur_labels_by_uuid and label:
+                    add_messages_by_label[label].append(message)
+
+        fields.discard("org")
+        bulk_update([m for m, kwargs in to_update], sorted(fields) + ["contact", "is_active"])
+
+        for label, label_messages in remove_messages_by_label.items():
+            Message.unlabel_all(org, label_messages, label)
+        for label, label_messages in add_messages_by_label.items():
+            Message.label_all(org, label_messages, label)
+
+        return len(to_update)
+
+    @staticmethod
+    def _bulk_delete(org, to_delete):
+        if not to_delete:
+            return 0
+
+        # equivalent to calling release on each message
+        Labelling.objects.filter(message__in=to_delete).delete()
+        Message.objects.filter(pk__in=[m.pk for m in to_delete]).update(is_active=False, modified_on=now())
+
+        return len(to_delete)
+
+
+def bulk_sync_local_to_changes(org, syncer, fetches, deleted_fetches, progress_callback=None):
+    """
+    Like sync_local_to_changes but syncs each fetch of changed objects as a single page using the syncer's sync_page
+    method. Deleted objects are still released one at a time.
+    :return: tuple of number of local objects created, updated, deleted and ignored
+    """
+    num_synced = 0
+    outcome_counts = defaultdict(int)
+
+    for fetch in fetches:
+        for outcome, count in syncer.sync_page(org, fetch).items():
+            outcome_counts[outcome] += count
+
+        num_synced += len(fetch)
+        if progress_callback:
+            progress_callback(num_synced)
+
+    for deleted_fetch in deleted_fetches:
+        for deleted_remote in deleted_fetch:
+            identity = syncer.identify_remote(deleted_remote)
+            with syncer.lock(org, identity):
+                existing = syncer.fetch_local(org, identity)
+                if existing:
+                    syncer.delete_local(existing)
+                    outcome_counts[SyncOutcome.deleted] += 1
+
+        num_synced += len(deleted_fetch)
+        if progress_callback:
+            progress_callback(num_synced)
+
+    return (
+        outcome_counts[SyncOutcome.created],
+        outcome_counts[SyncOutcome.updated],
+        outcome_counts[SyncOutcome.deleted],
+        outcome_counts[SyncOutcome.ignored],
+    )
+
+
+def iterfetches(query, checkpoint, stage):
+    """
+    Iterates over the fetches of the given query as tuples of each fetch and the cursor of the fetch after it. If there
+    is a checkpoint, then this resumes from the cursor it has recorded for the given stage, or fetches nothing if that
+    stage is already done.
+    """
+    if checkpoint and checkpoint.is_stage_done(stage):
+        return
+
+    resume_cursor = checkpoint.get_cursor(stage) if checkpoint else None
+    iterator = query.iterfetches(retry_on_rate_exceed=True, resume_cursor=resume_cursor)
+
+    for fetch in iterator:
+        yield fetch, iterator.get_cursor()
+
+
+def record_cursors(fetches, checkpoint, stage):
+    """
+    Unwraps fetches from iterfetches, recording each cursor in the checkpoint only once the fetch before it has been
+    synced, i.e. when the next fetch is requested
+    """
+    for fetch, cursor in fetches:
+        yield fetch
+
+        if checkpoint:
+            checkpoint.save_cursor(stage, cursor)
+
+    if checkpoint:
+        checkpoint.complete_stage(stage)
+
+
+def prefetch_contacts(session, fetches):
+    """
+    Wraps fetches of remote messages so that the contacts of each fetch are fetched or created in bulk by the given sync
+    session before its messages are synced individually
+    """
+    for fetch in fetches:
+        session.get_contacts([(m.contact.uuid, m.contact.name) for m in fetch if m.visibility != "deleted"])
+        yield fetch
+
 
 class RapidProBackend(BaseBackend):
     """
@@ -212,15 +525,28 @@ class RapidProBackend(BaseBackend):
 
         # all contacts created or modified in RapidPro in the time window
         active_query = client.get_contacts(after=modified_after, before=modified_before)
-        fetches = active_query.iterfetches(retry_on_rate_exceed=True)
 
         # all contacts deleted in RapidPro in the same time window
         deleted_query = client.get_contacts(deleted=True, after=modified_after, before=modified_before)
-        deleted_fetches = deleted_query.iterfetches(retry_on_rate_exceed=True)
 
-        return sync_local_to_changes(
-            org, ContactSyncer(backend=self.backend), fetches, deleted_fetches, progress_callback
-        )
+        depth = getattr(settings, "PULL_PREFETCH_DEPTH", 2)
+
+        with sync_session(org) as session:
+            checkpoint = session.checkpoint
+            fetches = session.pipeline("contacts", iterfetches(active_query, checkpoint, "contacts"), depth)
+            fetches = record_cursors(fetches, checkpoint, "contacts")
+
+            deleted_fetches = iterfetches(deleted_query, checkpoint, "deleted_contacts")
+            deleted_fetches = session.pipeline("deleted_contacts", deleted_fetches, depth)
+            deleted_fetches = record_cursors(deleted_fetches, checkpoint, "deleted_contacts")
+
+            if getattr(settings, "PULL_CONTACT_GROUPS_IN_BULK", True):
+                syncer = ContactSyncer(backend=self.backend, bulk_groups=True)
+                return bulk_sync_local_to_changes(org, syncer, fetches, deleted_fetches, progress_callback)
+
+            return sync_local_to_changes(
+                org, ContactSyncer(backend=self.backend), fetches, deleted_fetches, progress_callback
+            )
 
     def pull_fields(self, org):
         client = self._get_client(org)
@@ -245,11 +571,19 @@ class RapidProBackend(BaseBackend):
 
         # all incoming messages created or modified in RapidPro in the time window
         query = client.get_messages(folder="incoming", after=modified_after, before=modified_before)
-        fetches = query.iterfetches(retry_on_rate_exceed=True)
 
-        return sync_local_to_changes(
-            org, MessageSyncer(backend=self.backend, as_handled=as_handled), fetches, [], progress_callback
-        )
+        syncer = MessageSyncer(backend=self.backend, as_handled=as_handled)
+
+        with sync_session(org) as session:
+            checkpoint = session.checkpoint
+            fetches = iterfetches(query, checkpoint, "messages")
+            fetches = session.pipeline("messages", fetches, getattr(settings, "PULL_PREFETCH_DEPTH", 2))
+            fetches = record_cursors(fetches, checkpoint, "messages")
+
+            if getattr(settings, "PULL_MESSAGES_IN_BULK", True):
+                return bulk_sync_local_to_changes(org, syncer, fetches, [], progress_callback)
+
+            return sync_local_to_changes(org, syncer, prefetch_contacts(session, fetches), [], progress_callback)
 
     def push_label(self, org, label):
         client = self._get_client(org)
@@ -265,45 +599,100 @@ class RapidProBackend(BaseBackend):
 
     def push_outgoing(self, org, outgoing, as_broadcast=False):
         client = self._get_client(org)
+        results = []
 
         # RapidPro currently doesn't send emails so we use the CasePro email system to send those instead
         for_backend = []
         for msg in outgoing:
             if msg.urn and msg.urn.startswith("mailto:"):
-                to_address = msg.urn.split(":", 1)[1]
-                send_raw_email([to_address], "New message", msg.text, None)
+                results.append((msg, self._send_email(msg)))
             else:
                 for_backend.append(msg)
 
-        if not for_backend:
-            return
-
-        if as_broadcast:
-            # we might not be able to send all as a single broadcast, so we batch
-            for batch in chunks(for_backend, self.BATCH_SIZE):
-                contact_uuids = []
-                urns = []
+        # messages pushed separately are still sent as broadcasts if they share the same text, but each should still
+        # reach its recipient, so a recipient is never repeated within a broadcast unless that was asked for
+        batches = self._coalesce_broadcasts(for_backend, repeat_recipients=as_broadcast)
+
+        for b, batch in enumerate(batches):
+            contact_uuids = []
+            urns = []
+
+            for msg in batch:
+                if msg.contact:
+                    contact_uuids.append(msg.contact.uuid)
+                if msg.urn:
+                    urns.append(msg.urn)
+
+            try:
+                broadcast = client.create_broadcast(text=batch[0].text, contacts=contact_uuids, urns=urns)
+            except TembaBadRequestError as e:
+                logger.warning("Unable to send %d outgoing messages, rejected by RapidPro: %s" % (len(batch), str(e)))
+                results.extend((msg, PushStatus.FAILED) for msg in batch)
+                continue
+            except TembaException as e:
+                # later broadcasts aren't attempted as they may be to the same recipients
+                logger.warning("Unable to send %d outgoing messages to RapidPro: %s" % (len(batch), str(e)))
+                results.extend((msg, PushStatus.RETRYABLE) for later in batches[b:] for msg in later)
+                break
+
+            for msg in batch:
+                msg.backend_broadcast_id = broadcast.id
 
-                for msg in batch:
-                    if msg.contact:
-                        contact_uuids.append(msg.contact.uuid)
-                    if msg.urn:
-                        urns.append(msg.urn)
-                text = outgoing[0].text
-                broadcast = client.create_broadcast(text=text, contacts=contact_uuids, urns=urns)
+            Outgoing.objects.filter(pk__in=[o.id for o in batch]).update(backend_broadcast_id=broadcast.id)
 
-                for msg in batch:
-                    msg.backend_broadcast_id = broadcast.id
+            results.extend((msg, PushStatus.SENT) for msg in batch)
 
-                Outgoing.objects.filter(pk__in=[o.id for o in batch]).update(backend_broadcast_id=broadcast.id)
-        else:
-            for msg in for_backend:
-                contact_uuids = [msg.contact.uuid] if msg.contact else []
-                urns = [msg.urn] if msg.urn else []
-                broadcast = client.create_broadcast(text=msg.text, contacts=contact_uuids, urns=urns)
+        return results
 
-                msg.backend_broadcast_id = broadcast.id
-                msg.save(update_fields=("backend_broadcast_id",))
+    @staticmethod
+    def _send_email(msg):
+        """
+        Sends an outgoing message to an email address
+        :return: the PushStatus of the message
+        """
+        to_address = msg.urn.split(":", 1)[1]
+        try:
+            send_raw_email([to_address], "New message", msg.text, None)
+        except smtplib.SMTPRecipientsRefused as e:
+            logger.warning("Unable to email outgoing message #%s, recipient refused: %s" % (msg.pk, str(e)))
+            return PushStatus.FAILED
+        except OSError as e:  # includes all other SMTP errors
+            logger.warning("Unable to email outgoing message #%s: %s" % (msg.pk, str(e)))
+            return PushStatus.RETRYABLE
+
+        return PushStatus.SENT
+
+    def _coalesce_broadcasts(self, messages, repeat_recipients):
+        """
+        Groups messages into batches which can each be sent as a single broadcast, i.e. which have the same text and
+        no more than BATCH_SIZE recipients, without moving a message ahead of an earlier one to the same recipient
+        :param repeat_recipients: whether a batch can include more than one message to the same recipient
+        :return: list of batches in the order they should be sent
+        """
+        batches = []
+        last_batch_by_text = {}
+        last_batch_by_recipient = {}
+
+        for msg in messages:
+            recipient = msg.urn or msg.contact.uuid
+            batch_index = last_batch_by_text.get(msg.text)
+            recipient_index = last_batch_by_recipient.get(recipient, -1)
+
+            # a message can only join a batch which comes after every batch with an earlier message to its recipient
+            if (
+                batch_index is None
+                or len(batches[batch_index]) == self.BATCH_SIZE
+                or recipient_index > batch_index
+                or (recipient_index == batch_index and not repeat_recipients)
+            ):
+                batch_index = len(batches)
+                batches.append([])
+                last_batch_by_text[msg.text] = batch_index
+
+            batches[batch_index].append(msg)
+            last_batch_by_recipient[recipient] = batch_index
+
+        return batches
 
     def push_contact(self, org, contact):
         return
@@ -0,0 +1,348 @@
+import json
+import random
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlencode, urlparse
+from uuid import UUID
+
+from django.utils.timezone import now
+from temba_client.utils import format_iso8601, parse_iso8601
+from temba_client.v2.types import Contact as TembaContact
+from temba_client.v2.types import Field as TembaField
+from temba_client.v2.types import Group as TembaGroup
+from temba_client.v2.types import Label as TembaLabel
+from temba_client.v2.types import Message as TembaMessage
+from temba_client.v2.types import ObjectRef
+
+DEFAULT_PAGE_SIZE = 250
+
+FIELD_KEYS = ("age", "district", "gender", "state")
+LANGUAGES = ("eng", "fra", "kin", "swa")
+WORDS_PER_MESSAGE = 12
+
+
+class StandInData(object):
+    """
+    Randomly generated remote objects for a stand-in server to serve, i.e. contact fields, groups, labels, contacts
+    (some of them deleted) and incoming messages for RapidPro, and an identity with the same details as each contact
+    for the Identity Store.
+    Every label has keywords which appear in some messages, so that rules can be created which match them.
+    """
+
+    def __init__(self, num_contacts, num_messages, num_groups=10, num_labels=10, days=7, deleted=0.02, seed=1234):
+        rand = random.Random(seed)
+        self.end = now()
+        self.start = self.end - timedelta(days=days)
+
+        vocabulary = ["".join(rand.choice("abcdefghijklmnopqrstuvwxyz") for c in range(6)) for w in range(2000)]
+
+        self.fields = [TembaField.create(key=k, label=k.title(), value_type="text") for k in FIELD_KEYS]
+        self.groups = [
+            TembaGroup.create(uuid=self._uuid(rand), name="Group %d" % g, query=None, count=0)
+            for g in range(num_groups)
+        ]
+        self.labels = [
+            TembaLabel.create(uuid=self._uuid(rand), name="Label %d" % l, count=0) for l in range(num_labels)
+        ]
+        self.label_keywords = {label.uuid: rand.sample(vocabulary, 2) for label in self.labels}
+
+        self.contacts = []
+        self.deleted_contacts = []
+        self.identities = []
+
+        for c in range(num_contacts):
+            uuid = self._uuid(rand)
+            created_on = self._random_time(rand)
+            modified_on = self._random_time(rand, after=created_on)
+
+            if rand.random() < deleted:
+                self.deleted_contacts.append(
+                    TembaContact.create(
+                        uuid=uuid,
+                        name=None,
+                        language=None,
+                        urns=[],
+                        groups=[],
+                        fields={},
+                        blocked=None,
+                        stopped=None,
+                        created_on=created_on,
+                        modified_on=modified_on,
+                    )
+                )
+                continue
+
+            name = "Contact %d" % c
+            phone = "+2507%08d" % c
+            language = rand.choice(LANGUAGES)
+
+            self.contacts.append(
+                TembaContact.create(
+                    uuid=uuid,
+                    name=name,
+                    language=language,
+                    urns=["tel:%s" % phone],
+                    groups=[ObjectRef.create(uuid=g.uuid, name=g.name) for g in rand.sample(self.groups, 2)],
+                    fields={k: rand.choice(vocabulary) for k in FIELD_KEYS},
+                    blocked=False,
+                    stopped=False,
+                    created_on=created_on,
+                    modified_on=modified_on,
+                )
+            )
+            self.identities.append(
+                {
+                    "id": self._uuid(rand),
+                    "version": 1,
+                    "details": {
+                        "name": name,
+                        "language": "%s_RW" % language,
+                        "default_addr_type": "msisdn",
+                        "addresses": {"msisdn": {phone: {"default": True}}},
+                    },
+                    "communicate_through": None,
+                    "operator": None,
+                    "created_at": format_iso8601(created_on),
+                    "updated_at": format_iso8601(modified_on),
+                }
+            )
+
+        self.messages = []
+
+        for m in range(num_messages):
+            contact = rand.choice(self.contacts)
+            labels = rand.sample(self.labels, rand.randint(0, 2))
+            words = rand.sample(vocabulary, WORDS_PER_MESSAGE)
+            if labels:
+                words.append(rand.choice(self.label_keywords[labels[0].uuid]))
+
+            created_on = self._random_time(rand)
+
+            self.messages.append(
+                TembaMessage.create(
+                    id=m + 1,
+                    broadcast=None,
+                    contact=ObjectRef.create(uuid=contact.uuid, name=contact.name),
+                    urn=contact.urns[0],
+                    channel=None,
+                    direction="in",
+                    type="inbox",
+                    status="handled",
+                    visibility="visible",
+                    text=" ".join(words),
+                    labels=[ObjectRef.create(uuid=l.uuid, name=l.name) for l in labels],
+                    created_on=created_on,
+                    sent_on=None,
+                    modified_on=self._random_time(rand, after=created_on),
+                )
+            )
+
+    def _random_time(self, rand, after=None):
+        start = after or self.start
+        return start + timedelta(seconds=rand.random() * (self.end - start).total_seconds())
+
+    @staticmethod
+    def _uuid(rand):
+        return str(UUID(int=rand.getrandbits(128), version=4))
+
+
+class Collection(object):
+    """
+    Serialized remote objects, ordered newest first by the given time attribute so that time windows of them can be
+    found by bisection, and served as pages from an offset within a window
+    """
+
+    def __init__(self, items, time_attr):
+        items = sorted(items, key=lambda i: i[time_attr], reverse=True)
+        self.items = items
+        self.keys = [-parse_iso8601(i[time_attr]).timestamp() for i in items]
+
+    def window(self, after, before):
+        """
+        Gets the objects with times in the given window, either end of which can be None
+        """
+        start = bisect_left(self.keys, -before.timestamp()) if before else 0
+        stop = bisect_right(self.keys, -after.timestamp()) if after else len(self.items)
+        return self.items[start:stop]
+
+
+class StandInServer(object):
+    """
+    Local HTTP server which stands in for the RapidPro API v2 endpoints used to pull contact fields, groups, labels,
+    contacts and messages, and the Identity Store API v1 endpoints used by IdentityStore. Fetches are paginated with
+    cursors like the real APIs, and every request is delayed by the given latency. Requests which change remote state,
+    e.g. labelling messages, are accepted but ignored, except for creating identities.
+    """
+
+    def __init__(self, data, latency=0.0, page_size=DEFAULT_PAGE_SIZE, port=0):
+        self.latency = latency
+        self.page_size = page_size
+        self.num_requests = 0
+
+        self.fields = [f.serialize() for f in data.fields]
+        self.groups = [g.serialize() for g in data.groups]
+        self.labels = [l.serialize() for l in data.labels]
+        self.contacts = Collection([c.serialize() for c in data.contacts], "modified_on")
+        self.deleted_contacts = Collection([c.serialize() for c in data.deleted_contacts], "modified_on")
+        self.messages = Collection([m.serialize() for m in data.messages], "modified_on")
+
+        self.identities_by_created = Collection(data.identities, "created_at")
+        self.identities_by_updated = Collection(data.identities, "updated_at")
+        self.identities_by_id = {i["id"]: i for i in data.identities}
+        self.identities_by_address = {}
+        for identity in data.identities:
+            for addresses in identity["details"]["addresses"].values():
+                for address in addresses.keys():
+                    self.identities_by_address.setdefault(address, []).append(identity)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), StandInRequestHandler)
+        self.httpd.standin = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.httpd.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def get(self, path, params):
+        """
+        Handles a GET request
+        :return: tuple of status code and response body
+        """
+        parts = path.strip("/").split("/")
+
+        if parts[:2] == ["api", "v2"] and len(parts) == 3:
+            endpoint = parts[2].replace(".json", "")
+
+            if endpoint == "fields":
+                return 200, self.paginate(self.filter(self.fields, params, "key"), path, params)
+            elif endpoint == "groups":
+                return 200, self.paginate(self.filter(self.groups, params, "uuid", "name"), path, params)
+            elif endpoint == "labels":
+                return 200, self.paginate(self.filter(self.labels, params, "uuid", "name"), path, params)
+            elif endpoint == "contacts":
+                contacts = self.deleted_contacts if params.get("deleted") in ("1", "true") else self.contacts
+                items = contacts.window(parse_iso8601(params.get("after")), parse_iso8601(params.get("before")))
+                return 200, self.paginate(items, path, params)
+            elif endpoint == "messages":
+                items = self.messages.window(parse_iso8601(params.get("after")), parse_iso8601(params.get("before")))
+                return 200, self.paginate(items, path, params)
+
+        elif parts[:3] == ["api", "v1", "identities"]:
+            if len(parts) == 3:
+                if params.get("created_from") or params.get("created_to"):
+                    window = self.identities_by_created.window(
+                        parse_iso8601(params.get("created_from")), parse_iso8601(params.get("created_to"))
+                    )
+                else:
+                    window = self.identities_by_updated.window(
+                        parse_iso8601(params.get("updated_from")), parse_iso8601(params.get("updated_to"))
+                    )
+                return 200, self.paginate(window, path, params)
+
+            elif parts[3] == "search":
+                address = next((v for k, v in params.items() if k.startswith("details__addresses__")), None)
+                return 200, self.paginate(self.identities_by_address.get(address, []), path, params)
+
+            identity = self.identities_by_id.get(parts[3])
+            if identity:
+                if len(parts) == 4:
+                    return 200, identity
+
+                addresses = identity["details"]["addresses"].get(parts[5], {})
+                return 200, self.paginate([{"address": a} for a in addresses.keys()], path, params)
+
+        return 404, {"detail": "Not found."}
+
+    def post(self, path, body):
+        """
+        Handles a POST request
+        :return: tuple of status code and response body
+        """
+        parts = path.strip("/").split("/")
+
+        if parts == ["api", "v1", "identities"]:
+            identity = dict(body, id=str(UUID(int=random.getrandbits(128), version=4)), version=1)
+            self.identities_by_id[identity["id"]] = identity
+            return 201, identity
+        elif parts == ["api", "v2", "labels.json"]:
+            label = {"uuid": str(UUID(int=random.getrandbits(128), version=4)), "name": body.get("name"), "count": 0}
+            self.labels.append(label)
+            return 201, label
+
+        return 204, None
+
+    @staticmethod
+    def filter(items, params, *attrs):
+        for attr in attrs:
+            if params.get(attr):
+                items = [i for i in items if i[attr] == params[attr]]
+        return items
+
+    def paginate(self, items, path, params):
+        """
+        Gets a page of the given items starting at the offset given by the cursor param, with a URL for the next page
+        if there are more items
+        """
+        offset = int(params.get("cursor", 0))
+        next_offset = offset + self.page_size
+        next_url = None
+        if next_offset < len(items):
+            next_url = "%s%s?%s" % (self.url.rstrip("/"), path, urlencode(dict(params, cursor=next_offset)))
+
+        return {"next": next_url, "previous": None, "results": items[offset:next_offset]}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.respond(lambda standin: standin.get(url.path, dict(parse_qsl(url.query))))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
+        self.respond(lambda standin: standin.post(urlparse(self.path).path, body))
+
+    def respond(self, handler):
+        standin = self.server.standin
+        standin.num_requests += 1
+
+        if standin.latency:
+            time.sleep(standin.latency)
+
+        status, body = handler(standin)
+        content = json.dumps(body).encode("utf-8") if body is not None else b""
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
@@ -3,24 +3,33 @@ import uuid
 from datetime import datetime
 
 import pytz
+import requests
 import responses
 from django.conf import settings
 from django.db import IntegrityError
 from django.http import HttpResponse
 from django.test import RequestFactory, override_settings
+from django_redis import get_redis_connection
 from unittest import mock
 
+from casepro.celery import unschedule_disabled_tasks
 from casepro.contacts.models import Contact, Field, Group
 from casepro.msgs.models import Label, Message
+from casepro.msgs.tasks import ingest_junebug_messages
+from casepro.statistics.models import DailyCount
 from casepro.test import BaseCasesTest
 from casepro.utils import json_decode, uuid_to_int
 
+from .. import PushStatus
 from ..junebug import (
+    JUNEBUG_INBOUND_QUEUE_KEY,
+    IdentityCache,
     IdentityStore,
     IdentityStoreContact,
     IdentityStoreContactSyncer,
     JunebugBackend,
     JunebugMessageSendingError,
+    get_identity_cache,
     receive_identity_store_optout,
     received_junebug_message,
     token_auth_required,
@@ -30,6 +39,7 @@ from ..junebug import (
 class JunebugBackendTest(BaseCasesTest):
     def setUp(self):
         super(JunebugBackendTest, self).setUp()
+        get_identity_cache().clear()
         self.backend = JunebugBackend()
 
     def add_identity_store_callback(self, query, callback):
@@ -485,6 +495,11 @@ class JunebugBackendTest(BaseCasesTest):
         self.backend.push_outgoing(self.unicef, [msg])
         self.assertEqual(len(responses.calls), 3)
 
+        # the contact's addresses are now cached, and are resolved once for many messages
+        msg2 = self.create_outgoing(self.unicef, self.user1, None, "B", "That's great", bob)
+        self.backend.push_outgoing(self.unicef, [msg, msg2])
+        self.assertEqual(len(responses.calls), 5)
+
     @responses.activate
     @override_settings(JUNEBUG_FROM_ADDRESS="+4321")
     def test_outgoing_from_address(self):
@@ -657,22 +672,84 @@ class JunebugBackendTest(BaseCasesTest):
         self.backend.push_outgoing(self.unicef, [out_msg])
         self.assertEqual(len(responses.calls), 2)
 
+    @responses.activate
+    @mock.patch("casepro.backend.junebug.JunebugMessageSender.RETRY_BACKOFF", 0)
+    def test_outgoing_retries_and_failures(self):
+        """
+        Sending should be retried on server and connection errors, and messages which still can't be sent should be
+        reported without stopping the others being sent, as failed if Junebug rejected them or otherwise as retryable.
+        """
+        msgs = [
+            self.create_outgoing(self.unicef, self.user1, None, "F", "Hello", None, urn="tel:+%d" % n)
+            for n in range(1, 5)
+        ]
+        attempts = []
+
+        def junebug_callback(request):
+            to_addr = json_decode(request.body)["to"]
+            attempts.append(to_addr)
+
+            if to_addr == "+2" and attempts.count(to_addr) == 1:
+                return 503, {}, ""  # succeeds on retry
+            elif to_addr == "+3":
+                return 400, {}, json.dumps({"status": 400, "code": "Bad Request"})  # not retried
+            elif to_addr == "+4":
+                raise requests.ConnectionError("Connection refused")  # never succeeds
+            return 201, {}, json.dumps({"status": 201, "code": "created"})
+
+        responses.add_callback(
+            responses.POST,
+            "http://localhost:8080/channels/replace-me/messages/",
+            callback=junebug_callback,
+            content_type="application/json",
+        )
+
+        results = self.backend.push_outgoing(self.unicef, msgs)
+
+        self.assertEqual(sorted(attempts), ["+1", "+2", "+2", "+3", "+4", "+4", "+4", "+4"])
+        self.assertEqual(
+            results,
+            [
+                (msgs[0], PushStatus.SENT),
+                (msgs[1], PushStatus.SENT),
+                (msgs[2], PushStatus.FAILED),
+                (msgs[3], PushStatus.RETRYABLE),
+            ],
+        )
+
+        # sending a single message raises the failure
+        with override_settings(JUNEBUG_SEND_RETRIES=0):
+            self.assertRaises(JunebugMessageSendingError, JunebugBackend().message_sender.send_message, msgs[2])
+
     def test_outgoing_no_urn_no_contact(self):
         """
         If the outgoing message has no URN or contact, then we cannot send it.
         """
         msg = self.create_outgoing(self.unicef, self.user1, None, "B", "That's great", None, urn=None)
 
-        self.assertRaises(JunebugMessageSendingError, self.backend.push_outgoing, self.unicef, [msg])
+        self.assertEqual(self.backend.push_outgoing(self.unicef, [msg]), [(msg, PushStatus.FAILED)])
 
+    @responses.activate
     def test_outgoing_invalid_urn(self):
         """
-        If the outgoing message has an invalid URN, an exception should be raised.
+        If the outgoing message has an invalid URN, it should fail without stopping other messages being sent.
         """
         bob = self.create_contact(self.unicef, "C-002", "Bob")
         msg = self.create_outgoing(self.unicef, self.user1, None, "B", "That's great", bob, urn="badurn")
+        msg2 = self.create_outgoing(self.unicef, self.user1, None, "B", "That's great", bob, urn="tel:+1234")
 
-        self.assertRaises(JunebugMessageSendingError, self.backend.push_outgoing, self.unicef, [msg])
+        responses.add(
+            responses.POST,
+            "http://localhost:8080/channels/replace-me/messages/",
+            json={"status": 201, "code": "created"},
+            status=201,
+        )
+
+        results = self.backend.push_outgoing(self.unicef, [msg, msg2])
+
+        self.assertEqual(results, [(msg, PushStatus.FAILED), (msg2, PushStatus.SENT)])
+        self.assertEqual(len(responses.calls), 1)
+        self.assertRaises(JunebugMessageSendingError, self.backend.message_sender.send_message, msg)
 
     def test_add_to_group(self):
         """
@@ -1104,6 +1181,143 @@ class JunebugInboundViewTest(BaseCasesTest):
         request.org = self.unicef
         self.assertRaises(IntegrityError, received_junebug_message, request)
 
+    def post_queued(self, **data):
+        request = self.factory.post(self.url, content_type="application/json", data=json.dumps(data))
+        request.org = self.unicef
+        with override_settings(JUNEBUG_INBOUND_QUEUED=True):
+            return received_junebug_message(request)
+
+    @responses.activate
+    @mock.patch("casepro.msgs.tasks.ingest_junebug_messages.delay")
+    def test_inbound_message_queued(self, mock_delay):
+        """
+        In queued mode, messages should be validated and queued, and then created in batches by the ingest task, with
+        each address only looked up once per batch.
+        """
+        get_redis_connection().delete(JUNEBUG_INBOUND_QUEUE_KEY % self.unicef.pk)
+
+        search_url = "%sapi/v1/identities/search/" % settings.IDENTITY_API_ROOT
+        responses.add_callback(
+            responses.GET,
+            search_url + "?details__addresses__msisdn=%2B1234",
+            callback=self.single_identity_callback,
+            match_querystring=True,
+            content_type="application/json",
+        )
+        responses.add_callback(
+            responses.GET,
+            search_url + "?details__addresses__msisdn=%2B5678",
+            callback=self.no_identity_callback,
+            match_querystring=True,
+            content_type="application/json",
+        )
+        responses.add(
+            responses.POST,
+            "%sapi/v1/identities/" % settings.IDENTITY_API_ROOT,
+            json=self.create_identity_obj(id="ab2b5e1c-6e08-4bd4-8bcb-86ab5fb1cd5e"),
+            status=201,
+        )
+
+        # messages which can't be queued are rejected
+        response = self.post_queued(message_id="xyz", content="test message", **{"from": "+1234"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json_decode(response.content)["reason"], "Invalid message")
+
+        response = self.post_queued(message_id="35f3336d4a1a46c7b40cd172a41c510d", content="Hello")
+        self.assertEqual(response.status_code, 400)
+
+        # valid messages are queued without any lookups, and the ingest task is only started for an empty queue
+        response = self.post_queued(message_id="35f3336d4a1a46c7b40cd172a41c5101", content="One", **{"from": "+1234"})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json_decode(response.content), {"queued": True})
+
+        self.post_queued(
+            message_id="45f3336d4a1a46c7b40cd172a41c5102",
+            content="Two",
+            timestamp="2016.11.21 07:30:05.123456",
+            **{"from": "+1234"}
+        )
+        self.post_queued(message_id="55f3336d4a1a46c7b40cd172a41c5103", content=None, **{"from": "+5678"})
+
+        self.assertEqual(len(responses.calls), 0)
+        self.assertEqual(Message.objects.filter(org=self.unicef).count(), 0)
+        mock_delay.assert_called_once_with(self.unicef.pk)
+
+        with override_settings(JUNEBUG_INBOUND_BATCH_SIZE=2):
+            ingest_junebug_messages(self.unicef.pk)
+
+        self.assertEqual(
+            json_decode(self.unicef.get_task_state("junebug-ingest").last_results),
+            {"messages": {"created": 3, "duplicates": 0}},
+        )
+        self.assertEqual(len(responses.calls), 3)  # the two searches for +1234 were in different batches
+
+        msg1, msg2, msg3 = Message.objects.filter(org=self.unicef).order_by("text")
+        self.assertEqual(msg1.text, "")
+        self.assertEqual(msg1.contact.uuid, "ab2b5e1c-6e08-4bd4-8bcb-86ab5fb1cd5e")
+        self.assertEqual(msg2.text, "One")
+        self.assertEqual(msg2.backend_id, uuid_to_int("35f3336d4a1a46c7b40cd172a41c5101"))
+        self.assertEqual(msg2.contact.uuid, "50d62fcf-856a-489c-914a-56f6e9506ee3")
+        self.assertEqual(msg3.text, "Two")
+        self.assertEqual(msg3.contact, msg2.contact)
+        self.assertEqual(msg3.created_on, datetime(2016, 11, 21, 7, 30, 5, 123456, pytz.utc))
+        self.assertEqual(get_redis_connection().llen(JUNEBUG_INBOUND_QUEUE_KEY % self.unicef.pk), 0)
+        self.assertEqual(DailyCount.get_by_org([self.unicef], DailyCount.TYPE_INCOMING).total(), 3)
+
+        # a message which was already created is ignored, but one which just has the same backend id is created
+        self.post_queued(
+            message_id="45f3336d4a1a46c7b40cd172a41c5102",
+            content="Two",
+            timestamp="2016.11.21 07:30:05.123456",
+            **{"from": "+1234"}
+        )
+        self.post_queued(
+            message_id="95f3336d4a1a46c7b40cd172a41c5102",
+            content="Different",
+            timestamp="2016.11.21 07:30:05.123456",
+            **{"from": "+1234"}
+        )
+        ingest_junebug_messages(self.unicef.pk)
+
+        self.assertEqual(
+            json_decode(self.unicef.get_task_state("junebug-ingest").last_results),
+            {"messages": {"created": 1, "duplicates": 1}},
+        )
+        self.assertEqual(len(responses.calls), 4)
+
+        msg4 = Message.objects.get(org=self.unicef, text="Different")
+        self.assertNotEqual(msg4.backend_id, msg3.backend_id)
+        self.assertEqual(msg4.contact, msg3.contact)
+
+        # retrying a batch whose clashing message was created but which wasn't removed from the queue doesn't create
+        # that message again with another random backend id
+        self.post_queued(
+            message_id="95f3336d4a1a46c7b40cd172a41c5102",
+            content="Different",
+            timestamp="2016.11.21 07:30:05.123456",
+            **{"from": "+1234"}
+        )
+        ingest_junebug_messages(self.unicef.pk)
+
+        self.assertEqual(
+            json_decode(self.unicef.get_task_state("junebug-ingest").last_results),
+            {"messages": {"created": 0, "duplicates": 1}},
+        )
+        self.assertEqual(Message.objects.filter(org=self.unicef, text="Different").count(), 1)
+
+    def test_ingest_scheduled_if_queued(self):
+        sender = mock.Mock()
+
+        with override_settings(JUNEBUG_INBOUND_QUEUED=False):
+            sender.conf.beat_schedule = {"message-pull": {}, "junebug-ingest": {}}
+            unschedule_disabled_tasks(sender)
+            self.assertEqual(set(sender.conf.beat_schedule), {"message-pull"})
+
+        with override_settings(JUNEBUG_INBOUND_QUEUED=True):
+            sender.conf.beat_schedule = {"message-pull": {}, "junebug-ingest": {}}
+            unschedule_disabled_tasks(sender)
+            self.assertEqual(set(sender.conf.beat_schedule), {"message-pull", "junebug-ingest"})
+
 
 class IdentityStoreOptoutViewTest(BaseCasesTest):
     """
@@ -1115,6 +1329,7 @@ class IdentityStoreOptoutViewTest(BaseCasesTest):
     def setUp(self):
         self.factory = RequestFactory()
         super(IdentityStoreOptoutViewTest, self).setUp()
+        get_identity_cache().clear()
 
     def test_method_not_post(self):
         """
@@ -1204,6 +1419,8 @@ class IdentityStoreOptoutViewTest(BaseCasesTest):
         contact = Contact.get_or_create(self.unicef, "test_id", "testing")
         self.assertFalse(contact.is_blocked)
 
+        get_identity_cache().set(("http://localhost:8081", "identity", "test_id"), {"id": "test_id"}, ["test_id"])
+
         request = self.get_optout_request(contact.uuid, "stop")
         with self.settings(IDENTITY_AUTH_TOKEN="test_token"):
             request.META["HTTP_AUTHORIZATION"] = "Token " + settings.IDENTITY_AUTH_TOKEN
@@ -1214,6 +1431,9 @@ class IdentityStoreOptoutViewTest(BaseCasesTest):
         contact = Contact.get_or_create(self.unicef, "test_id", "testing")
         self.assertTrue(contact.is_blocked)
 
+        # and the cached identity is dropped
+        self.assertEqual(get_identity_cache().entries, {})
+
     @responses.activate
     def test_unsubscribe_optout_received(self):
         """
@@ -1325,6 +1545,10 @@ class TokenAuthRequiredTest(BaseCasesTest):
 
 
 class IdentityStoreTest(BaseCasesTest):
+    def setUp(self):
+        super(IdentityStoreTest, self).setUp()
+        get_identity_cache().clear()
+
     def get_identities_callback(self, request):
         self.assertEqual(request.headers.get("Content-Type"), "application/json")
         self.assertEqual(request.headers.get("Authorization"), "Token auth-token")
@@ -1474,6 +1698,54 @@ class IdentityStoreTest(BaseCasesTest):
 
         res = identity_store.get_addresses("identity-uuid")
         self.assertEqual(sorted(res), sorted(["+1234", "+4321"]))
+        self.assertEqual(len(responses.calls), 3)
+
+        # addresses are now cached
+        self.assertEqual(sorted(identity_store.get_addresses("identity-uuid")), ["+1234", "+4321"])
+        self.assertEqual(len(responses.calls), 3)
+
+        # until the identity communicated through is invalidated
+        get_identity_cache().invalidate("other-uuid")
+
+        self.assertEqual(sorted(identity_store.get_addresses("identity-uuid")), ["+1234", "+4321"])
+        self.assertEqual(len(responses.calls), 5)
+
+    @responses.activate
+    def test_get_addresses_for_identities(self):
+        """
+        The addresses of many identities should be resolved at once, with each identity only looked up once.
+        """
+        identity_store = IdentityStore("http://identitystore.org/", "auth-token", "msisdn")
+
+        def identity_callback(request):
+            uuid = request.url.split("/")[-2]
+            return 200, {"Content-Type": "application/json"}, json.dumps({"id": uuid, "communicate_through": None})
+
+        def addresses_callback(request):
+            uuid = request.url.split("/")[-3]
+            resp = {"next": None, "previous": None, "results": [{"address": "+%s" % uuid}]}
+            return 200, {"Content-Type": "application/json"}, json.dumps(resp)
+
+        for identity_id in ("1", "2", "3"):
+            responses.add_callback(
+                responses.GET,
+                "http://identitystore.org/api/v1/identities/%s/" % identity_id,
+                callback=identity_callback,
+                content_type="application/json",
+            )
+            responses.add_callback(
+                responses.GET,
+                "http://identitystore.org/api/v1/identities/%s/addresses/msisdn" % identity_id,
+                callback=addresses_callback,
+                content_type="application/json",
+            )
+
+        self.assertEqual(identity_store.get_addresses_for_identities([]), {})
+        self.assertEqual(identity_store.get_addresses_for_identities(["1"]), {"1": ["+1"]})
+        self.assertEqual(
+            identity_store.get_addresses_for_identities(["1", "2", "3", "2"]), {"1": ["+1"], "2": ["+2"], "3": ["+3"]}
+        )
+        self.assertEqual(len(responses.calls), 6)
 
     @responses.activate
     def test_get_identities(self):
@@ -1641,6 +1913,65 @@ class IdentityStoreTest(BaseCasesTest):
         identity = identity_store.get_identity("identity-uuid")
         self.assertEqual(identity, None)
 
+        # missing identities aren't cached
+        identity_store.get_identity("identity-uuid")
+        self.assertEqual(len(responses.calls), 2)
+
+
+class IdentityCacheTest(BaseCasesTest):
+    def test_get_and_set(self):
+        cache = IdentityCache(ttl=300, max_size=2)
+
+        self.assertIsNone(cache.get("a"))
+
+        cache.set("a", "A", ["1"])
+        cache.set("b", "B", ["1", "2"])
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("b"), "B")
+
+        # adding another entry evicts the least recently used
+        cache.get("a")
+        cache.set("c", "C", ["3"])
+        self.assertEqual(cache.get("a"), "A")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "C")
+        self.assertEqual((cache.hits, cache.misses), (5, 2))
+
+        # entries expire after the TTL
+        with mock.patch("casepro.backend.junebug.time.time", return_value=cache.last_synced + 301):
+            self.assertIsNone(cache.get("a"))
+
+        self.assertEqual(list(cache.entries.keys()), ["c"])
+
+        # a TTL of zero disables caching
+        cache = IdentityCache(ttl=0, max_size=2)
+        cache.set("a", "A", ["1"])
+        self.assertIsNone(cache.get("a"))
+
+    def test_invalidate(self):
+        cache1 = IdentityCache(ttl=300, max_size=10, sync_interval=0)
+        cache2 = IdentityCache(ttl=300, max_size=10, sync_interval=0)
+
+        for cache in (cache1, cache2):
+            cache.set("a", "A", ["1"])
+            cache.set("b", "B", ["1", "2"])
+            cache.set("c", "C", ["3"])
+
+        # invalidating an identity drops every entry which depends on it, here and in other processes' caches
+        cache1.invalidate("2")
+
+        self.assertEqual(list(cache1.entries.keys()), ["a", "c"])
+        self.assertEqual(cache2.get("a"), "A")
+        self.assertIsNone(cache2.get("b"))
+
+        cache1.invalidate("1")
+
+        self.assertIsNone(cache2.get("a"))
+        self.assertEqual(cache2.get("c"), "C")
+
+        cache2.clear()
+        self.assertEqual(cache2.entries, {})
+
 
 class IdentityStoreContactTest(BaseCasesTest):
     def test_contact_with_defaults(self):
@@ -1,3 +1,4 @@
+import smtplib
 import time
 from datetime import datetime, timedelta
 from unittest import skip
@@ -5,8 +6,10 @@ from unittest import skip
 import pytz
 from dash.orgs.models import Org
 from dash.test import MockClientQuery
+from django.test.utils import override_settings
 from django.utils.timezone import now
 from unittest.mock import call, patch
+from temba_client.exceptions import TembaBadRequestError, TembaConnectionError
 from temba_client.v1.types import Broadcast as TembaBroadcast
 from temba_client.v2.types import Contact as TembaContact
 from temba_client.v2.types import Field as TembaField
@@ -19,8 +22,11 @@ from temba_client.v2.types import ObjectRef
 from casepro.contacts.models import Contact, Field, Group
 from casepro.msgs.models import Label, Message, Outgoing
 from casepro.orgs_ext.models import Flow
+from casepro.statistics.models import DailyCount
 from casepro.test import BaseCasesTest
+from casepro.utils.sync import PullCheckpoint, sync_session
 
+from .. import PushStatus
 from ..rapidpro import ContactSyncer, MessageSyncer, RapidProBackend
 
 
@@ -355,6 +361,17 @@ class RapidProBackendTest(BaseCasesTest):
 
     @patch("dash.orgs.models.TembaClient.get_contacts")
     def test_pull_contacts(self, mock_get_contacts):
+        self._test_pull_contacts(mock_get_contacts, (15, 12, 5, 8))
+
+    @override_settings(PULL_CONTACT_GROUPS_IN_BULK=False)
+    @patch("dash.orgs.models.TembaClient.get_contacts")
+    def test_pull_contacts_individually(self, mock_get_contacts):
+        self._test_pull_contacts(mock_get_contacts, (15, 13, 3, 9))
+
+    def _test_pull_contacts(self, mock_get_contacts, num_queries):
+        """
+        Syncing group memberships a page at a time or per contact should have the same outcomes
+        """
         # start with nothing...
         Group.objects.all().delete()
         Field.objects.all().delete()
@@ -415,7 +432,7 @@ class RapidProBackendTest(BaseCasesTest):
             ),
         ]
 
-        with self.assertNumQueries(16):
+        with self.assertNumQueries(num_queries[0]):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_contacts(self.unicef, None, None)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (3, 0, 0, 0))
@@ -469,7 +486,7 @@ class RapidProBackendTest(BaseCasesTest):
             ),
         ]
 
-        with self.assertNumQueries(13):
+        with self.assertNumQueries(num_queries[1]):
             self.assertEqual(self.backend.pull_contacts(self.unicef, None, None), (0, 1, 1, 0))
 
         self.assertEqual(set(Contact.objects.filter(is_active=True)), {bob, ann})
@@ -502,12 +519,40 @@ class RapidProBackendTest(BaseCasesTest):
             MockClientQuery([]),
         ]
 
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(num_queries[2]):
             self.assertEqual(self.backend.pull_contacts(self.unicef, None, None), (0, 0, 0, 1))
 
         self.assertEqual(set(Contact.objects.filter(is_active=True)), {bob, ann})
         self.assertEqual(set(Contact.objects.filter(is_active=False)), {jim})
 
+        mock_get_contacts.side_effect = [
+            # first call to get active contacts will return a contact with only a change to groups
+            MockClientQuery(
+                [
+                    TembaContact.create(
+                        uuid="C-001",
+                        name="Bob McFlough",
+                        language="fre",
+                        urns=["twitter:bobflow22"],
+                        groups=[
+                            ObjectRef.create(uuid="G-001", name="Customers"),
+                            ObjectRef.create(uuid="G-003", name="Testers"),
+                        ],
+                        fields={"age": "35"},
+                        stopped=True,
+                        blocked=False,
+                    )
+                ]
+            ),
+            MockClientQuery([]),
+        ]
+
+        with self.assertNumQueries(num_queries[3]):
+            self.assertEqual(self.backend.pull_contacts(self.unicef, None, None), (0, 1, 0, 0))
+
+        testers = Group.objects.get(org=self.unicef, uuid="G-003", name="Testers", is_active=False)
+        self.assertEqual(set(bob.groups.all()), {customers, testers})
+
     @patch("dash.orgs.models.TembaClient.get_fields")
     def test_pull_fields(self, mock_get_fields):
         # start with no fields
@@ -743,6 +788,156 @@ class RapidProBackendTest(BaseCasesTest):
 
         self.assertEqual(set(msg1.labels.all()), {self.aids, important})
 
+    @patch("dash.orgs.models.TembaClient.get_messages")
+    def test_pull_messages_with_checkpoint(self, mock_get_messages):
+        d1 = now() - timedelta(hours=10)
+        d2 = now() - timedelta(hours=9)
+
+        def create_message(msg_id):
+            return TembaMessage.create(
+                id=msg_id,
+                contact=ObjectRef.create(uuid="C-001", name="Ann"),
+                type="inbox",
+                text="Hello",
+                visibility="visible",
+                labels=[],
+                created_on=d1,
+            )
+
+        query = MockClientQuery([create_message(101)], [create_message(102)])
+        mock_get_messages.return_value = query
+
+        checkpoint = PullCheckpoint(self.unicef, "message-pull", d1)
+        checkpoint.begin_slice(d2)
+        checkpoint.save_cursor("messages", "cursor-0")
+
+        with sync_session(self.unicef) as session:
+            session.checkpoint = checkpoint
+
+            with patch.object(query, "iterfetches", wraps=query.iterfetches) as mock_iterfetches:
+                self.assertEqual(self.backend.pull_messages(self.unicef, d1, d2), (2, 0, 0, 0))
+
+            # fetching resumed from the checkpoint's cursor, and the cursor after each page was recorded
+            mock_iterfetches.assert_called_once_with(retry_on_rate_exceed=True, resume_cursor="cursor-0")
+            self.assertEqual(checkpoint.get_cursor("messages"), "cursor-string")
+            self.assertTrue(checkpoint.is_stage_done("messages"))
+            self.assertEqual(PullCheckpoint.load(self.unicef, "message-pull").done_stages, ["messages"])
+
+            # once a stage is done, pulling it again fetches nothing
+            mock_get_messages.return_value = MockClientQuery([create_message(103)])
+            self.assertEqual(self.backend.pull_messages(self.unicef, d1, d2), (0, 0, 0, 0))
+
+        checkpoint.clear()
+
+    @patch("dash.orgs.models.TembaClient.get_messages")
+    def test_pull_messages_in_bulk(self, mock_get_messages):
+        self._test_pull_messages_page(mock_get_messages)
+
+    @patch("dash.orgs.models.TembaClient.get_messages")
+    def test_pull_messages_in_bulk_commits_pages(self, mock_get_messages):
+        """
+        Each page should be committed along with its daily counts, so a failure only loses the failed page
+        """
+        d1 = now() - timedelta(hours=10)
+
+        def remote(backend_id):
+            contact = ObjectRef.create(uuid="C-001", name="Ann")
+            return TembaMessage.create(
+                id=backend_id, contact=contact, type="inbox", text="Hi", visibility="visible", labels=[], created_on=d1
+            )
+
+        mock_get_messages.return_value = MockClientQuery([remote(101)], [remote(102)])
+        bulk_create = MessageSyncer._bulk_create
+
+        def fail_second_page(syncer, org, to_create, *args):
+            created = bulk_create(syncer, org, to_create, *args)
+            if to_create[0]["backend_id"] == 102:
+                raise ValueError("Database unhappy")
+            return created
+
+        with patch.object(MessageSyncer, "_bulk_create", autospec=True, side_effect=fail_second_page):
+            with self.assertRaises(ValueError):
+                self.backend.pull_messages(self.unicef, d1, now())
+
+        self.assertEqual(list(Message.objects.filter(org=self.unicef).values_list("backend_id", flat=True)), [101])
+        self.assertEqual(
+            DailyCount.objects.filter(item_type=DailyCount.TYPE_INCOMING, scope="org:%d" % self.unicef.pk).count(), 1
+        )
+
+    @override_settings(PULL_MESSAGES_IN_BULK=False)
+    @patch("dash.orgs.models.TembaClient.get_messages")
+    def test_pull_messages_individually(self, mock_get_messages):
+        self._test_pull_messages_page(mock_get_messages)
+
+    def _test_pull_messages_page(self, mock_get_messages):
+        """
+        Both sync modes should have the same outcomes for a page with creates, updates, deletes and ignores
+        """
+        d1 = now() - timedelta(hours=10)
+        d2 = now() - timedelta(hours=9)
+
+        self.create_message(self.unicef, 201, self.ann, "Hello", [self.aids, self.tea], created_on=d1)
+        self.create_message(self.unicef, 202, self.bob, "Inactive", created_on=d1, is_active=False)
+        self.create_message(self.unicef, 203, self.bob, "Deleted", [self.pregnancy], created_on=d1)
+        self.create_message(self.unicef, 205, self.ann, "Unchanged", [self.aids], created_on=d1)
+
+        def remote(backend_id, contact, text, visibility="visible", labels=(), msg_type="inbox"):
+            return TembaMessage.create(
+                id=backend_id,
+                contact=contact,
+                type=msg_type,
+                text=text,
+                visibility=visibility,
+                labels=[ObjectRef.create(uuid=l[0], name=l[1]) for l in labels],
+                created_on=d2,
+            )
+
+        ann = ObjectRef.create(uuid="C-001", name="Ann")
+        bob = ObjectRef.create(uuid="C-002", name="Bob")
+        ivy = ObjectRef.create(uuid="C-009", name="Ivy")
+
+        mock_get_messages.return_value = MockClientQuery(
+            [
+                remote(
+                    101, ann, "What is aids?", labels=[("L-001", "AIDS"), ("L-007", "Important"), ("L-9", "Flagged")]
+                ),
+                remote(102, ivy, "Thanks", msg_type="flow"),
+                remote(201, ann, "Hello", visibility="archived", labels=[("L-002", "Pregnancy")]),
+                remote(202, bob, "Inactive"),
+                remote(203, bob, "Deleted", visibility="deleted"),
+            ],
+            [
+                remote(204, bob, "Never seen", visibility="deleted"),
+                remote(205, ann, "Unchanged", labels=[("L-001", "AIDS")]),
+            ],
+        )
+
+        self.assertEqual(self.backend.pull_messages(self.unicef, d1, d2), (2, 2, 1, 2))
+
+        important = Label.objects.get(org=self.unicef, uuid="L-007", name="Important", is_active=False)
+        ivy = Contact.objects.get(org=self.unicef, uuid="C-009", name="Ivy", is_stub=True)
+
+        msg101 = Message.objects.get(backend_id=101, type="I", is_flagged=True, is_archived=False, is_active=True)
+        msg102 = Message.objects.get(backend_id=102, type="F", is_flagged=False, is_archived=False, is_active=True)
+        msg201 = Message.objects.get(backend_id=201, is_archived=True, is_active=True)
+        msg202 = Message.objects.get(backend_id=202, is_active=True)
+        msg203 = Message.objects.get(backend_id=203, is_active=False)
+
+        self.assertEqual(msg101.contact, self.ann)
+        self.assertEqual(set(msg101.labels.all()), {self.aids, important})
+        self.assertEqual(msg102.contact, ivy)
+        self.assertEqual(set(msg102.labels.all()), set())
+        self.assertEqual(set(msg201.labels.all()), {self.pregnancy, self.tea})
+        self.assertEqual(set(msg202.labels.all()), set())
+        self.assertEqual(set(msg203.labels.all()), set())
+        self.assertFalse(Message.objects.filter(backend_id=204).exists())
+
+        self.assertEqual(DailyCount.get_by_org([self.unicef], DailyCount.TYPE_INCOMING).total(), 6)
+        self.assertEqual(
+            DailyCount.get_by_label([self.aids, self.pregnancy, important], DailyCount.TYPE_INCOMING).scope_totals(),
+            {self.aids: 2, self.pregnancy: 2, important: 1},
+        )
+
     @patch("dash.orgs.models.TembaClient.create_label")
     @patch("dash.orgs.models.TembaClient.get_labels")
     def test_push_label(self, mock_get_labels, mock_create_label):
@@ -774,28 +969,36 @@ class RapidProBackendTest(BaseCasesTest):
     @patch("casepro.backend.rapidpro.send_raw_email")
     @patch("dash.orgs.models.TembaClient.create_broadcast")
     def test_push_outgoing(self, mock_create_broadcast, mock_send_raw_email):
-        # test with replies sent separately
+        # test with replies sent separately, which are still coalesced into broadcasts by text
         mock_create_broadcast.side_effect = [
-            TembaBroadcast.create(id=201, text="That's great", urns=[], contacts=["C-001"]),
-            TembaBroadcast.create(id=202, text="That's great", urns=[], contacts=["C-002"]),
+            TembaBroadcast.create(id=201, text="That's great", urns=[], contacts=["C-001", "C-002"]),
+            TembaBroadcast.create(id=202, text="Hi", urns=["tel:+1234"], contacts=[]),
+            TembaBroadcast.create(id=203, text="That's great", urns=[], contacts=["C-001"]),
         ]
 
         out1 = self.create_outgoing(self.unicef, self.user1, None, "B", "That's great", self.ann)
-        out2 = self.create_outgoing(self.unicef, self.user1, None, "B", "That's great", self.bob)
-        self.backend.push_outgoing(self.unicef, [out1, out2])
+        out2 = self.create_outgoing(self.unicef, self.user1, None, "F", "Hi", None, urn="tel:+1234")
+        out3 = self.create_outgoing(self.unicef, self.user1, None, "B", "That's great", self.bob)
+        out4 = self.create_outgoing(self.unicef, self.user1, None, "B", "That's great", self.ann)
+        results = self.backend.push_outgoing(self.unicef, [out1, out2, out3, out4])
 
-        mock_create_broadcast.assert_has_calls(
+        self.assertEqual({status for msg, status in results}, {PushStatus.SENT})
+        self.assertEqual({msg for msg, status in results}, {out1, out2, out3, out4})
+
+        # but a contact sent the same text twice gets it from different broadcasts
+        self.assertEqual(
+            mock_create_broadcast.call_args_list,
             [
+                call(text="That's great", urns=[], contacts=["C-001", "C-002"]),
+                call(text="Hi", urns=["tel:+1234"], contacts=[]),
                 call(text="That's great", urns=[], contacts=["C-001"]),
-                call(text="That's great", urns=[], contacts=["C-002"]),
-            ]
+            ],
         )
         mock_create_broadcast.reset_mock()
 
-        out1.refresh_from_db()
-        out2.refresh_from_db()
-        self.assertEqual(out1.backend_broadcast_id, 201)
-        self.assertEqual(out2.backend_broadcast_id, 202)
+        for out, broadcast_id in ((out1, 201), (out2, 202), (out3, 201), (out4, 203)):
+            out.refresh_from_db()
+            self.assertEqual(out.backend_broadcast_id, broadcast_id)
 
         # test with replies sent as single broadcast
         mock_create_broadcast.side_effect = [
@@ -837,7 +1040,9 @@ class RapidProBackendTest(BaseCasesTest):
         mock_send_raw_email.assert_called_once_with(["jim@unicef.org"], "New message", "FYI", None)
 
         # if only sending email - no call to backend
-        self.backend.push_outgoing(self.unicef, [out7], as_broadcast=True)
+        results = self.backend.push_outgoing(self.unicef, [out7], as_broadcast=True)
+
+        self.assertEqual(results, [(out7, PushStatus.SENT)])
 
         self.assertNotCalled(mock_create_broadcast)
 
@@ -862,6 +1067,71 @@ class RapidProBackendTest(BaseCasesTest):
         )
         mock_create_broadcast.reset_mock()
 
+        # a text isn't coalesced with an earlier identical text if that would send it ahead of an earlier message
+        mock_create_broadcast.side_effect = [
+            TembaBroadcast.create(id=207, text="Yes"),
+            TembaBroadcast.create(id=208, text="No"),
+            TembaBroadcast.create(id=209, text="Yes"),
+        ]
+
+        out8 = self.create_outgoing(self.unicef, self.user1, None, "B", "Yes", self.ann)
+        out9 = self.create_outgoing(self.unicef, self.user1, None, "B", "No", self.bob)
+        out10 = self.create_outgoing(self.unicef, self.user1, None, "B", "Yes", self.bob)
+        self.backend.push_outgoing(self.unicef, [out8, out9, out10])
+
+        self.assertEqual(
+            mock_create_broadcast.call_args_list,
+            [
+                call(text="Yes", urns=[], contacts=["C-001"]),
+                call(text="No", urns=[], contacts=["C-002"]),
+                call(text="Yes", urns=[], contacts=["C-002"]),
+            ],
+        )
+
+    @patch("casepro.backend.rapidpro.send_raw_email")
+    @patch("dash.orgs.models.TembaClient.create_broadcast")
+    def test_push_outgoing_failures(self, mock_create_broadcast, mock_send_raw_email):
+        out1 = self.create_outgoing(self.unicef, self.user1, None, "F", "FYI", None, urn="mailto:jim@unicef.org")
+        out2 = self.create_outgoing(self.unicef, self.user1, None, "F", "FYI", None, urn="mailto:bad@unicef.org")
+        out3 = self.create_outgoing(self.unicef, self.user1, None, "B", "Hello", self.ann)
+        out4 = self.create_outgoing(self.unicef, self.user1, None, "B", "Hi", self.ann)
+        out5 = self.create_outgoing(self.unicef, self.user1, None, "B", "Bye", self.bob)
+        out6 = self.create_outgoing(self.unicef, self.user1, None, "B", "Bye again", self.bob)
+
+        # emails which can't be sent are retried unless the recipient is refused
+        mock_send_raw_email.side_effect = [
+            smtplib.SMTPServerDisconnected("Connection unexpectedly closed"),
+            smtplib.SMTPRecipientsRefused({"bad@unicef.org": (550, b"No such user")}),
+        ]
+
+        # broadcasts which are rejected fail, but others are retried along with all those after them
+        mock_create_broadcast.side_effect = [
+            TembaBadRequestError({"text": ["Too long"]}),
+            TembaBroadcast.create(id=201, text="Hi", urns=[], contacts=["C-001"]),
+            TembaConnectionError(),
+        ]
+
+        with self.assertLogs("casepro.backend.rapidpro", level="WARNING"):
+            results = self.backend.push_outgoing(self.unicef, [out1, out2, out3, out4, out5, out6])
+
+        self.assertEqual(
+            results,
+            [
+                (out1, PushStatus.RETRYABLE),
+                (out2, PushStatus.FAILED),
+                (out3, PushStatus.FAILED),
+                (out4, PushStatus.SENT),
+                (out5, PushStatus.RETRYABLE),
+                (out6, PushStatus.RETRYABLE),
+            ],
+        )
+        self.assertEqual(mock_create_broadcast.call_count, 3)
+
+        out4.refresh_from_db()
+        out5.refresh_from_db()
+        self.assertEqual(out4.backend_broadcast_id, 201)
+        self.assertIsNone(out5.backend_broadcast_id)
+
     def test_push_contact(self):
         """
         Pushing a new contact should be a noop.
@@ -1068,7 +1338,9 @@ class RapidProBackendTest(BaseCasesTest):
     def test_start_flow(self, mock_create_flow_start):
         self.backend.start_flow(self.unicef, Flow("0002-0002", "Follow Up"), self.ann, extra={"foo": "bar"})
 
-        mock_create_flow_start.assert_called_once_with(flow="0002-0002", contacts=[str(self.ann.uuid)], restart_participants=True, extra={"foo": "bar"})
+        mock_create_flow_start.assert_called_once_with(
+            flow="0002-0002", contacts=[str(self.ann.uuid)], restart_participants=True, extra={"foo": "bar"}
+        )
 
     def test_get_url_patterns(self):
         """
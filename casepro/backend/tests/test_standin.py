@@ -0,0 +1,94 @@
+from datetime import timedelta
+
+from temba_client.v2 import TembaClient
+
+from casepro.contacts.models import Contact
+from casepro.msgs.models import Message
+from casepro.test import BaseCasesTest
+
+from ..junebug import IdentityStore
+from ..rapidpro import RapidProBackend
+from ..standin import StandInData, StandInServer
+
+
+class StandInServerTest(BaseCasesTest):
+    def setUp(self):
+        super(StandInServerTest, self).setUp()
+
+        self.data = StandInData(20, 30, num_groups=3, num_labels=2, deleted=0.2, seed=1)
+        self.server = StandInServer(self.data, page_size=7).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+        super(StandInServerTest, self).tearDown()
+
+    def test_rapidpro_endpoints(self):
+        client = TembaClient(self.server.url, "1234567890")
+
+        self.assertEqual(len(client.get_fields().all()), 4)
+        self.assertEqual([g.name for g in client.get_groups().all()], ["Group 0", "Group 1", "Group 2"])
+        self.assertEqual(client.get_labels(name="Label 1").first().uuid, self.data.labels[1].uuid)
+
+        # fetches are paginated with cursors, newest first
+        query = client.get_contacts().iterfetches()
+        fetches = list(query)
+        self.assertEqual(len(self.data.contacts), 16)
+        self.assertEqual([len(f) for f in fetches], [7, 7, 2])
+        self.assertIsNone(query.get_cursor())
+
+        contacts = [c for f in fetches for c in f]
+        self.assertEqual({c.uuid for c in contacts}, {c.uuid for c in self.data.contacts})
+        self.assertEqual(contacts, sorted(contacts, key=lambda c: c.modified_on, reverse=True))
+
+        # and can be resumed from a cursor
+        query = client.get_contacts().iterfetches()
+        next(query)
+        resumed = client.get_contacts().iterfetches(resume_cursor=query.get_cursor())
+        self.assertEqual([c.uuid for f in resumed for c in f], [c.uuid for c in contacts[7:]])
+
+        self.assertEqual(
+            {c.uuid for c in client.get_contacts(deleted=True).all()}, {c.uuid for c in self.data.deleted_contacts}
+        )
+
+        # time windows are inclusive of both ends
+        middle = sorted(self.data.messages, key=lambda m: m.modified_on)[10:20]
+        messages = client.get_messages(after=middle[0].modified_on, before=middle[-1].modified_on).all()
+        self.assertEqual({m.id for m in messages}, {m.id for m in middle})
+
+        # requests which change things are accepted
+        self.assertEqual(client.create_label(name="Spam").name, "Spam")
+        client.bulk_archive_messages(messages=[1, 2])
+
+        self.assertEqual(self.server.num_requests, 14)
+
+    def test_identity_store_endpoints(self):
+        identity_store = IdentityStore(self.server.url, "1234567890", "msisdn")
+        identity = self.data.identities[0]
+        phone = list(identity["details"]["addresses"]["msisdn"].keys())[0]
+
+        self.assertEqual(len(list(identity_store.get_identities())), len(self.data.identities))
+        self.assertEqual(
+            len(list(identity_store.get_identities(created_from=self.data.start, created_to=self.data.end))),
+            len(self.data.identities),
+        )
+        self.assertEqual(identity_store.get_identity(identity["id"]), identity)
+        self.assertIsNone(identity_store.get_identity("xyz"))
+        self.assertEqual(list(identity_store.get_addresses(identity["id"])), [phone])
+        self.assertEqual([i["id"] for i in identity_store.get_identities_for_address(phone)], [identity["id"]])
+
+        created = identity_store.create_identity(["tel:+1234"], name="Ann")
+        self.assertEqual(identity_store.get_identity(created["id"])["details"]["name"], "Ann")
+
+    def test_pull_from_rapidpro(self):
+        self.unicef.backends.update(host=self.server.url)
+        backend = RapidProBackend(backend=None)
+
+        backend.pull_contacts(self.unicef, None, None)
+        backend.pull_messages(self.unicef, self.data.start - timedelta(seconds=1), self.data.end)
+
+        self.assertEqual(
+            set(Contact.objects.filter(org=self.unicef, is_active=True).values_list("uuid", flat=True)),
+            {c.uuid for c in self.data.contacts},
+        )
+        self.assertEqual(Message.objects.filter(org=self.unicef).count(), 30)
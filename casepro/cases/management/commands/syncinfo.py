@@ -5,6 +5,8 @@ from dash.orgs.models import Org
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.timezone import now
 
+from casepro.utils import row_to_str, row_width
+
 
 class Command(BaseCommand):
     help = "Dumps information about the synced state of each org's contacts and messages"
@@ -101,13 +103,5 @@ class Command(BaseCommand):
             self.stdout.write(row_to_str(row))
 
 
-def row_to_str(row):
-    return "".join([str(cell[0]).ljust(cell[1]) for cell in row])
-
-
-def row_width(row):
-    return sum([cell[1] for cell in row])
-
-
 def format_date(dt):
     return dt.astimezone(pytz.UTC).strftime("%b %d, %Y %H:%M") if dt else ""
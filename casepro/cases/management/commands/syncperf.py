@@ -0,0 +1,132 @@
+import resource
+import time
+from datetime import timedelta
+
+from dash.orgs.models import Org
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from casepro.backend.junebug import JunebugBackend
+from casepro.backend.standin import DEFAULT_PAGE_SIZE, StandInData, StandInServer
+from casepro.contacts.tasks import pull_contacts
+from casepro.msgs.models import Label
+from casepro.msgs.tasks import handle_messages, pull_messages
+from casepro.rules.models import ContainsTest, Quantifier
+from casepro.utils import row_to_str, row_width
+
+
+class QueryCounter(object):
+    """
+    Database execute wrapper which just counts queries, so that counting doesn't need DEBUG or keep every query
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks pulling contacts and messages from a local stand-in RapidPro and Identity Store, and handling them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contacts", type=int, default=10000, help="The number of contacts to generate")
+        parser.add_argument("--messages", type=int, default=10000, help="The number of messages to generate")
+        parser.add_argument("--days", type=int, default=7, help="The number of days of modifications to generate")
+        parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="The page size of fetches")
+        parser.add_argument(
+            "--latency", type=float, default=0.0, help="The simulated network latency in seconds of each request"
+        )
+        parser.add_argument("--seed", type=int, default=1234, help="The seed for generating remote objects")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Generating %d contacts and %d messages..." % (options["contacts"], options["messages"]))
+
+        data = StandInData(options["contacts"], options["messages"], days=options["days"], seed=options["seed"])
+
+        header = (
+            ("Stage", 12),
+            ("Rows", 10),
+            ("Time (secs)", 14),
+            ("Rows/sec", 12),
+            ("Queries/row", 14),
+            ("Requests", 10),
+            ("Peak RSS (MB)", 14),
+        )
+        self.stdout.write(row_to_str(header))
+        self.stdout.write("=" * row_width(header))
+
+        with StandInServer(data, latency=options["latency"], page_size=options["page_size"]) as server:
+            for stage, num_rows, duration, num_queries, num_requests in self.run_stages(data, server):
+                row = (
+                    (stage, 12),
+                    (num_rows, 10),
+                    ("%.2f" % duration, 14),
+                    ("%.1f" % (num_rows / duration), 12),
+                    ("%.2f" % (num_queries / num_rows if num_rows else 0), 14),
+                    (num_requests, 10),
+                    ("%.1f" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024), 14),
+                )
+                self.stdout.write(row_to_str(row))
+
+    @staticmethod
+    def run_stages(data, server):
+        """
+        Runs each stage against the given stand-in server in a throwaway org, in a transaction which is rolled back
+        afterwards
+        :return: list of tuples of stage name, number of rows, time taken, number of queries and number of requests
+        """
+        results = []
+
+        with transaction.atomic(), override_settings(
+            SITE_BACKEND="casepro.backend.rapidpro.RapidProBackend",
+            SITE_API_HOST=server.url,
+            IDENTITY_API_ROOT=server.url,
+        ):
+            user = User.objects.create(username="syncperf")
+            org = Org.objects.create(name="Benchmark", created_by=user, modified_by=user)
+
+            # create the remote labels locally with rules that match their keywords so that handling applies them
+            for remote in data.labels:
+                label = Label.objects.create(org=org, uuid=remote.uuid, name=remote.name, is_synced=True)
+                label.update_tests([ContainsTest(data.label_keywords[remote.uuid], Quantifier.ANY)])
+
+            # have messages pulled for the whole generated period rather than just the last hour
+            task_state = org.get_task_state("message-pull")
+            task_state.last_successfully_started_on = data.start - timedelta(seconds=1)
+            task_state.save(update_fields=("last_successfully_started_on",))
+
+            junebug_org = Org.objects.create(name="Benchmark Junebug", created_by=user, modified_by=user)
+
+            stages = (
+                ("contacts", len(data.contacts) + len(data.deleted_contacts), lambda: pull_contacts(org.pk)),
+                ("messages", len(data.messages), lambda: pull_messages(org.pk)),
+                ("handling", len(data.messages), lambda: handle_messages(org.pk)),
+                (
+                    "identities",
+                    len(data.identities),
+                    lambda: JunebugBackend().pull_contacts(junebug_org, data.start - timedelta(seconds=1), None),
+                ),
+            )
+
+            for stage, num_rows, func in stages:
+                counter = QueryCounter()
+                num_requests = server.num_requests
+                start = time.time()
+
+                with connection.execute_wrapper(counter):
+                    func()
+
+                results.append(
+                    (stage, num_rows, time.time() - start, counter.count, server.num_requests - num_requests)
+                )
+
+            transaction.set_rollback(True)
+
+        return results
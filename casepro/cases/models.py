@@ -1,3 +1,4 @@
+from collections import defaultdict
 from enum import Enum, IntEnum
 from itertools import chain
 
@@ -210,6 +211,35 @@ class Case(models.Model):
         qs = cls.get_for_contact(org, contact)
         return qs.filter(opened_on__lt=dt).filter(Q(closed_on=None) | Q(closed_on__gt=dt)).first()
 
+    @classmethod
+    def get_open_for_messages(cls, org, messages):
+        """
+        Equivalent to calling get_open_for_contact_on for each message's contact and creation time, but fetches all
+        cases which might have been open in a single query
+        :return: dict of messages to the case open for their contact when they were received
+        """
+        if not messages:
+            return {}
+
+        earliest = min(m.created_on for m in messages)
+        latest = max(m.created_on for m in messages)
+
+        candidates = cls.objects.filter(org=org, contact__in={m.contact_id for m in messages}, opened_on__lt=latest)
+        candidates = candidates.filter(Q(closed_on=None) | Q(closed_on__gt=earliest)).order_by("pk")
+
+        cases_by_contact = defaultdict(list)
+        for case in candidates:
+            cases_by_contact[case.contact_id].append(case)
+
+        open_by_message = {}
+        for msg in messages:
+            for case in cases_by_contact[msg.contact_id]:
+                if case.opened_on < msg.created_on and (case.closed_on is None or case.closed_on > msg.created_on):
+                    open_by_message[msg] = case
+                    break
+
+        return open_by_message
+
     @classmethod
     def search(cls, org, user, search):
         """
@@ -335,6 +365,48 @@ class Case(models.Model):
 
         self.notify_watchers(reply=message)
 
+    @classmethod
+    def bulk_add_replies(cls, org, replies_by_case):
+        """
+        Equivalent to calling add_reply for each case and message, but with a single update of all the messages and a
+        single insert of notifications for all watchers
+        """
+        from casepro.profiles.models import Notification
+
+        if not replies_by_case:
+            return
+
+        for case, replies in replies_by_case.items():
+            for msg in replies:
+                msg.case = case
+                msg.is_archived = True
+
+        Message.objects.filter(pk__in=[m.pk for replies in replies_by_case.values() for m in replies]).update(
+            case=models.Case(
+                *[
+                    models.When(pk__in=[m.pk for m in replies], then=case.pk)
+                    for case, replies in replies_by_case.items()
+                ],
+                output_field=models.IntegerField()
+            ),
+            is_archived=True,
+        )
+
+        watchers = cls.watchers.through.objects.filter(case__in=replies_by_case.keys())
+        watcher_ids_by_case_id = defaultdict(list)
+        for case_id, user_id in watchers.values_list("case_id", "user_id"):
+            watcher_ids_by_case_id[case_id].append(user_id)
+
+        Notification.bulk_new_case_replies(
+            org,
+            [
+                (user_id, msg.pk)
+                for case, replies in replies_by_case.items()
+                for msg in replies
+                for user_id in watcher_ids_by_case_id[case.pk]
+            ],
+        )
+
     @case_action()
     def update_summary(self, user, summary):
         self.summary = summary
@@ -357,6 +357,86 @@ class CaseTest(BaseCasesTest):
         open_case = Case.get_open_for_contact_on(self.unicef, self.ann, datetime(2014, 1, 16, 0, 0, tzinfo=pytz.UTC))
         self.assertEqual(open_case, case2)
 
+    def test_get_open_for_messages(self):
+        d0 = datetime(2014, 1, 5, 0, 0, tzinfo=pytz.UTC)
+        d1 = datetime(2014, 1, 10, 0, 0, tzinfo=pytz.UTC)
+        d2 = datetime(2014, 1, 15, 0, 0, tzinfo=pytz.UTC)
+
+        # case Jan 5th -> Jan 10th
+        msg1 = self.create_message(self.unicef, 123, self.ann, "Hello", created_on=d0)
+        case1 = self.create_case(self.unicef, self.ann, self.moh, msg1, opened_on=d0, closed_on=d1)
+
+        # case Jan 15th -> now
+        msg2 = self.create_message(self.unicef, 234, self.ann, "Hello again", created_on=d2)
+        case2 = self.create_case(self.unicef, self.ann, self.moh, msg2, opened_on=d2)
+
+        # another contact's case Jan 5th -> now
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        msg3 = self.create_message(self.unicef, 345, bob, "Yo", created_on=d0)
+        case3 = self.create_case(self.unicef, bob, self.who, msg3, opened_on=d0)
+
+        msg4 = self.create_message(self.unicef, 401, self.ann, "?", created_on=datetime(2014, 1, 4, tzinfo=pytz.UTC))
+        msg5 = self.create_message(self.unicef, 402, self.ann, "?", created_on=datetime(2014, 1, 7, tzinfo=pytz.UTC))
+        msg6 = self.create_message(self.unicef, 403, self.ann, "?", created_on=datetime(2014, 1, 13, tzinfo=pytz.UTC))
+        msg7 = self.create_message(self.unicef, 404, self.ann, "?", created_on=datetime(2014, 1, 16, tzinfo=pytz.UTC))
+        msg8 = self.create_message(self.unicef, 405, bob, "?", created_on=datetime(2014, 1, 4, tzinfo=pytz.UTC))
+        msg9 = self.create_message(self.unicef, 406, bob, "?", created_on=datetime(2014, 1, 16, tzinfo=pytz.UTC))
+        messages = [msg4, msg5, msg6, msg7, msg8, msg9]
+
+        with self.assertNumQueries(1):
+            open_cases = Case.get_open_for_messages(self.unicef, messages)
+
+        self.assertEqual(open_cases, {msg5: case1, msg7: case2, msg9: case3})
+
+        # should be the same as looking up each message individually
+        for msg in messages:
+            self.assertEqual(
+                open_cases.get(msg), Case.get_open_for_contact_on(self.unicef, msg.contact, msg.created_on)
+            )
+
+        self.assertEqual(Case.get_open_for_messages(self.unicef, []), {})
+
+    def test_bulk_add_replies(self):
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        msg1 = self.create_message(self.unicef, 101, self.ann, "Hello")
+        case1 = self.create_case(self.unicef, self.ann, self.moh, msg1)
+        case1.watchers.add(self.user1, self.user2)
+        msg2 = self.create_message(self.unicef, 102, bob, "Hello")
+        case2 = self.create_case(self.unicef, bob, self.who, msg2)
+        case2.watchers.add(self.user3)
+
+        reply1 = self.create_message(self.unicef, 103, self.ann, "Hi")
+        reply2 = self.create_message(self.unicef, 104, self.ann, "Hi again")
+        reply3 = self.create_message(self.unicef, 105, bob, "Hey")
+
+        # user2 already has a notification for the first reply
+        Notification.new_case_reply(self.unicef, self.user2, reply1)
+
+        with self.assertNumQueries(4):
+            Case.bulk_add_replies(self.unicef, {case1: [reply1, reply2], case2: [reply3]})
+
+        self.assertEqual(reply1.case, case1)
+        self.assertTrue(reply1.is_archived)
+
+        for reply, case in ((reply1, case1), (reply2, case1), (reply3, case2)):
+            reply.refresh_from_db()
+            self.assertEqual(reply.case, case)
+            self.assertTrue(reply.is_archived)
+
+        self.assertEqual(
+            set(Notification.objects.filter(type=Notification.TYPE_CASE_REPLY).values_list("user", "message")),
+            {
+                (self.user1.pk, reply1.pk),
+                (self.user2.pk, reply1.pk),
+                (self.user1.pk, reply2.pk),
+                (self.user2.pk, reply2.pk),
+                (self.user3.pk, reply3.pk),
+            },
+        )
+
+        with self.assertNumQueries(0):
+            Case.bulk_add_replies(self.unicef, {})
+
     def test_get_open_with_user_assignee(self):
         """
         If a case is opened with the user_assignee field set, the created case should have the assigned user, and
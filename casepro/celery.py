@@ -12,3 +12,17 @@ app = Celery("casepro")
 # pickle the object when using Windows.
 app.config_from_object("django.conf:settings")
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+# scheduled tasks which only have work to do if the given setting is enabled
+OPTIONAL_SCHEDULED_TASKS = {"junebug-ingest": "JUNEBUG_INBOUND_QUEUED", "outbox-push": "OUTBOX_ENABLED"}
+
+
+@app.on_after_configure.connect
+def unschedule_disabled_tasks(sender, **kwargs):
+    """
+    Removes scheduled tasks whose setting isn't enabled. This is checked against the final settings rather than in
+    settings_common as deployments enable these settings after importing it.
+    """
+    for name, setting in OPTIONAL_SCHEDULED_TASKS.items():
+        if not getattr(settings, setting, False):
+            sender.conf.beat_schedule.pop(name, None)
@@ -1,3 +1,6 @@
+from collections import defaultdict
+from contextlib import ExitStack
+
 import phonenumbers
 import regex
 from dash.orgs.models import Org
@@ -8,6 +11,7 @@ from django.utils.translation import ugettext_lazy as _
 from django_redis import get_redis_connection
 
 from casepro.utils import get_language_name
+from casepro.utils.sync import get_sync_session
 
 FIELD_LOCK_KEY = "lock:field:%d:%s"
 GROUP_LOCK_KEY = "lock:group:%d:%s"
@@ -310,6 +314,93 @@ class Contact(models.Model):
 
             return contact
 
+    @classmethod
+    def bulk_get_or_create(cls, org, uuid_names):
+        """
+        Equivalent to calling get_or_create for each of the given (uuid, name) pairs, but with one query to fetch
+        existing contacts and one to create any missing stubs
+        :return: dict of contacts by UUID
+        """
+        names_by_uuid = dict(uuid_names)
+        if not names_by_uuid:
+            return {}
+
+        contacts_by_uuid = {c.uuid: c for c in cls.objects.filter(org=org, uuid__in=names_by_uuid.keys())}
+        missing_uuids = sorted(set(names_by_uuid.keys()) - set(contacts_by_uuid.keys()))
+
+        if missing_uuids:
+            # lock in a consistent order so that concurrent calls can't deadlock
+            with ExitStack() as stack:
+                for uuid in missing_uuids:
+                    stack.enter_context(cls.lock(org, uuid))
+
+                # another process may have created some of these before we got the locks
+                for contact in cls.objects.filter(org=org, uuid__in=missing_uuids):
+                    contacts_by_uuid[contact.uuid] = contact
+
+                stubs = [
+                    cls(org=org, uuid=uuid, name=names_by_uuid[uuid], is_stub=True)
+                    for uuid in missing_uuids
+                    if uuid not in contacts_by_uuid
+                ]
+                for contact in cls.objects.bulk_create(stubs):
+                    contacts_by_uuid[contact.uuid] = contact
+
+        return contacts_by_uuid
+
+    @classmethod
+    def bulk_set_groups(cls, org, groups_by_contact):
+        """
+        Equivalent to saving each of the given contacts with its list of (uuid, name) group pairs as SAVE_GROUPS_ATTR,
+        but with one query to fetch current memberships, one to create any missing group stubs, one to delete old
+        memberships and one to insert new memberships
+        :return: set of ids of contacts whose memberships changed
+        """
+        session = get_sync_session(org)
+        org_groups = {g.uuid: g for g in (session.get_groups() if session else org.groups.all())}
+
+        # create stubs for any groups that don't exist yet
+        stubs = {}
+        for groups in groups_by_contact.values():
+            for uuid, name in groups:
+                if uuid not in org_groups and uuid not in stubs:
+                    stubs[uuid] = Group(org=org, uuid=uuid, name=name, is_active=False)
+
+        for stub in Group.objects.bulk_create(stubs.values()):
+            org_groups[stub.uuid] = stub
+            if session:
+                session.add_group(stub)
+
+        Membership = cls.groups.through
+        current = defaultdict(dict)
+        memberships = Membership.objects.filter(contact__in=groups_by_contact.keys())
+        for membership_id, contact_id, group_id in memberships.values_list("id", "contact_id", "group_id"):
+            current[contact_id][group_id] = membership_id
+
+        to_delete = []
+        to_create = []
+        changed = set()
+
+        for contact, groups in groups_by_contact.items():
+            cur_membership_ids = current[contact.pk]
+            new_group_ids = {org_groups[uuid].pk for uuid, name in groups}
+
+            for group_id, membership_id in cur_membership_ids.items():
+                if group_id not in new_group_ids:
+                    to_delete.append(membership_id)
+                    changed.add(contact.pk)
+
+            for group_id in new_group_ids - set(cur_membership_ids.keys()):
+                to_create.append(Membership(contact_id=contact.pk, group_id=group_id))
+                changed.add(contact.pk)
+
+        if to_delete:
+            Membership.objects.filter(id__in=to_delete).delete()
+        if to_create:
+            Membership.objects.bulk_create(to_create)
+
+        return changed
+
     @classmethod
     def get_or_create_from_urn(cls, org, urn, name=None):
         """
@@ -1,6 +1,8 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from casepro.utils.sync import get_sync_session
+
 from .models import Contact
 
 
@@ -27,7 +29,8 @@ def update_contact_groups(sender, instance, created, **kwargs):
     add_to_by_uuid = {uuid: name for uuid, name in new_groups_by_uuid.items() if uuid not in cur_groups_by_uuid.keys()}
 
     if add_to_by_uuid:
-        org_groups = {g.uuid: g for g in org.groups.all()}
+        session = get_sync_session(org)
+        org_groups = {g.uuid: g for g in (session.get_groups() if session else org.groups.all())}
 
         # create any groups that don't exist
         add_to_groups = []
@@ -36,6 +39,8 @@ def update_contact_groups(sender, instance, created, **kwargs):
             if not existing:
                 # create stub
                 existing = org.groups.create(uuid=uuid, name=name, is_active=False)
+                if session:
+                    session.add_group(existing)
 
             add_to_groups.append(existing)
 
@@ -1,5 +1,8 @@
 from celery.utils.log import get_task_logger
 from dash.orgs.tasks import org_task
+from django.conf import settings
+
+from casepro.utils.sync import pull_in_slices, sync_session
 
 logger = get_task_logger(__name__)
 
@@ -7,24 +10,47 @@ logger = get_task_logger(__name__)
 @org_task("contact-pull", lock_timeout=12 * 60 * 60)
 def pull_contacts(org, since, until):
     """
-    Fetches updated contacts from RapidPro and updates local contacts accordingly
+    Fetches updated contacts from RapidPro and updates local contacts accordingly. Long windows, e.g. the first time
+    sync of all contacts, are pulled in time slices, and progress is checkpointed so that a run which fails or runs
+    out of time is resumed by the next run.
     """
     backend = org.get_backend()
 
     if not since:
         logger.warn("First time run for org #%d. Will sync all contacts" % org.pk)
 
-    fields_created, fields_updated, fields_deleted, ignored = backend.pull_fields(org)
-
-    groups_created, groups_updated, groups_deleted, ignored = backend.pull_groups(org)
-
     def progress(num):  # pragma: no cover
         logger.debug(f" > Synced {num} contacts for org #{org.id}")
 
-    contacts_created, contacts_updated, contacts_deleted, ignored = backend.pull_contacts(org, since, until, progress)
+    with sync_session(org) as session:
+        fields_created, fields_updated, fields_deleted, ignored = backend.pull_fields(org)
+
+        groups_created, groups_updated, groups_deleted, ignored = backend.pull_groups(org)
 
-    return {
+        counts, num_slices, completed, resumed = pull_in_slices(
+            org,
+            "contact-pull",
+            since,
+            until,
+            lambda slice_since, slice_until: backend.pull_contacts(org, slice_since, slice_until, progress),
+            slice_days=getattr(settings, "PULL_SLICE_DAYS", 7),
+            time_limit=getattr(settings, "PULL_TIME_LIMIT", 60 * 60),
+        )
+        contacts_created, contacts_updated, contacts_deleted, ignored = counts
+
+    result = {
         "fields": {"created": fields_created, "updated": fields_updated, "deleted": fields_deleted},
         "groups": {"created": groups_created, "updated": groups_updated, "deleted": groups_deleted},
         "contacts": {"created": contacts_created, "updated": contacts_updated, "deleted": contacts_deleted},
     }
+
+    # include how the window was pulled if it wasn't just pulled in one go
+    if num_slices > 1 or not completed or resumed:
+        result["slices"] = {"pulled": num_slices, "completed": completed, "resumed": resumed}
+
+    # include how long we waited on the network vs the database if the backend used fetch pipelines
+    pipeline_stats = session.get_pipeline_stats()
+    if pipeline_stats:
+        result["pipelines"] = pipeline_stats
+
+    return result
@@ -202,6 +202,34 @@ class ContactTest(BaseCasesTest):
                 },
             )
 
+    def test_bulk_set_groups(self):
+        bob = self.create_contact(self.unicef, "C-002", "Bob", [self.males, self.reporters])
+        cat = self.create_contact(self.unicef, "C-003", "Cat", [self.females])
+
+        with self.assertNumQueries(5):
+            changed = Contact.bulk_set_groups(
+                self.unicef,
+                {
+                    self.ann: [("G-003", "Reporters")],  # no change
+                    bob: [("G-001", "Males"), ("G-009", "Testers")],  # removed from one group, added to a new one
+                    cat: [("G-009", "Testers")],  # moved to the new group
+                },
+            )
+
+        self.assertEqual(changed, {bob.pk, cat.pk})
+
+        testers = Group.objects.get(org=self.unicef, uuid="G-009", name="Testers", is_active=False)
+
+        self.assertEqual(set(self.ann.groups.all()), {self.reporters})
+        self.assertEqual(set(bob.groups.all()), {self.males, testers})
+        self.assertEqual(set(cat.groups.all()), {testers})
+
+        # no changes means no updates
+        with self.assertNumQueries(2):
+            changed = Contact.bulk_set_groups(self.unicef, {bob: [("G-001", "Males"), ("G-009", "Testers")]})
+
+        self.assertEqual(changed, set())
+
     @patch("casepro.test.TestBackend.push_contact")
     def test_get_or_create_from_urn(self, mock_push_contact):
         """
@@ -413,7 +441,27 @@ class TasksTest(BaseCasesTest):
 
         pull_contacts(self.unicef.pk)
 
+        # first time sync is pulled as contacts modified before the org was created, and then those modified since
+        task_state = TaskState.objects.get(org=self.unicef, task_key="contact-pull")
+        self.assertEqual(mock_pull_contacts.call_count, 2)
+        self.assertEqual(mock_pull_contacts.call_args_list[0][0][1:3], (None, self.unicef.created_on))
+        self.assertEqual(mock_pull_contacts.call_args_list[1][0][1:3], (self.unicef.created_on, task_state.started_on))
+        self.assertEqual(
+            task_state.get_last_results(),
+            {
+                "fields": {"created": 1, "updated": 2, "deleted": 3},
+                "groups": {"created": 5, "updated": 6, "deleted": 7},
+                "contacts": {"created": 18, "updated": 20, "deleted": 22},
+                "slices": {"pulled": 2, "completed": True, "resumed": False},
+            },
+        )
+
+        mock_pull_contacts.reset_mock()
+
+        pull_contacts(self.unicef.pk)
+
         task_state = TaskState.objects.get(org=self.unicef, task_key="contact-pull")
+        self.assertEqual(mock_pull_contacts.call_count, 1)
         self.assertEqual(
             task_state.get_last_results(),
             {
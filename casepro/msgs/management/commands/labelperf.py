@@ -0,0 +1,148 @@
+import time
+
+from dash.orgs.models import Org
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils.timezone import now
+
+from casepro.contacts.models import Contact
+from casepro.msgs.models import Label, Message
+from casepro.statistics.models import TotalCount
+from casepro.utils import row_to_str, row_width
+
+DEFAULT_MESSAGE_COUNTS = (1000, 10000)
+DEFAULT_NUM_LABELS = 3
+TRIGGERS = ("statement", "row")
+STATEMENT_TRIGGERS_MIN_PG_VERSION = 100000  # older servers only have the row level triggers
+
+# swaps the statement level label count triggers for the row level ones they replaced
+ROW_TRIGGERS_SQL = """
+    DROP TRIGGER msgs_message_labels_on_insert_trg ON msgs_message_labels;
+    DROP TRIGGER msgs_message_labels_on_delete_trg ON msgs_message_labels;
+    DROP TRIGGER msgs_message_on_update_trg ON msgs_message;
+
+    CREATE TRIGGER msgs_message_labels_on_change_trg
+        AFTER INSERT OR DELETE ON msgs_message_labels
+        FOR EACH ROW EXECUTE PROCEDURE msgs_message_labels_on_change();
+
+    CREATE TRIGGER msgs_message_on_change_trg
+        AFTER UPDATE ON msgs_message
+        FOR EACH ROW EXECUTE PROCEDURE msgs_message_on_change();"""
+
+
+class Command(BaseCommand):
+    help = "Benchmarks labelling, archiving and restoring messages in bulk with statement and row level count triggers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--messages", type=int, nargs="*", default=DEFAULT_MESSAGE_COUNTS, help="The numbers of messages"
+        )
+        parser.add_argument("--labels", type=int, default=DEFAULT_NUM_LABELS, help="The number of labels per message")
+        parser.add_argument(
+            "--triggers", nargs="*", choices=TRIGGERS, default=TRIGGERS, help="The triggers to compare"
+        )
+
+    def handle(self, *args, **options):
+        triggers_to_compare = options["triggers"]
+        if connection.pg_version < STATEMENT_TRIGGERS_MIN_PG_VERSION and "statement" in triggers_to_compare:
+            self.stderr.write("Statement level triggers need PostgreSQL 10 or later so only row level are benchmarked")
+            triggers_to_compare = [t for t in triggers_to_compare if t != "statement"]
+
+        header = (
+            ("Messages", 10),
+            ("Triggers", 12),
+            ("Operation", 12),
+            ("Count rows", 12),
+            ("Time (secs)", 14),
+            ("Msgs/sec", 10),
+        )
+        self.stdout.write(row_to_str(header))
+        self.stdout.write("=" * row_width(header))
+
+        for num_messages in options["messages"]:
+            totals_by_triggers = {}
+
+            for triggers in triggers_to_compare:
+                results, totals = self.time_operations(num_messages, options["labels"], triggers)
+
+                for operation, num_rows, duration in results:
+                    row = (
+                        (num_messages, 10),
+                        (triggers, 12),
+                        (operation, 12),
+                        (num_rows, 12),
+                        ("%.2f" % duration, 14),
+                        ("%.1f" % (num_messages / duration), 10),
+                    )
+                    self.stdout.write(row_to_str(row))
+
+                totals_by_triggers[triggers] = totals
+
+            if len({tuple(t) for t in totals_by_triggers.values()}) > 1:  # pragma: no cover
+                self.stderr.write("Label totals differ between triggers: %s" % totals_by_triggers)
+
+    @staticmethod
+    def time_operations(num_messages, num_labels, triggers):
+        """
+        Labels, archives, restores and unlabels messages in a throwaway org, in a transaction which is rolled back
+        afterwards, along with any change of triggers
+        :return: tuple of list of tuples of operation, number of count rows written and time taken, and the label
+            totals after each operation
+        """
+        results, totals = [], []
+
+        with transaction.atomic():
+            if triggers == "row" and connection.pg_version >= STATEMENT_TRIGGERS_MIN_PG_VERSION:
+                with connection.cursor() as cursor:
+                    cursor.execute(ROW_TRIGGERS_SQL)
+
+            user = User.objects.create(username="labelperf")
+            org = Org.objects.create(name="Benchmark", created_by=user, modified_by=user)
+            contact = Contact.objects.create(org=org, uuid="C-001", name="Ann")
+            labels = [Label.objects.create(org=org, name="Label %d" % l) for l in range(num_labels)]
+
+            Message.objects.bulk_create(
+                [
+                    Message(
+                        org=org,
+                        backend_id=m + 1,
+                        contact=contact,
+                        type=Message.TYPE_INBOX,
+                        text="Message number %d" % m,
+                        is_handled=True,
+                        created_on=now(),
+                    )
+                    for m in range(num_messages)
+                ]
+            )
+            messages = list(org.incoming_messages.all())
+            message_ids = [m.pk for m in messages]
+
+            def archive(is_archived):
+                org.incoming_messages.filter(pk__in=message_ids).update(is_archived=is_archived, modified_on=now())
+
+            operations = (
+                ("label", lambda: [Message.label_all(org, messages, l) for l in labels]),
+                ("archive", lambda: archive(True)),
+                ("restore", lambda: archive(False)),
+                ("unlabel", lambda: [Message.unlabel_all(org, messages, l) for l in labels]),
+            )
+
+            for operation, func in operations:
+                last_id = TotalCount.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+
+                start = time.time()
+                func()
+                duration = time.time() - start
+
+                new_counts = TotalCount.objects.filter(pk__gt=last_id)
+                results.append((operation, new_counts.count(), duration))
+
+                inbox = TotalCount.get_by_label(labels, TotalCount.TYPE_INBOX).scope_totals()
+                archived = TotalCount.get_by_label(labels, TotalCount.TYPE_ARCHIVED).scope_totals()
+                totals.append((operation, tuple((inbox[l], archived[l]) for l in labels)))
+
+            transaction.set_rollback(True)
+
+        return results, totals
@@ -0,0 +1,193 @@
+import random
+import time
+from datetime import timedelta
+
+from dash.orgs.models import Org
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from temba_client.v2.types import Message as TembaMessage
+from temba_client.v2.types import ObjectRef
+
+from casepro.backend.rapidpro import RapidProBackend
+from casepro.utils import row_to_str, row_width
+
+DEFAULT_MESSAGE_COUNTS = (10000, 100000)
+DEFAULT_PAGE_SIZE = 250
+DEFAULT_NUM_CONTACTS = 2000
+DEFAULT_NUM_LABELS = 10
+MODES = ("bulk", "individual")
+
+
+class FakeQuery(object):
+    """
+    Stands in for a RapidPro API query, returning pages of pre-generated messages after a simulated network latency
+    """
+
+    def __init__(self, messages, page_size, latency):
+        self.messages = messages
+        self.page_size = page_size
+        self.latency = latency
+
+    def iterfetches(self, *args, **kwargs):
+        for p in range(0, len(self.messages), self.page_size):
+            time.sleep(self.latency)
+            yield self.messages[p : p + self.page_size]
+
+
+class FakeClient(object):
+    """
+    Stands in for a RapidPro API client, returning the given messages from any messages query
+    """
+
+    def __init__(self, messages, page_size, latency):
+        self.messages = messages
+        self.page_size = page_size
+        self.latency = latency
+
+    def get_messages(self, *args, **kwargs):
+        return FakeQuery(self.messages, self.page_size, self.latency)
+
+
+class BenchmarkBackend(RapidProBackend):
+    def __init__(self, client):
+        super(BenchmarkBackend, self).__init__(backend=None)
+        self.client = client
+
+    def _get_client(self, org):
+        return self.client
+
+
+class Command(BaseCommand):
+    help = "Benchmarks pulling messages from a fake RapidPro API with bulk and per-message syncing"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--messages", type=int, nargs="*", default=DEFAULT_MESSAGE_COUNTS, help="The numbers of messages to pull"
+        )
+        parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="The number of messages per page")
+        parser.add_argument("--modes", nargs="*", choices=MODES, default=MODES, help="The sync modes to compare")
+        parser.add_argument(
+            "--latency", type=float, default=0.0, help="The simulated network latency in seconds of each page fetch"
+        )
+        parser.add_argument(
+            "--prefetch", type=int, default=2, help="The number of pages to fetch ahead (0 to fetch in turn)"
+        )
+        parser.add_argument("--seed", type=int, default=1234, help="The seed for generating messages")
+
+    def handle(self, *args, **options):
+        header = (
+            ("Messages", 10),
+            ("Mode", 12),
+            ("Pass", 10),
+            ("Outcomes", 24),
+            ("Time (secs)", 14),
+            ("Msgs/sec", 10),
+        )
+        self.stdout.write(row_to_str(header))
+        self.stdout.write("=" * row_width(header))
+
+        for num_messages in options["messages"]:
+            outcomes_by_mode = {}
+
+            for mode in options["modes"]:
+                rand = random.Random(options["seed"])
+                initial = self.generate_messages(rand, num_messages)
+                changed = self.change_messages(rand, initial)
+
+                passes = (("initial", initial), ("changes", changed))
+                outcomes = []
+                for (pass_name, messages), (outcome, duration) in zip(passes, self.time_pulls(passes, mode, options)):
+                    outcomes.append(outcome)
+
+                    row = (
+                        (num_messages, 10),
+                        (mode, 12),
+                        (pass_name, 10),
+                        ("%d/%d/%d/%d" % outcome, 24),
+                        ("%.2f" % duration, 14),
+                        ("%.1f" % (len(messages) / duration), 10),
+                    )
+                    self.stdout.write(row_to_str(row))
+
+                outcomes_by_mode[mode] = outcomes
+
+            if len({tuple(o) for o in outcomes_by_mode.values()}) > 1:  # pragma: no cover
+                self.stderr.write("Outcomes differ between modes: %s" % outcomes_by_mode)
+
+    @staticmethod
+    def generate_messages(rand, num_messages):
+        contacts = [ObjectRef.create(uuid="C-%05d" % c, name="Contact %d" % c) for c in range(DEFAULT_NUM_CONTACTS)]
+        labels = [ObjectRef.create(uuid="L-%03d" % l, name="Label %d" % l) for l in range(DEFAULT_NUM_LABELS)]
+        start = now() - timedelta(days=7)
+
+        return [
+            TembaMessage.create(
+                id=m + 1,
+                contact=rand.choice(contacts),
+                type="inbox",
+                text="Message number %d" % m,
+                visibility="visible",
+                labels=rand.sample(labels, rand.randint(0, 2)),
+                created_on=start + timedelta(seconds=m),
+            )
+            for m in range(num_messages)
+        ]
+
+    @staticmethod
+    def change_messages(rand, messages):
+        """
+        Generates the same messages as they might look when pulled again, with some archived, some deleted and some
+        labelled differently
+        """
+        changed = []
+        for msg in messages:
+            visibility, labels = msg.visibility, msg.labels
+
+            change = rand.random()
+            if change < 0.1:
+                visibility = "archived"
+            elif change < 0.15:
+                visibility = "deleted"
+            elif change < 0.25:
+                labels = []
+
+            changed.append(
+                TembaMessage.create(
+                    id=msg.id,
+                    contact=msg.contact,
+                    type=msg.type,
+                    text=msg.text,
+                    visibility=visibility,
+                    labels=labels,
+                    created_on=msg.created_on,
+                )
+            )
+        return changed
+
+    @staticmethod
+    def time_pulls(passes, mode, options):
+        """
+        Pulls each pass of messages in turn into a throwaway org, in a transaction which is rolled back afterwards
+        :return: list of tuples of pull outcome and time taken
+        """
+        results = []
+
+        with transaction.atomic(), override_settings(
+            PULL_MESSAGES_IN_BULK=(mode == "bulk"), PULL_PREFETCH_DEPTH=options["prefetch"]
+        ):
+            user = User.objects.create(username="msgsyncperf")
+            org = Org.objects.create(name="Benchmark", created_by=user, modified_by=user)
+
+            for pass_name, messages in passes:
+                backend = BenchmarkBackend(FakeClient(messages, options["page_size"], options["latency"]))
+
+                start = time.time()
+                outcome = backend.pull_messages(org, None, None)
+                results.append((outcome, time.time() - start))
+
+            transaction.set_rollback(True)
+
+        return results
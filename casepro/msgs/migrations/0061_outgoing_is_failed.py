@@ -0,0 +1,14 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("msgs", "0060_auto_20180814_2109")]
+
+    operations = [
+        migrations.AddField(
+            model_name="outgoing",
+            name="is_failed",
+            field=models.BooleanField(default=False, help_text="Whether the backend failed to send this message"),
+        )
+    ]
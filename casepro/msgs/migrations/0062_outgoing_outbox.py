@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+SQL = """
+CREATE INDEX msgs_outgoing_org_pending ON msgs_outgoing(org_id, id) WHERE is_pending = TRUE;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("msgs", "0061_outgoing_is_failed")]
+
+    operations = [
+        migrations.AddField(
+            model_name="outgoing",
+            name="is_pending",
+            field=models.BooleanField(default=False, help_text="Whether this message is waiting in the outbox"),
+        ),
+        migrations.AddField(
+            model_name="outgoing",
+            name="push_attempts",
+            field=models.IntegerField(default=0, help_text="Number of attempts to push this message"),
+        ),
+        migrations.AddField(
+            model_name="outgoing",
+            name="pushed_on",
+            field=models.DateTimeField(help_text="When this message was pushed to the backend", null=True),
+        ),
+        migrations.RunSQL(SQL, "DROP INDEX msgs_outgoing_org_pending;"),
+    ]
@@ -0,0 +1,12 @@
+from django.db import migrations
+
+from casepro.sql import InstallSQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("msgs", "0062_outgoing_outbox"), ("statistics", "0013_monthlycount")]
+
+    # statement level triggers need transition tables which were added in PostgreSQL 10, so older servers keep the
+    # row level triggers
+    operations = [InstallSQL("msgs_0003", min_pg_version=100000)]
@@ -1,3 +1,5 @@
+import logging
+from collections import Counter
 from datetime import timedelta
 from enum import Enum
 
@@ -5,13 +7,15 @@ from dash.orgs.models import Org
 from dash.utils import get_obj_cacheable
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
-from django.db import models
-from django.db.models import Q
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, F, Min, Q
 from django.utils.timesince import timesince
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from django_redis import get_redis_connection
 
+from casepro.backend import PushStatus
 from casepro.contacts.models import Contact, Field
 from casepro.utils import get_language_name, json_encode
 from casepro.utils.export import BaseSearchExport
@@ -20,6 +24,8 @@ LABEL_LOCK_KEY = "lock:label:%d:%s"
 MESSAGE_LOCK_KEY = "lock:message:%d:%d"
 MESSAGE_LOCK_SECONDS = 300
 
+logger = logging.getLogger(__name__)
+
 
 class MessageFolder(Enum):
     inbox = 1
@@ -103,9 +109,9 @@ class Label(models.Model):
         return get_obj_cacheable(self, self.INBOX_COUNT_CACHE_ATTR, lambda: self._get_inbox_count(), recalculate)
 
     def _get_inbox_count(self,):
-        from casepro.statistics.models import TotalCount
-
-        return TotalCount.get_by_label([self], TotalCount.TYPE_INBOX).scope_totals()[self]
+        # both counts are read together so getting the other count after this doesn't need another read
+        Label.bulk_cache_initialize([self])
+        return getattr(self, self.INBOX_COUNT_CACHE_ATTR)
 
     def get_archived_count(self, recalculate=False):
         """
@@ -114,23 +120,22 @@ class Label(models.Model):
         return get_obj_cacheable(self, self.ARCHIVED_COUNT_CACHE_ATTR, lambda: self._get_archived_count(), recalculate)
 
     def _get_archived_count(self):
-        from casepro.statistics.models import TotalCount
-
-        return TotalCount.get_by_label([self], TotalCount.TYPE_ARCHIVED).scope_totals()[self]
+        Label.bulk_cache_initialize([self])
+        return getattr(self, self.ARCHIVED_COUNT_CACHE_ATTR)
 
     @classmethod
     def bulk_cache_initialize(cls, labels):
         """
         Pre-loads cached counts on a set of labels to avoid fetching counts individually for each label
         """
+        from casepro.statistics.cache import get_label_totals
         from casepro.statistics.models import TotalCount
 
-        inbox_by_label = TotalCount.get_by_label(labels, TotalCount.TYPE_INBOX).scope_totals()
-        archived_by_label = TotalCount.get_by_label(labels, TotalCount.TYPE_ARCHIVED).scope_totals()
+        totals = get_label_totals(labels)
 
         for label in labels:
-            setattr(label, cls.INBOX_COUNT_CACHE_ATTR, inbox_by_label[label])
-            setattr(label, cls.ARCHIVED_COUNT_CACHE_ATTR, archived_by_label[label])
+            setattr(label, cls.INBOX_COUNT_CACHE_ATTR, totals[TotalCount.TYPE_INBOX][label])
+            setattr(label, cls.ARCHIVED_COUNT_CACHE_ATTR, totals[TotalCount.TYPE_ARCHIVED][label])
 
     @classmethod
     def lock(cls, org, uuid):
@@ -504,13 +509,82 @@ class Message(models.Model):
         """
         Removes all labels from this message
         """
+        self.clear_all_labels(self.org, [self])
+
+    @classmethod
+    def label_all(cls, org, messages, label):
+        """
+        Adds the given label to all of the given messages which don't already have it, using a fixed number of queries
+        regardless of the number of messages
+        :return: the messages which were labelled
+        """
+        from casepro.profiles.models import Notification
         from casepro.statistics.models import DailyCount, datetime_to_date
 
-        day = datetime_to_date(self.created_on, self.org)
-        for label in self.labels.all():
-            DailyCount.record_removal(day, DailyCount.TYPE_INCOMING, label)
+        messages_by_id = {m.pk: m for m in messages}
+
+        existing_ids = Labelling.objects.filter(label=label, message__in=messages_by_id.keys())
+        existing_ids = set(existing_ids.values_list("message_id", flat=True))
+        new_messages = [m for m_id, m in sorted(messages_by_id.items()) if m_id not in existing_ids]
+        if not new_messages:
+            return []
+
+        Labelling.objects.bulk_create([Labelling(message=m, label=label) for m in new_messages])
+
+        counts = Counter((datetime_to_date(m.created_on, org), (label,)) for m in new_messages)
+        DailyCount.record_counts(DailyCount.TYPE_INCOMING, counts)
+
+        # notify all users who watch this label
+        watcher_ids = User.objects.filter(watched_labels=label).values_list("pk", flat=True)
+        Notification.bulk_new_message_labellings(org, [(u, m.pk) for u in watcher_ids for m in new_messages])
+
+        return new_messages
+
+    @classmethod
+    def unlabel_all(cls, org, messages, label):
+        """
+        Removes the given label from all of the given messages which have it, using a fixed number of queries
+        regardless of the number of messages
+        :return: the messages which were unlabelled
+        """
+        from casepro.statistics.models import DailyCount, datetime_to_date
+
+        messages_by_id = {m.pk: m for m in messages}
+
+        labellings = Labelling.objects.filter(label=label, message__in=messages_by_id.keys())
+        labelled_ids = set(labellings.values_list("message_id", flat=True))
+        if not labelled_ids:
+            return []
+
+        removed_messages = [m for m_id, m in sorted(messages_by_id.items()) if m_id in labelled_ids]
 
-        Labelling.objects.filter(message=self).delete()
+        counts = Counter((datetime_to_date(m.created_on, org), (label,)) for m in removed_messages)
+        DailyCount.record_counts(DailyCount.TYPE_INCOMING, {k: -c for k, c in counts.items()})
+
+        Labelling.objects.filter(label=label, message__in=labelled_ids).delete()
+
+        return removed_messages
+
+    @classmethod
+    def clear_all_labels(cls, org, messages):
+        """
+        Removes all labels from all of the given messages, using a fixed number of queries regardless of the number of
+        messages or labels
+        """
+        from casepro.statistics.models import DailyCount, datetime_to_date
+
+        messages_by_id = {m.pk: m for m in messages}
+
+        labellings = Labelling.objects.filter(message__in=messages_by_id.keys()).select_related("label")
+
+        counts = Counter()
+        for labelling in labellings:
+            message = messages_by_id[labelling.message_id]
+            counts[(datetime_to_date(message.created_on, org), (labelling.label,))] -= 1
+
+        DailyCount.record_counts(DailyCount.TYPE_INCOMING, counts)
+
+        Labelling.objects.filter(message__in=messages_by_id.keys()).delete()
 
     def update_labels(self, user, labels):
         """
@@ -571,10 +645,11 @@ class Message(models.Model):
 
     @staticmethod
     def bulk_label(org, user, messages, label):
+        from casepro.statistics.cache import update_label_totals_on_commit
+
         messages = list(messages)
         if messages:
-            for msg in messages:
-                msg.label(label)
+            Message.label_all(org, messages, label)
 
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(modified_on=now())
 
@@ -583,12 +658,15 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.LABEL, label)
 
+            update_label_totals_on_commit()
+
     @staticmethod
     def bulk_unlabel(org, user, messages, label):
+        from casepro.statistics.cache import update_label_totals_on_commit
+
         messages = list(messages)
         if messages:
-            for msg in messages:
-                msg.unlabel(label)
+            Message.unlabel_all(org, messages, label)
 
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(modified_on=now())
 
@@ -597,8 +675,12 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.UNLABEL, label)
 
+            update_label_totals_on_commit()
+
     @staticmethod
     def bulk_archive(org, user, messages):
+        from casepro.statistics.cache import update_label_totals_on_commit
+
         messages = list(messages)
         if messages:
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(
@@ -609,8 +691,12 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.ARCHIVE)
 
+            update_label_totals_on_commit()
+
     @staticmethod
     def bulk_restore(org, user, messages):
+        from casepro.statistics.cache import update_label_totals_on_commit
+
         messages = list(messages)
         if messages:
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(
@@ -621,6 +707,8 @@ class Message(models.Model):
 
             MessageAction.create(org, user, messages, MessageAction.RESTORE)
 
+            update_label_totals_on_commit()
+
     def as_json(self):
         """
         Prepares this message for JSON serialization
@@ -718,6 +806,14 @@ class Outgoing(models.Model):
 
     backend_broadcast_id = models.IntegerField(null=True, help_text=_("Broadcast id from the backend"))
 
+    is_failed = models.BooleanField(default=False, help_text=_("Whether the backend failed to send this message"))
+
+    is_pending = models.BooleanField(default=False, help_text=_("Whether this message is waiting in the outbox"))
+
+    push_attempts = models.IntegerField(default=0, help_text=_("Number of attempts to push this message"))
+
+    pushed_on = models.DateTimeField(null=True, help_text=_("When this message was pushed to the backend"))
+
     contact = models.ForeignKey(
         Contact, null=True, related_name="outgoing_messages", on_delete=models.PROTECT
     )  # used for case and bulk replies
@@ -743,7 +839,7 @@ class Outgoing(models.Model):
             replies.append(reply)
 
         # push together as a single broadcast
-        org.get_backend().push_outgoing(org, replies, as_broadcast=True)
+        cls._push(org, replies, as_broadcast=True)
 
         return replies
 
@@ -761,7 +857,7 @@ class Outgoing(models.Model):
             forwards.append(cls._create(org, user, cls.FORWARD, text, original_message, urn=urn, push=False))
 
         # push together as a single broadcast
-        org.get_backend().push_outgoing(org, forwards, as_broadcast=True)
+        cls._push(org, forwards, as_broadcast=True)
 
         return forwards
 
@@ -782,13 +878,138 @@ class Outgoing(models.Model):
             reply_to=reply_to,
             case=case,
             created_by=user,
+            is_pending=cls.is_outbox_enabled(),
         )
 
         if push:
-            org.get_backend().push_outgoing(org, [msg])
+            cls._push(org, [msg])
 
         return msg
 
+    @staticmethod
+    def is_outbox_enabled():
+        return getattr(settings, "OUTBOX_ENABLED", False)
+
+    @classmethod
+    def _push(cls, org, messages, **kwargs):
+        """
+        Pushes new messages to the backend, or if the outbox is enabled, leaves them pending there and has the outbox
+        pushed once they have been committed. Without the outbox, messages which aren't sent are marked as failed as
+        nothing will retry them.
+        """
+        if cls.is_outbox_enabled():
+            from .tasks import push_outbox
+
+            transaction.on_commit(lambda: push_outbox.delay(org.pk))
+        else:
+            results = org.get_backend().push_outgoing(org, messages, **kwargs)
+
+            unsent = [msg for msg, status in results if status != PushStatus.SENT]
+            for msg in unsent:
+                msg.is_failed = True
+            if unsent:
+                cls.objects.filter(pk__in=[m.pk for m in unsent]).update(is_failed=True)
+
+    @classmethod
+    def push_outbox(cls, org, batch_size, max_attempts):
+        """
+        Pushes an org's pending messages to the backend a batch at a time, oldest first. Messages in a batch with the
+        same text are pushed together as a broadcast, as long as that doesn't send a message to a recipient ahead of
+        an earlier one. Messages which the backend couldn't send but might if retried stay pending to be retried by a
+        later run, until they reach the maximum number of attempts and are marked as failed.
+        :return: tuple of the number of messages pushed, left to be retried, and failed
+        """
+        backend = org.get_backend()
+        num_pushed, num_retried, num_failed = 0, 0, 0
+        last_id = 0
+
+        while True:
+            batch = cls.objects.filter(org=org, is_pending=True, pk__gt=last_id).order_by("pk")
+            batch = list(batch.select_related("contact", "reply_to", "created_by")[:batch_size])
+            if not batch:
+                break
+
+            last_id = batch[-1].pk
+
+            for messages in cls._group_for_push(batch):
+                as_broadcast = len(messages) > 1
+
+                try:
+                    results = backend.push_outgoing(org, messages, as_broadcast=as_broadcast)
+                except Exception:
+                    # backends report messages which couldn't be sent so this is unexpected, and we assume none were
+                    logger.exception("Unable to push %d outgoing messages for org #%d" % (len(messages), org.pk))
+                    results = []
+
+                status_by_id = {msg.pk: status for msg, status in results}
+                pushed, retried, failed = [], [], []
+
+                for msg in messages:
+                    status = status_by_id.get(msg.pk, PushStatus.RETRYABLE)
+
+                    if status == PushStatus.SENT:
+                        pushed.append(msg.pk)
+                    elif status == PushStatus.RETRYABLE and msg.push_attempts + 1 < max_attempts:
+                        retried.append(msg.pk)
+                    else:
+                        failed.append(msg.pk)
+
+                cls.objects.filter(pk__in=pushed).update(
+                    is_pending=False, push_attempts=F("push_attempts") + 1, pushed_on=now()
+                )
+                cls.objects.filter(pk__in=retried).update(push_attempts=F("push_attempts") + 1)
+                cls.objects.filter(pk__in=failed).update(
+                    is_pending=False, is_failed=True, push_attempts=F("push_attempts") + 1
+                )
+                num_pushed += len(pushed)
+                num_retried += len(retried)
+                num_failed += len(failed)
+
+            if len(batch) < batch_size:
+                break
+
+        return num_pushed, num_retried, num_failed
+
+    @staticmethod
+    def _group_for_push(messages):
+        """
+        Groups messages with the same text to be pushed together, without grouping two messages to the same recipient
+        or moving a message ahead of an earlier one to the same recipient
+        :return: list of lists of messages, in the order they should be pushed
+        """
+        groups = []
+        last_group_by_text = {}
+        last_group_by_recipient = {}
+
+        for msg in messages:
+            recipient = msg.urn or msg.contact_id
+            group_index = last_group_by_text.get(msg.text)
+
+            # a message can only join a group which comes after every group with an earlier message to its recipient
+            if group_index is None or last_group_by_recipient.get(recipient, -1) >= group_index:
+                group_index = len(groups)
+                groups.append([])
+                last_group_by_text[msg.text] = group_index
+
+            groups[group_index].append(msg)
+            last_group_by_recipient[recipient] = group_index
+
+        return groups
+
+    @classmethod
+    def get_outbox_stats(cls, org):
+        """
+        Gets the size and age of an org's outbox backlog, and how many messages have failed
+        """
+        pending = cls.objects.filter(org=org, is_pending=True).aggregate(count=Count("pk"), oldest=Min("created_on"))
+        oldest_age = round((now() - pending["oldest"]).total_seconds()) if pending["oldest"] else None
+
+        return {
+            "pending": pending["count"],
+            "oldest_pending_age": oldest_age,
+            "failed": cls.objects.filter(org=org, is_failed=True).count(),
+        }
+
     @classmethod
     def get_replies(cls, org):
         return org.outgoing_messages.filter(activity__in=cls.REPLY_ACTIVITIES)
@@ -1,6 +1,8 @@
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 
+from casepro.utils.sync import get_sync_session
+
 from .models import Label, Message
 
 
@@ -19,7 +21,12 @@ def update_message_contact(sender, instance, **kwargs):
 
     contact = getattr(instance, Message.SAVE_CONTACT_ATTR)
 
-    instance.contact = Contact.get_or_create(instance.org, contact[0], contact[1])
+    # if we're part of a sync, then the contact may already have been fetched or created
+    session = get_sync_session(instance.org)
+    if session:
+        instance.contact = session.get_contact(contact[0], contact[1])
+    else:
+        instance.contact = Contact.get_or_create(instance.org, contact[0], contact[1])
 
 
 @receiver(post_save, sender=Message)
@@ -49,8 +56,10 @@ def update_message_labels(sender, instance, created, **kwargs):
     # add this message to any labels not in the current set
     add_to_by_uuid = {uuid: name for uuid, name in new_labels_by_uuid.items() if uuid not in cur_labels_by_uuid.keys()}
     if add_to_by_uuid:
-        org_labels_by_uuid = {l.uuid: l for l in org.labels.all()}
-        org_unsynced_names = {l.name for l in org.labels.all() if not l.is_synced}
+        session = get_sync_session(org)
+        org_labels = session.get_labels() if session else list(org.labels.all())
+        org_labels_by_uuid = {l.uuid: l for l in org_labels}
+        org_unsynced_names = {l.name for l in org_labels if not l.is_synced}
 
         # create any labels that don't exist
         add_to_labels = []
@@ -59,6 +68,8 @@ def update_message_labels(sender, instance, created, **kwargs):
             if not label and name not in org_unsynced_names:
                 # create stub
                 label = org.labels.create(uuid=uuid, name=name, is_active=False)
+                if session:
+                    session.add_label(label)
 
             if label and label.is_synced:
                 add_to_labels.append(label)
@@ -1,5 +1,7 @@
 import csv
+import time
 import traceback
+from collections import defaultdict
 from datetime import timedelta
 
 from celery import shared_task
@@ -11,7 +13,10 @@ from django.db import transaction
 from django.utils import timezone
 from smartmin.csv_imports.models import ImportTask
 
+from casepro.statistics.cache import update_label_totals
+from casepro.statistics.models import buffered_counts
 from casepro.utils import parse_csv
+from casepro.utils.sync import pull_in_slices, sync_session
 
 from .models import FAQ, Label
 
@@ -21,7 +26,8 @@ logger = get_task_logger(__name__)
 @org_task("message-pull", lock_timeout=12 * 60 * 60)
 def pull_messages(org, since, until):
     """
-    Pulls new unsolicited messages for an org
+    Pulls new unsolicited messages for an org. Long windows are pulled in time slices, and progress is checkpointed so
+    that a run which fails or runs out of time is resumed by the next run.
     """
     backend = org.get_backend()
 
@@ -29,18 +35,158 @@ def pull_messages(org, since, until):
     if not since:
         since = until - timedelta(hours=1)
 
-    labels_created, labels_updated, labels_deleted, ignored = backend.pull_labels(org)
-
-    msgs_created, msgs_updated, msgs_deleted, ignored = backend.pull_messages(org, since, until)
-
-    return {
+    with sync_session(org) as session:
+        labels_created, labels_updated, labels_deleted, ignored = backend.pull_labels(org)
+
+        counts, num_slices, completed, resumed = pull_in_slices(
+            org,
+            "message-pull",
+            since,
+            until,
+            lambda slice_since, slice_until: backend.pull_messages(org, slice_since, slice_until),
+            slice_days=getattr(settings, "PULL_SLICE_DAYS", 7),
+            time_limit=getattr(settings, "PULL_TIME_LIMIT", 60 * 60),
+        )
+        msgs_created, msgs_updated, msgs_deleted, ignored = counts
+
+    result = {
         "labels": {"created": labels_created, "updated": labels_updated, "deleted": labels_deleted},
         "messages": {"created": msgs_created, "updated": msgs_updated, "deleted": msgs_deleted},
     }
 
+    # include how the window was pulled if it wasn't just pulled in one go
+    if num_slices > 1 or not completed or resumed:
+        result["slices"] = {"pulled": num_slices, "completed": completed, "resumed": resumed}
+
+    # include how long we waited on the network vs the database if the backend used fetch pipelines
+    pipeline_stats = session.get_pipeline_stats()
+    if pipeline_stats:
+        result["pipelines"] = pipeline_stats
+
+    return result
+
 
 @org_task("message-handle", lock_timeout=12 * 60 * 60)
 def handle_messages(org):
+    """
+    Handles unhandled messages in batches, each of which is committed before the next is started, so that an
+    interrupted run only has to redo its last batch. A run stops early if it exceeds its time limit, leaving remaining
+    messages for the next run.
+    """
+    from casepro.rules.models import MatchingPool
+    from .models import Message
+
+    batch_size = getattr(settings, "HANDLE_MESSAGES_BATCH_SIZE", 500)
+    time_limit = getattr(settings, "HANDLE_MESSAGES_TIME_LIMIT", 60 * 60)
+
+    processes = getattr(settings, "HANDLE_MESSAGES_RULE_PROCESSES", 1)
+    if processes > 1 and batch_size < getattr(settings, "RULES_PARALLEL_MIN_MESSAGES", 500):
+        logger.warning(
+            "HANDLE_MESSAGES_RULE_PROCESSES is set but batches of %d messages are too small to be matched in parallel, "
+            "as RULES_PARALLEL_MIN_MESSAGES is larger" % batch_size
+        )
+        processes = 1
+
+    num_handled = 0
+    num_rules_matched = 0
+    num_case_replies = 0
+    num_batches = 0
+    batch_rates = []
+
+    start = time.time()
+    last_id = 0
+
+    # workers are reused for every batch of this run
+    with MatchingPool(processes) as pool:
+        while True:
+            # fetch next batch of unhandled messages who now have full contacts
+            batch = Message.get_unhandled(org).filter(contact__is_stub=False, pk__gt=last_id).order_by("pk")
+            batch = list(batch.select_related("contact").prefetch_related("contact__groups")[:batch_size])
+            if not batch:
+                break
+
+            batch_start = time.time()
+
+            rules_matched, case_replies = handle_message_batch(org, batch, pool=pool)
+
+            batch_time = time.time() - batch_start
+
+            num_handled += len(batch)
+            num_rules_matched += rules_matched
+            num_case_replies += case_replies
+            num_batches += 1
+
+            if batch_time > 0:  # timer may not have ticked
+                batch_rates.append(len(batch) / batch_time)
+
+            last_id = batch[-1].pk
+
+            if len(batch) < batch_size:
+                break
+
+            if time.time() - start > time_limit:
+                logger.warning(
+                    "Time limit reached handling messages for org #%d after %d messages" % (org.pk, num_handled)
+                )
+                break
+
+    return {
+        "handled": num_handled,
+        "rules_matched": num_rules_matched,
+        "case_replies": num_case_replies,
+        "batches": {
+            "count": num_batches,
+            "min_rate": round(min(batch_rates), 1) if batch_rates else None,
+            "avg_rate": round(sum(batch_rates) / len(batch_rates), 1) if batch_rates else None,
+            "max_rate": round(max(batch_rates), 1) if batch_rates else None,
+        },
+    }
+
+
+@org_task("junebug-ingest", lock_timeout=12 * 60 * 60)
+def ingest_junebug_messages(org):
+    """
+    Creates inbound Junebug messages which the webhook has queued, in batches. A run stops early if it exceeds its
+    time limit, leaving remaining messages for the next run.
+    """
+    from casepro.backend.junebug import ingest_queued_messages
+
+    num_created, num_duplicates = ingest_queued_messages(
+        org,
+        batch_size=getattr(settings, "JUNEBUG_INBOUND_BATCH_SIZE", 500),
+        time_limit=getattr(settings, "JUNEBUG_INBOUND_TIME_LIMIT", 5 * 60),
+    )
+
+    return {"messages": {"created": num_created, "duplicates": num_duplicates}}
+
+
+@org_task("outbox-push", lock_timeout=60 * 60)
+def push_outbox(org):
+    """
+    Pushes outgoing messages waiting in the outbox to the backend
+    """
+    from .models import Outgoing
+
+    num_pushed, num_retried, num_failed = Outgoing.push_outbox(
+        org,
+        batch_size=getattr(settings, "OUTBOX_BATCH_SIZE", 100),
+        max_attempts=getattr(settings, "OUTBOX_MAX_ATTEMPTS", 5),
+    )
+
+    return {
+        "messages": {"pushed": num_pushed, "retried": num_retried, "failed": num_failed},
+        "backlog": Outgoing.get_outbox_stats(org),
+    }
+
+
+def handle_message_batch(org, messages, pool=None):
+    """
+    Handles a batch of messages by adding them to open cases or applying rules, and then marking them as handled. The
+    local changes are committed together before any changes are made on the backend, so that no locks are held while
+    waiting on the backend and a rollback can't leave the backend out of sync.
+    :param pool: the matching pool to match rules in, if any
+    :return: tuple of the number of rules matched, and the number of messages which were case replies
+    """
     from casepro.cases.models import Case
     from casepro.rules.models import Rule
     from .models import Message
@@ -48,38 +194,45 @@ def handle_messages(org):
     backend = org.get_backend()
 
     case_replies = []
-    num_rules_matched = 0
+    rule_messages = []
+
+    rule_processor = Rule.get_batch_processor(org)
 
-    # fetch all unhandled messages who now have full contacts
-    unhandled = Message.get_unhandled(org).filter(contact__is_stub=False)
-    unhandled = list(unhandled.select_related("contact").prefetch_related("contact__groups"))
+    # find the open case (if any) for each message's contact at the time it was received
+    open_cases = Case.get_open_for_messages(org, messages)
+    replies_by_case = defaultdict(list)
 
-    if unhandled:
-        rules = Rule.get_all(org)
-        rule_processor = Rule.BatchProcessor(org, rules)
+    for msg in messages:
+        open_case = open_cases.get(msg)
 
-        for msg in unhandled:
-            open_case = Case.get_open_for_contact_on(org, msg.contact, msg.created_on)
+        # only apply rules if there isn't a currently open case for this contact
+        if open_case:
+            replies_by_case[open_case].append(msg)
 
-            # only apply rules if there isn't a currently open case for this contact
-            if open_case:
-                open_case.add_reply(msg)
+            case_replies.append(msg)
+        else:
+            rule_messages.append(msg)
 
-                case_replies.append(msg)
-            else:
-                rules_matched, actions_deferred = rule_processor.include_messages(msg)
-                num_rules_matched += rules_matched
+    num_rules_matched, actions_deferred = rule_processor.include_messages(*rule_messages, pool=pool)
 
-        # archive messages which are case replies on the backend
-        if case_replies:
-            backend.archive_messages(org, case_replies)
+    with transaction.atomic(), buffered_counts():
+        Case.bulk_add_replies(org, replies_by_case)
 
-        rule_processor.apply_actions()
+        rule_processor.apply_actions_locally()
 
         # mark all of these messages as handled
-        Message.objects.filter(pk__in=[m.pk for m in unhandled]).update(is_handled=True, modified_on=timezone.now())
+        Message.objects.filter(pk__in=[m.pk for m in messages]).update(is_handled=True, modified_on=timezone.now())
+
+    # handled messages are now counted in the inboxes of their labels
+    update_label_totals()
+
+    # archive messages which are case replies on the backend
+    if case_replies:
+        backend.archive_messages(org, case_replies)
+
+    rule_processor.apply_actions_on_backend()
 
-    return {"handled": len(unhandled), "rules_matched": num_rules_matched, "case_replies": len(case_replies)}
+    return num_rules_matched, len(case_replies)
 
 
 @shared_task
@@ -3,17 +3,25 @@ from datetime import datetime
 import pytz
 from dash.orgs.models import TaskState
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.urls import reverse
 from django.test.utils import override_settings
 from django.utils.timezone import now
-from unittest.mock import call, patch
+from unittest.mock import MagicMock, call, patch
 from temba_client.utils import format_iso8601
 
+from casepro.backend import PushStatus
+from casepro.celery import unschedule_disabled_tasks
 from casepro.contacts.models import Contact
 from casepro.msgs.views import ImportTask
+from casepro.profiles.models import Notification
 from casepro.rules.models import ContainsTest, FieldTest, GroupsTest, Quantifier, WordCountTest
+from casepro.sql import InstallSQL
+from casepro.statistics.cache import update_label_totals
+from casepro.statistics.models import DailyCount, TotalCount
 from casepro.statistics.tasks import squash_counts
 from casepro.test import BaseCasesTest
+from casepro.utils.sync import get_sync_session
 
 from .models import (
     FAQ,
@@ -26,7 +34,7 @@ from .models import (
     OutgoingFolder,
     ReplyExport,
 )
-from .tasks import faq_csv_import, handle_messages, pull_messages
+from .tasks import faq_csv_import, handle_messages, pull_messages, push_outbox
 
 faq_good_import = b"""Parent ID,Parent Language,Parent Question,Parent Answer,Labels,afr ID,afr Question,afr Answer,bla ID,bla Question,bla Answer
 ,eng,Can I drink tea while pregnant?,"Yes, but avoid too much caffeine","Tea, Pregnancy",,Kan ek tee drink tydens swangerskap?,"Ja, maar beperk jou kaffein inname",,Xtea Xpregnant?,Xyes
@@ -627,7 +635,7 @@ class FaqCRUDLTest(BaseCasesTest):
         self.login(self.user1)
 
         # check that appropriate number of queries are executed
-        with self.assertNumQueries(28):
+        with self.assertNumQueries(20):
             response = self.url_get("unicef", url, {})
         # should have 4 results as one is label restricted
         self.assertEqual(len(response.json["results"]), 4)
@@ -827,6 +835,9 @@ class MessageTest(BaseCasesTest):
 
     def test_triggers(self):
         def get_label_counts():
+            # tests run in a transaction which is never committed, so the cached totals have to be updated here
+            update_label_totals()
+
             return {
                 "aids.inbox": self.aids.get_inbox_count(recalculate=True),
                 "aids.archived": self.aids.get_archived_count(recalculate=True),
@@ -881,6 +892,59 @@ class MessageTest(BaseCasesTest):
 
         self.assertEqual(get_label_counts(), {"aids.inbox": 1, "aids.archived": 1, "tea.inbox": 0, "tea.archived": 1})
 
+    def test_statement_triggers_migration(self):
+        operation = InstallSQL("msgs_0003", min_pg_version=100000)
+        schema_editor = MagicMock()
+        schema_editor.connection.ops.prepare_sql_script.side_effect = lambda sql: [sql]
+
+        # older servers keep the row level triggers
+        schema_editor.connection.pg_version = 90600
+        operation.database_forwards("msgs", schema_editor, None, None)
+        schema_editor.execute.assert_not_called()
+
+        schema_editor.connection.pg_version = 100000
+        operation.database_forwards("msgs", schema_editor, None, None)
+        schema_editor.execute.assert_called_once_with(operation.sql, params=None)
+
+    def test_statement_triggers(self):
+        if connection.pg_version < 100000:
+            self.skipTest("Statement level triggers need PostgreSQL 10")
+
+        def get_new_counts():
+            counts = TotalCount.objects.filter(pk__gt=self.last_count_id).order_by("item_type", "scope")
+            self.last_count_id = TotalCount.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+            return [(c.item_type, c.scope, c.count) for c in counts]
+
+        self.last_count_id = 0
+        msgs = [self.create_message(self.unicef, 101 + m, self.ann, "Hello", is_handled=True) for m in range(3)]
+        aids, tea = "label:%d" % self.aids.pk, "label:%d" % self.tea.pk
+        get_new_counts()
+
+        # labelling many messages in one statement writes a single count per label and folder
+        Message.label_all(self.unicef, msgs, self.aids)
+        Message.label_all(self.unicef, msgs[:2], self.tea)
+
+        self.assertEqual(get_new_counts(), [("N", aids, 3), ("N", tea, 2)])
+        self.assertEqual(Message.objects.filter(pk__in=[m.pk for m in msgs], has_labels=True).count(), 3)
+
+        Message.objects.filter(pk__in=[m.pk for m in msgs]).update(is_archived=True)
+
+        self.assertEqual(get_new_counts(), [("A", aids, 3), ("A", tea, 2), ("N", aids, -3), ("N", tea, -2)])
+
+        # as does unlabelling them, which only clears has_labels on messages with no other labels
+        Message.unlabel_all(self.unicef, msgs, self.aids)
+
+        self.assertEqual(get_new_counts(), [("A", aids, -3)])
+        self.assertEqual(
+            set(Message.objects.filter(pk__in=[m.pk for m in msgs], has_labels=False).values_list("pk", flat=True)),
+            {msgs[2].pk},
+        )
+
+        # updates which don't move messages between folders don't write counts
+        Message.objects.filter(pk__in=[m.pk for m in msgs]).update(is_flagged=True)
+
+        self.assertEqual(get_new_counts(), [])
+
     def test_save(self):
         # start with no labels or contacts
         Label.objects.all().delete()
@@ -1164,6 +1228,66 @@ class MessageTest(BaseCasesTest):
 
         self.assertEqual(self.aids.messages.count(), 0)
 
+    def test_label_all(self):
+        self.create_test_messages()
+        self.aids.watch(self.user1)
+        self.aids.watch(self.user3)
+
+        # msg1 already has this label and msg3 is given twice
+        with self.assertNumQueries(6):
+            labelled = Message.label_all(self.unicef, [self.msg1, self.msg3, self.msg4, self.msg3], self.aids)
+
+        self.assertEqual(labelled, [self.msg3, self.msg4])
+        self.assertEqual(set(self.aids.messages.all()), {self.msg1, self.msg3, self.msg4})
+        self.assertEqual(DailyCount.get_by_label([self.aids], DailyCount.TYPE_INCOMING).total(), 3)
+        self.assertEqual(
+            set(Notification.objects.filter(type=Notification.TYPE_MESSAGE_LABELLING).values_list("user", "message")),
+            {
+                (self.user1.pk, self.msg3.pk),
+                (self.user1.pk, self.msg4.pk),
+                (self.user3.pk, self.msg3.pk),
+                (self.user3.pk, self.msg4.pk),
+            },
+        )
+
+        # nothing to do if all messages are already labelled
+        with self.assertNumQueries(1):
+            self.assertEqual(Message.label_all(self.unicef, [self.msg3, self.msg4], self.aids), [])
+
+    def test_unlabel_all(self):
+        self.create_test_messages()
+        Message.label_all(self.unicef, [self.msg3], self.tea)
+
+        with self.assertNumQueries(3):
+            unlabelled = Message.unlabel_all(self.unicef, [self.msg1, self.msg2, self.msg3], self.tea)
+
+        self.assertEqual(unlabelled, [self.msg1, self.msg3])
+        self.assertEqual(set(self.tea.messages.all()), set())
+        self.assertEqual(set(self.aids.messages.all()), {self.msg1})
+        self.assertEqual(DailyCount.get_by_label([self.tea], DailyCount.TYPE_INCOMING).total(), 0)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Message.unlabel_all(self.unicef, [self.msg1], self.tea), [])
+
+    def test_clear_all_labels(self):
+        self.create_test_messages()
+        Message.label_all(self.unicef, [self.msg2, self.msg3], self.aids)
+
+        with self.assertNumQueries(3):
+            Message.clear_all_labels(self.unicef, [self.msg1, self.msg2])
+
+        self.assertEqual(set(self.aids.messages.all()), {self.msg3})
+        self.assertEqual(set(self.pregnancy.messages.all()), set())
+        self.assertEqual(set(self.tea.messages.all()), set())
+        self.assertEqual(
+            DailyCount.get_by_label([self.aids, self.pregnancy, self.tea], DailyCount.TYPE_INCOMING).scope_totals(),
+            {self.aids: 1, self.pregnancy: 0, self.tea: 0},
+        )
+
+        self.msg3.clear_labels()
+
+        self.assertEqual(set(self.aids.messages.all()), set())
+
     @patch("casepro.test.TestBackend.archive_messages")
     def test_bulk_archive(self, mock_archive_messages):
         self.create_test_messages()
@@ -1734,6 +1858,21 @@ class OutgoingTest(BaseCasesTest):
             },
         )
 
+    @override_settings(OUTBOX_ENABLED=True)
+    @patch("casepro.test.TestBackend.push_outgoing")
+    def test_create_with_outbox(self, mock_push_outgoing):
+        msg1 = self.create_message(self.unicef, 101, self.ann, "Hello")
+        msg2 = self.create_message(self.unicef, 102, self.bob, "Bonjour")
+        case = self.create_case(self.unicef, self.ann, self.moh, msg1)
+
+        replies = Outgoing.create_bulk_replies(self.unicef, self.user1, "That's great", [msg1, msg2])
+        reply = Outgoing.create_case_reply(self.unicef, self.user1, "We can help", case)
+
+        # messages are left in the outbox rather than pushed
+        self.assertEqual(mock_push_outgoing.call_count, 0)
+        self.assertEqual([o.is_pending for o in replies + [reply]], [True, True, True])
+        self.assertEqual(Outgoing.get_outbox_stats(self.unicef), {"pending": 3, "oldest_pending_age": 0, "failed": 0})
+
 
 class OutgoingCRUDLTest(BaseCasesTest):
     def setUp(self):
@@ -1989,6 +2128,18 @@ class TasksTest(BaseCasesTest):
             },
         )
 
+        # if the backend pipelines its fetches, then the pipeline stats are included in the results
+        def pull_with_pipeline(org, since, until):
+            list(get_sync_session(org).pipeline("messages", [[1], [2]], 2))
+            return 5, 6, 7, 8
+
+        mock_pull_messages.side_effect = pull_with_pipeline
+
+        pull_messages(self.unicef.pk)
+
+        task_state = TaskState.objects.get(org=self.unicef, task_key="message-pull")
+        self.assertEqual(task_state.get_last_results()["pipelines"]["messages"]["fetches"], 2)
+
     @patch("casepro.test.TestBackend.label_messages")
     @patch("casepro.test.TestBackend.archive_messages")
     def test_handle_messages(self, mock_archive_messages, mock_label_messages):
@@ -2042,9 +2193,226 @@ class TasksTest(BaseCasesTest):
 
         # check task result
         task_state = self.unicef.get_task_state("message-handle")
-        self.assertEqual(task_state.get_last_results(), {"handled": 5, "case_replies": 1, "rules_matched": 3})
+        results = task_state.get_last_results()
+        self.assertEqual((results["handled"], results["case_replies"], results["rules_matched"]), (5, 1, 3))
+        self.assertEqual(results["batches"]["count"], 1)
 
         # check calling again...
         handle_messages(self.unicef.pk)
         task_state = self.unicef.get_task_state("message-handle")
-        self.assertEqual(task_state.get_last_results(), {"handled": 0, "case_replies": 0, "rules_matched": 0})
+        self.assertEqual(
+            task_state.get_last_results(),
+            {
+                "handled": 0,
+                "case_replies": 0,
+                "rules_matched": 0,
+                "batches": {"count": 0, "min_rate": None, "avg_rate": None, "max_rate": None},
+            },
+        )
+
+    @override_settings(HANDLE_MESSAGES_BATCH_SIZE=2)
+    @patch("casepro.test.TestBackend.label_messages")
+    def test_handle_messages_in_batches(self, mock_label_messages):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        msgs = [self.create_message(self.unicef, 101 + m, ann, "What is aids?") for m in range(5)]
+
+        # make labelling fail on the second batch
+        mock_label_messages.side_effect = [None, ValueError("backend down"), None]
+
+        with self.assertRaises(ValueError):
+            handle_messages(self.unicef.pk)
+
+        # backend is only called once a batch is committed so second batch is handled locally but third isn't started
+        self.assertEqual(set(Message.objects.filter(is_handled=True)), set(msgs[:4]))
+        self.assertEqual(set(self.aids.messages.all()), set(msgs[:4]))
+
+        # next run resumes from the first unhandled message
+        handle_messages(self.unicef.pk)
+
+        self.assertEqual(set(Message.objects.filter(is_handled=True)), set(msgs))
+        self.assertEqual(set(self.aids.messages.all()), set(msgs))
+        self.assertEqual(mock_label_messages.call_count, 3)
+
+        results = self.unicef.get_task_state("message-handle").get_last_results()
+        self.assertEqual((results["handled"], results["rules_matched"]), (1, 1))
+        self.assertEqual(results["batches"]["count"], 1)
+
+    @override_settings(HANDLE_MESSAGES_BATCH_SIZE=2, HANDLE_MESSAGES_TIME_LIMIT=0)
+    def test_handle_messages_time_limit(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        for m in range(5):
+            self.create_message(self.unicef, 101 + m, ann, "Hello")
+
+        # each run stops after its first batch as it's used up its time
+        handle_messages(self.unicef.pk)
+        self.assertEqual(Message.objects.filter(is_handled=True).count(), 2)
+
+        handle_messages(self.unicef.pk)
+        self.assertEqual(Message.objects.filter(is_handled=True).count(), 4)
+
+        handle_messages(self.unicef.pk)
+        self.assertEqual(Message.objects.filter(is_handled=True).count(), 5)
+
+    @override_settings(HANDLE_MESSAGES_BATCH_SIZE=100, HANDLE_MESSAGES_RULE_PROCESSES=2)
+    def test_handle_messages_rule_processes(self):
+        # batches which can never be large enough to be matched in parallel are a misconfiguration
+        with override_settings(RULES_PARALLEL_MIN_MESSAGES=200):
+            with self.assertLogs("casepro.msgs.tasks", level="WARNING"):
+                handle_messages(self.unicef.pk)
+
+        with override_settings(RULES_PARALLEL_MIN_MESSAGES=100), patch("casepro.msgs.tasks.logger") as mock_logger:
+            handle_messages(self.unicef.pk)
+
+            mock_logger.warning.assert_not_called()
+
+    @patch("casepro.msgs.tasks.time")
+    def test_handle_messages_coarse_timer(self, mock_time):
+        mock_time.time.return_value = 1000.0
+
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        self.create_message(self.unicef, 101, ann, "Hello")
+
+        # a batch which takes no measurable time doesn't have a rate
+        handle_messages(self.unicef.pk)
+
+        results = self.unicef.get_task_state("message-handle").get_last_results()
+        self.assertEqual(results["batches"], {"count": 1, "min_rate": None, "avg_rate": None, "max_rate": None})
+
+    @patch("casepro.test.TestBackend.push_outgoing")
+    def test_push_without_outbox(self, mock_push_outgoing):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        msg1 = self.create_message(self.unicef, 101, ann, "Hello")
+        msg2 = self.create_message(self.unicef, 102, bob, "Bonjour")
+
+        # nothing will retry messages which weren't sent so they're failed
+        mock_push_outgoing.side_effect = lambda org, messages, as_broadcast=False: [
+            (messages[0], PushStatus.SENT),
+            (messages[1], PushStatus.RETRYABLE),
+        ]
+        out1, out2 = Outgoing.create_bulk_replies(self.unicef, self.user1, "That's great", [msg1, msg2])
+
+        self.assertEqual((out1.is_failed, out2.is_failed), (False, True))
+
+        out1.refresh_from_db()
+        out2.refresh_from_db()
+        self.assertEqual((out1.is_failed, out2.is_failed), (False, True))
+
+    @override_settings(OUTBOX_ENABLED=True, OUTBOX_BATCH_SIZE=3, OUTBOX_MAX_ATTEMPTS=2)
+    @patch("casepro.test.TestBackend.push_outgoing")
+    def test_push_outbox(self, mock_push_outgoing):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        msg1 = self.create_message(self.unicef, 101, ann, "Hello")
+        msg2 = self.create_message(self.unicef, 102, bob, "Bonjour")
+        out1, out2 = Outgoing.create_bulk_replies(self.unicef, self.user1, "That's great", [msg1, msg2])
+        out3 = Outgoing.create_forwards(self.unicef, self.user1, "FYI", ["tel:+26012345678"], msg1)[0]
+        out4 = Outgoing.create_bulk_replies(self.unicef, self.user1, "That's great", [msg1])[0]
+        out5 = Outgoing.create_bulk_replies(self.unicef, self.user1, "Hi", [msg2])[0]
+
+        def get_last_results():
+            return TaskState.objects.get(org=self.unicef, task_key="outbox-push").get_last_results()
+
+        # if pushing fails, messages are left in the outbox to be retried
+        mock_push_outgoing.side_effect = Exception("Backend down")
+        with self.assertLogs("casepro.msgs.models", level="ERROR"):
+            push_outbox(self.unicef.pk)
+
+        self.assertEqual(get_last_results()["messages"], {"pushed": 0, "retried": 5, "failed": 0})
+        self.assertEqual(get_last_results()["backlog"]["pending"], 5)
+
+        def push_outgoing(org, messages, as_broadcast=False):
+            status = PushStatus.RETRYABLE if messages[0].text == "FYI" else PushStatus.SENT
+            return [(msg, status) for msg in messages]
+
+        mock_push_outgoing.reset_mock()
+        mock_push_outgoing.side_effect = push_outgoing
+        push_outbox(self.unicef.pk)
+
+        # identical texts within a batch are pushed together as broadcasts
+        self.assertEqual(
+            mock_push_outgoing.call_args_list,
+            [
+                call(self.unicef, [out1, out2], as_broadcast=True),
+                call(self.unicef, [out3], as_broadcast=False),
+                call(self.unicef, [out4], as_broadcast=False),
+                call(self.unicef, [out5], as_broadcast=False),
+            ],
+        )
+
+        # and messages which reach the maximum number of attempts are marked as failed
+        self.assertEqual(
+            get_last_results(),
+            {
+                "messages": {"pushed": 4, "retried": 0, "failed": 1},
+                "backlog": {"pending": 0, "oldest_pending_age": None, "failed": 1},
+            },
+        )
+
+        out1.refresh_from_db()
+        out3.refresh_from_db()
+        self.assertEqual((out1.is_pending, out1.is_failed, out1.push_attempts), (False, False, 2))
+        self.assertIsNotNone(out1.pushed_on)
+        self.assertEqual((out3.is_pending, out3.is_failed, out3.push_attempts), (False, True, 2))
+        self.assertIsNone(out3.pushed_on)
+
+    @override_settings(OUTBOX_ENABLED=True, OUTBOX_BATCH_SIZE=10, OUTBOX_MAX_ATTEMPTS=2)
+    @patch("casepro.test.TestBackend.push_outgoing")
+    def test_push_outbox_order(self, mock_push_outgoing):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        msg1 = self.create_message(self.unicef, 101, ann, "Hello")
+        msg2 = self.create_message(self.unicef, 102, bob, "Bonjour")
+        out1 = Outgoing.create_bulk_replies(self.unicef, self.user1, "Yes", [msg1])[0]
+        out2 = Outgoing.create_bulk_replies(self.unicef, self.user1, "Ok, bye", [msg1])[0]
+        out3, out4 = Outgoing.create_bulk_replies(self.unicef, self.user1, "Yes", [msg1, msg2])
+
+        def push_outgoing(org, messages, as_broadcast=False):
+            # the backend rejects one message, and sends the first of a broadcast before failing
+            if messages == [out2]:
+                return [(out2, PushStatus.FAILED)]
+            elif messages == [out3, out4]:
+                return [(out3, PushStatus.SENT), (out4, PushStatus.RETRYABLE)]
+            return [(msg, PushStatus.SENT) for msg in messages]
+
+        mock_push_outgoing.side_effect = push_outgoing
+        push_outbox(self.unicef.pk)
+
+        # a text is only pushed together with an earlier identical text if that keeps each recipient's messages in order
+        self.assertEqual(
+            mock_push_outgoing.call_args_list,
+            [
+                call(self.unicef, [out1], as_broadcast=False),
+                call(self.unicef, [out2], as_broadcast=False),
+                call(self.unicef, [out3, out4], as_broadcast=True),
+            ],
+        )
+
+        # and only the messages which weren't sent but might be are retried
+        results = TaskState.objects.get(org=self.unicef, task_key="outbox-push").get_last_results()
+        self.assertEqual(results["messages"], {"pushed": 2, "retried": 1, "failed": 1})
+
+        out2.refresh_from_db()
+        out3.refresh_from_db()
+        out4.refresh_from_db()
+        self.assertEqual((out2.is_pending, out2.is_failed, out2.push_attempts), (False, True, 1))
+        self.assertEqual((out3.is_pending, out3.push_attempts), (False, 1))
+        self.assertEqual((out4.is_pending, out4.push_attempts), (True, 1))
+
+        mock_push_outgoing.reset_mock()
+        push_outbox(self.unicef.pk)
+
+        mock_push_outgoing.assert_called_once_with(self.unicef, [out4], as_broadcast=False)
+
+    def test_push_outbox_scheduled_if_enabled(self):
+        sender = MagicMock()
+
+        with override_settings(OUTBOX_ENABLED=False):
+            sender.conf.beat_schedule = {"message-pull": {}, "outbox-push": {}}
+            unschedule_disabled_tasks(sender)
+            self.assertEqual(set(sender.conf.beat_schedule), {"message-pull"})
+
+        with override_settings(OUTBOX_ENABLED=True):
+            sender.conf.beat_schedule = {"message-pull": {}, "outbox-push": {}}
+            unschedule_disabled_tasks(sender)
+            self.assertEqual(set(sender.conf.beat_schedule), {"message-pull", "outbox-push"})
@@ -118,6 +118,13 @@ class Notification(models.Model):
     def new_message_labelling(cls, org, user, message):
         return cls.objects.get_or_create(org=org, user=user, type=cls.TYPE_MESSAGE_LABELLING, message=message)
 
+    @classmethod
+    def bulk_new_message_labellings(cls, org, user_messages):
+        """
+        Equivalent to calling new_message_labelling for each of the given (user id, message id) pairs
+        """
+        return cls._bulk_new_for_messages(org, cls.TYPE_MESSAGE_LABELLING, user_messages)
+
     @classmethod
     def new_case_assignment(cls, org, user, case_action):
         return cls.objects.get_or_create(org=org, user=user, type=cls.TYPE_CASE_ASSIGNMENT, case_action=case_action)
@@ -130,6 +137,32 @@ class Notification(models.Model):
     def new_case_reply(cls, org, user, message):
         return cls.objects.get_or_create(org=org, user=user, type=cls.TYPE_CASE_REPLY, message=message)
 
+    @classmethod
+    def bulk_new_case_replies(cls, org, user_messages):
+        """
+        Equivalent to calling new_case_reply for each of the given (user id, message id) pairs
+        """
+        return cls._bulk_new_for_messages(org, cls.TYPE_CASE_REPLY, user_messages)
+
+    @classmethod
+    def _bulk_new_for_messages(cls, org, notification_type, user_messages):
+        """
+        Creates notifications of the given type for (user id, message id) pairs, ignoring pairs which already have one
+        """
+        user_messages = set(user_messages)
+        if not user_messages:
+            return []
+
+        existing = cls.objects.filter(org=org, type=notification_type, message__in={m for u, m in user_messages})
+        existing = set(existing.values_list("user_id", "message_id"))
+
+        return cls.objects.bulk_create(
+            [
+                cls(org=org, user_id=user_id, type=notification_type, message_id=message_id)
+                for user_id, message_id in sorted(user_messages - existing)
+            ]
+        )
+
     @classmethod
     def send_all(cls):
         unsent = cls.objects.filter(is_sent=False)
@@ -0,0 +1 @@
+default_app_config = "casepro.rules.apps.Config"
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class Config(AppConfig):
+    name = "casepro.rules"
+
+    def ready(self):
+        from . import signals  # noqa
@@ -0,0 +1,65 @@
+from dash.orgs.models import Org
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from casepro.rules.models import ContainsTest, Quantifier, Rule
+from casepro.utils import json_encode, row_to_str, row_width
+
+
+class Command(BaseCommand):
+    help = "Evaluates rules against an org's historical messages without applying their actions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("org_id", type=int, metavar="ORG", help="The org whose messages to evaluate rules against")
+        parser.add_argument(
+            "--keywords",
+            type=str,
+            nargs="*",
+            help="Keywords of a proposed rule to evaluate, instead of the org's existing rules",
+        )
+        parser.add_argument("--days", type=int, default=0, help="Maximum age of messages to evaluate in days")
+        parser.add_argument("--limit", type=int, default=0, help="Maximum number of messages to evaluate")
+        parser.add_argument("--samples", type=int, default=3, help="The number of matched messages to show per rule")
+
+    def handle(self, *args, **options):
+        org_id = int(options["org_id"])
+        try:
+            org = Org.objects.get(pk=org_id)
+        except Org.DoesNotExist:
+            raise CommandError("No such org with id %d" % org_id)
+
+        if options["keywords"]:
+            tests = [ContainsTest(options["keywords"], Quantifier.ANY)]
+            rules = [Rule(org=org, tests=json_encode(tests), actions=json_encode([]))]
+        else:
+            rules = list(Rule.get_all(org).order_by("pk"))
+
+        if not rules:
+            raise CommandError("No rules to evaluate")
+
+        since = timezone.now() - relativedelta(days=options["days"]) if options["days"] else None
+
+        result = Rule.backtest(org, rules, since=since, limit=options["limit"], num_samples=options["samples"])
+
+        self.stdout.write(
+            "Evaluated %d rules against %d messages in %.3f secs (%.3f secs scanning for keywords)\n"
+            % (len(rules), result["messages"], result["time"], result["scan_time"])
+        )
+
+        header = (("Rule", 8), ("Matches", 10), ("Time (secs)", 14), ("Tests", 60))
+        self.stdout.write(row_to_str(header))
+        self.stdout.write("=" * row_width(header))
+
+        for rule_result in result["rules"]:
+            rule = rule_result["rule"]
+            row = (
+                (rule.pk or "-", 8),
+                (rule_result["matches"], 10),
+                ("%.3f" % rule_result["time"], 14),
+                (rule.get_tests_description(), 60),
+            )
+            self.stdout.write(row_to_str(row))
+
+            for message in rule_result["samples"]:
+                self.stdout.write("    #%d: %s" % (message.backend_id, message.text))
@@ -0,0 +1,147 @@
+import random
+import string
+import time
+
+from dash.orgs.models import Org
+from django.core.management.base import BaseCommand
+
+from casepro.msgs.models import Message
+from casepro.rules.models import ContainsTest, FlagAction, MatchingPool, Quantifier, Rule
+from casepro.utils import json_encode, row_to_str, row_width
+
+DEFAULT_RULE_COUNTS = (10, 50, 100, 250, 500)
+DEFAULT_NUM_MESSAGES = 2000
+DEFAULT_POOL_MESSAGE_COUNTS = (500, 1000, 2000, 5000, 10000)
+DEFAULT_POOL_NUM_RULES = 250
+KEYWORDS_PER_RULE = 3
+WORDS_PER_MESSAGE = 20
+
+
+class Command(BaseCommand):
+    help = "Benchmarks rule matching throughput of the per-rule loop against the compiled batch processor"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rules", type=int, nargs="*", default=DEFAULT_RULE_COUNTS, help="The numbers of rules to test with"
+        )
+        parser.add_argument(
+            "--messages", type=int, default=DEFAULT_NUM_MESSAGES, help="The number of messages to match against"
+        )
+        parser.add_argument("--seed", type=int, default=1234, help="The seed for generating keywords and messages")
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=0,
+            help="The number of worker processes to compare in-process matching against (0 to skip)",
+        )
+        parser.add_argument(
+            "--pool-messages",
+            type=int,
+            nargs="*",
+            default=DEFAULT_POOL_MESSAGE_COUNTS,
+            help="The numbers of messages to compare in-process and pooled matching with",
+        )
+
+    def handle(self, *args, **options):
+        rand = random.Random(options["seed"])
+        vocabulary = [
+            "".join(rand.choice(string.ascii_lowercase) for c in range(rand.randint(3, 9))) for w in range(5000)
+        ]
+
+        messages = [
+            Message(pk=m + 1, text=" ".join(rand.sample(vocabulary, WORDS_PER_MESSAGE)))
+            for m in range(options["messages"])
+        ]
+
+        header = (("Rules", 8), ("Per-rule (msgs/sec)", 22), ("Compiled (msgs/sec)", 22), ("Speedup", 10))
+        self.stdout.write(row_to_str(header))
+        self.stdout.write("=" * row_width(header))
+
+        for num_rules in options["rules"]:
+            rules = [self.create_rule(rand.sample(vocabulary, KEYWORDS_PER_RULE)) for r in range(num_rules)]
+
+            looped_rate, looped_matches = self.time_per_rule_loop(rules, messages)
+            compiled_rate, compiled_matches = self.time_compiled(rules, messages)
+
+            if looped_matches != compiled_matches:  # pragma: no cover
+                self.stderr.write("Match counts differ: %d vs %d" % (looped_matches, compiled_matches))
+
+            row = (
+                (num_rules, 8),
+                ("%.1f" % looped_rate, 22),
+                ("%.1f" % compiled_rate, 22),
+                ("%.1fx" % (compiled_rate / looped_rate), 10),
+            )
+            self.stdout.write(row_to_str(row))
+
+        if options["processes"] > 1:
+            self.stdout.write("")
+            self.compare_pool(rand, vocabulary, options["processes"], options["pool_messages"])
+
+    def compare_pool(self, rand, vocabulary, processes, message_counts):
+        """
+        Compares in-process matching against matching sharded across a process pool for different numbers of messages,
+        to show the batch size at which sending messages to workers starts to pay off. As the pool is reused across the
+        batches of a run, its workers are started before timing.
+        """
+        rules = [self.create_rule(rand.sample(vocabulary, KEYWORDS_PER_RULE)) for r in range(DEFAULT_POOL_NUM_RULES)]
+
+        header = (
+            ("Messages", 10),
+            ("In-process (msgs/sec)", 24),
+            ("Pool x%d (msgs/sec)" % processes, 22),
+            ("Speedup", 10),
+        )
+        self.stdout.write(row_to_str(header))
+        self.stdout.write("=" * row_width(header))
+
+        with MatchingPool(processes) as pool:
+            pool.map(len, [[]] * processes)
+
+            for num_messages in message_counts:
+                messages = [
+                    Message(pk=m + 1, text=" ".join(rand.sample(vocabulary, WORDS_PER_MESSAGE)))
+                    for m in range(num_messages)
+                ]
+                in_process_rate, in_process_matches = self.time_compiled(rules, messages)
+                pool_rate, pool_matches = self.time_compiled(rules, messages, pool=pool)
+
+                if in_process_matches != pool_matches:  # pragma: no cover
+                    self.stderr.write("Match counts differ: %d vs %d" % (in_process_matches, pool_matches))
+
+                row = (
+                    (num_messages, 10),
+                    ("%.1f" % in_process_rate, 24),
+                    ("%.1f" % pool_rate, 22),
+                    ("%.1fx" % (pool_rate / in_process_rate), 10),
+                )
+                self.stdout.write(row_to_str(row))
+
+    @staticmethod
+    def create_rule(keywords):
+        """
+        Creates an unsaved rule so that benchmarking doesn't touch the database
+        """
+        tests = [ContainsTest(keywords, Quantifier.ANY)]
+        return Rule(org=Org(name="Benchmark"), tests=json_encode(tests), actions=json_encode([FlagAction()]))
+
+    @staticmethod
+    def time_per_rule_loop(rules, messages):
+        start = time.time()
+        num_matches = 0
+        for message in messages:
+            for rule in rules:
+                if rule.matches(message):
+                    num_matches += 1
+
+        return len(messages) / (time.time() - start), num_matches
+
+    @staticmethod
+    def time_compiled(rules, messages, pool=None):
+        start = time.time()
+        processor = Rule.BatchProcessor(None, rules)
+        processor.parallel_min_messages = 0
+
+        num_matches, num_actions = processor.include_messages(*messages, pool=pool)
+
+        return len(messages) / (time.time() - start), num_matches
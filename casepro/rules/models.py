@@ -1,13 +1,20 @@
 import json
+import logging
+import time
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from enum import Enum
+from functools import partial
 
 import regex
+from billiard.exceptions import WorkerLostError
+from billiard.pool import Pool
 from dash.orgs.models import Org
 from dash.utils import get_obj_cacheable
+from django.conf import settings
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
+from django_redis import get_redis_connection
 
 from casepro.contacts.models import Group
 from casepro.msgs.models import Label, Message
@@ -15,6 +22,13 @@ from casepro.utils import json_encode, normalize
 
 KEYWORD_REGEX = regex.compile(r"^\w[\w\- ]*\w$", flags=regex.UNICODE | regex.V0)
 
+RULES_VERSION_KEY = "org:%d:rules_version"
+RULES_CACHE_STATS_KEY = "rules:compiled_cache_stats"
+
+COMPILED_RULES_BY_ORG = {}  # process-wide cache of (rules version, rules, keyword set) tuples
+
+logger = logging.getLogger(__name__)
+
 
 class Quantifier(Enum):
     """
@@ -107,6 +121,13 @@ class Test(object):
         Subclasses must implement this to return a boolean.
         """
 
+    def matches_compact(self, compact, found_keywords):
+        """
+        Evaluates this test against a compact message, given the keywords already found in its text. Tests which only
+        look at the message text can be evaluated directly as compact messages also have text.
+        """
+        return self.matches(compact)
+
     def __eq__(self, other):  # pragma: no cover
         return other and self.TYPE == other.TYPE
 
@@ -146,6 +167,21 @@ class ContainsTest(Test):
 
         return self.quantifier.evaluate(checks)
 
+    def matches_keywords(self, found_keywords):
+        """
+        Evaluates this test against the set of keywords already found in the message text, e.g. by a KeywordSet
+        """
+
+        def keyword_check(w):
+            return lambda: w in found_keywords
+
+        checks = [keyword_check(keyword) for keyword in self.keywords]
+
+        return self.quantifier.evaluate(checks)
+
+    def matches_compact(self, compact, found_keywords):
+        return self.matches_keywords(found_keywords)
+
     @classmethod
     def is_valid_keyword(cls, keyword):
         return KEYWORD_REGEX.match(keyword)
@@ -159,6 +195,134 @@ class ContainsTest(Test):
         )
 
 
+class KeywordSet(object):
+    """
+    A set of keywords compiled into a single regular expression so that text can be scanned once to find all of the
+    keywords it contains, rather than searching for each keyword separately.
+    """
+
+    FLAGS = regex.UNICODE | regex.V0
+
+    def __init__(self, keywords):
+        # longest first so that where keywords share a prefix, the longest is tried first at each position
+        self.keywords = sorted(set(keywords), key=lambda k: (-len(k), k))
+
+        if self.keywords:
+            alternation = "|".join(regex.escape(k) for k in self.keywords)
+            self.regex = regex.compile(r"\b(?:" + alternation + r")\b", flags=self.FLAGS)
+        else:
+            self.regex = None
+
+        # a match of a longer keyword can hide matches of any shorter keywords which are its prefixes
+        self.prefixes = defaultdict(list)
+        for keyword in self.keywords:
+            for other in self.keywords:
+                if len(other) < len(keyword) and keyword.startswith(other):
+                    self.prefixes[keyword].append(other)
+
+        self.prefix_regexes = {}
+        for prefix in {p for prefixes in self.prefixes.values() for p in prefixes}:
+            self.prefix_regexes[prefix] = regex.compile(r"\b" + regex.escape(prefix) + r"\b", flags=self.FLAGS)
+
+    def find(self, text):
+        """
+        Finds all keywords in the given normalized text
+        """
+        found = set()
+
+        if not self.regex:
+            return found
+
+        for match in self.regex.finditer(text, overlapped=True):
+            keyword = match.group()
+            found.add(keyword)
+
+            for prefix in self.prefixes.get(keyword, ()):
+                if prefix not in found and self.prefix_regexes[prefix].match(text, match.start()):
+                    found.add(prefix)
+
+        return found
+
+
+class CompactMessage(namedtuple("CompactMessage", ("id", "text", "group_ids", "fields"))):
+    """
+    The values of a message and its contact that tests need, in a form that is cheap to send to another process. Group
+    ids and fields are only included if the rules being evaluated have tests which need them.
+    """
+
+    @classmethod
+    def from_message(cls, message, with_groups=True, with_fields=True):
+        group_ids = frozenset(g.pk for g in message.contact.groups.all()) if with_groups else frozenset()
+        fields = message.contact.fields if with_fields else None
+        return cls(message.pk, message.text, group_ids, fields)
+
+
+def match_compact_messages(tests_by_rule, keyword_set, compact_messages):
+    """
+    Matches compact messages against the tests of a list of rules. This is module level so that it can be called in a
+    worker process.
+    :return: list of tuples of message id and the indexes of the rules which matched it
+    """
+    matches = []
+    for compact in compact_messages:
+        found_keywords = keyword_set.find(normalize(compact.text))
+
+        rule_indexes = []
+        for r, tests in enumerate(tests_by_rule):
+            if all(test.matches_compact(compact, found_keywords) for test in tests):
+                rule_indexes.append(r)
+
+        if rule_indexes:
+            matches.append((compact.id, rule_indexes))
+
+    return matches
+
+
+class MatchingPool(object):
+    """
+    A pool of worker processes for matching rules, which is reused for every batch of a run, as starting workers costs
+    more than matching a typical batch. Workers are only started when first needed, and are started with billiard, which
+    unlike multiprocessing allows a daemonic Celery prefork worker to have children. If workers can't be started or one
+    is lost, then the pool is closed for good and matching falls back to in-process.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.pool = None
+        self.broken = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def is_available(self):
+        return self.processes > 1 and not self.broken
+
+    def map(self, func, shards):
+        """
+        Maps the given function over the given shards in the worker processes
+        :return: the list of results, or None if workers couldn't be started or were lost
+        """
+        try:
+            if self.pool is None:
+                self.pool = Pool(processes=self.processes)
+
+            return self.pool.map(func, shards)
+        except (OSError, WorkerLostError) as e:
+            logger.warning("Unable to match rules in process pool, falling back to in-process: %s" % str(e))
+            self.close()
+            self.broken = True
+            return None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
 class WordCountTest(Test):
     """
     Test that returns whether the message text contains at least the given number of words
@@ -220,6 +384,14 @@ class GroupsTest(Test):
 
         return self.quantifier.evaluate(checks)
 
+    def matches_compact(self, compact, found_keywords):
+        def group_check(g):
+            return lambda: g.pk in compact.group_ids
+
+        checks = [group_check(group) for group in self.groups]
+
+        return self.quantifier.evaluate(checks)
+
     def __eq__(self, other):
         return (
             other and self.TYPE == other.TYPE and self.groups == other.groups and self.quantifier == other.quantifier
@@ -249,8 +421,14 @@ class FieldTest(Test):
         return "contact.%s is %s %s" % (self.key, Quantifier.ANY, ", ".join(quoted_values))
 
     def matches(self, message):
-        if message.contact.fields:
-            contact_value = normalize(message.contact.fields.get(self.key, ""))
+        return self.matches_fields(message.contact.fields)
+
+    def matches_compact(self, compact, found_keywords):
+        return self.matches_fields(compact.fields)
+
+    def matches_fields(self, fields):
+        if fields:
+            contact_value = normalize(fields.get(self.key, ""))
 
             for value in self.values:
                 if value == contact_value:
@@ -295,6 +473,21 @@ class Action(object):
     def get_description(self):  # pragma: no cover
         pass
 
+    def apply_to(self, org, messages):
+        """
+        Applies this action to the given messages locally and then on the backend
+        """
+        self.apply_locally(org, messages)
+        self.apply_on_backend(org, messages)
+
+    @abstractmethod
+    def apply_locally(self, org, messages):  # pragma: no cover
+        pass
+
+    @abstractmethod
+    def apply_on_backend(self, org, messages):  # pragma: no cover
+        pass
+
     def __eq__(self, other):
         return self.TYPE == other.TYPE
 
@@ -325,10 +518,10 @@ class LabelAction(Action):
     def get_description(self):
         return "apply label '%s'" % self.label.name
 
-    def apply_to(self, org, messages):
-        for msg in messages:
-            msg.label(self.label)
+    def apply_locally(self, org, messages):
+        Message.label_all(org, messages, self.label)
 
+    def apply_on_backend(self, org, messages):
         if self.label.is_synced:
             org.get_backend().label_messages(org, messages, self.label)
 
@@ -356,9 +549,10 @@ class FlagAction(Action):
     def get_description(self):
         return "flag"
 
-    def apply_to(self, org, messages):
+    def apply_locally(self, org, messages):
         Message.objects.filter(pk__in=[m.pk for m in messages]).update(is_flagged=True)
 
+    def apply_on_backend(self, org, messages):
         org.get_backend().flag_messages(org, messages)
 
 
@@ -379,9 +573,10 @@ class ArchiveAction(Action):
     def get_description(self):
         return "archive"
 
-    def apply_to(self, org, messages):
+    def apply_locally(self, org, messages):
         Message.objects.filter(pk__in=[m.pk for m in messages]).update(is_archived=True)
 
+    def apply_on_backend(self, org, messages):
         org.get_backend().archive_messages(org, messages)
 
 
@@ -404,6 +599,129 @@ class Rule(models.Model):
     def get_all(cls, org):
         return org.rules.all()
 
+    @classmethod
+    def get_version(cls, org_id):
+        """
+        Gets the current version of an org's rules. If no version has been recorded, e.g. because Redis has been
+        flushed, one is initialized from the current time so that it can't match a previously cached version.
+        """
+        r = get_redis_connection()
+        key = RULES_VERSION_KEY % org_id
+
+        version = r.get(key)
+        if version is None:
+            r.setnx(key, int(time.time() * 1000))
+            version = r.get(key)
+
+        return int(version)
+
+    @classmethod
+    def bump_version(cls, org_id):
+        """
+        Invalidates any compiled copies of an org's rules
+        """
+        cls.get_version(org_id)  # ensure version is initialized before incrementing
+
+        get_redis_connection().incr(RULES_VERSION_KEY % org_id)
+
+    @classmethod
+    def get_batch_processor(cls, org):
+        """
+        Gets a batch processor for all of the given org's rules, reusing rules compiled by previous calls in this
+        process if they haven't changed since
+        """
+        r = get_redis_connection()
+        version = cls.get_version(org.pk)
+        cached = COMPILED_RULES_BY_ORG.get(org.pk)
+
+        if cached and cached[0] == version:
+            r.hincrby(RULES_CACHE_STATS_KEY, "hits")
+            rules, keyword_set = cached[1], cached[2]
+        else:
+            r.hincrby(RULES_CACHE_STATS_KEY, "misses")
+
+            rules = list(cls.get_all(org).order_by("pk"))
+            for rule in rules:
+                rule.org = org
+                rule.get_tests()
+                rule.get_actions()
+
+            keyword_set = KeywordSet([k for rule in rules for k in rule.get_keywords()])
+
+            COMPILED_RULES_BY_ORG[org.pk] = (version, rules, keyword_set)
+
+        return cls.BatchProcessor(org, rules, keyword_set)
+
+    @classmethod
+    def get_cache_stats(cls):
+        """
+        Gets the number of hits and misses on compiled rules across all processes
+        """
+        stats = get_redis_connection().hgetall(RULES_CACHE_STATS_KEY)
+        return {"hits": int(stats.get(b"hits", 0)), "misses": int(stats.get(b"misses", 0))}
+
+    @classmethod
+    def backtest(cls, org, rules, since=None, limit=None, num_samples=5, chunk_size=2000):
+        """
+        Evaluates rules against an org's historical messages, most recent first, without applying any of their actions.
+        Messages are streamed with a server-side cursor and contact groups are fetched a chunk at a time if needed.
+        :return: dict of number of messages and total time, time spent scanning for keywords, and for each rule, the
+            number of matched messages, a sample of matched messages and the time spent evaluating it
+        """
+        processor = cls.BatchProcessor(org, rules)
+        with_groups = any(isinstance(t, GroupsTest) for rule in rules for t in rule.get_tests())
+
+        messages = org.incoming_messages.filter(is_active=True).select_related("contact").order_by("-pk")
+        if since:
+            messages = messages.filter(created_on__gte=since)
+        if limit:
+            messages = messages[:limit]
+
+        num_messages = 0
+        scan_time = 0.0
+        results = [{"rule": rule, "matches": 0, "samples": [], "time": 0.0} for rule in rules]
+
+        start = time.perf_counter()
+
+        def evaluate_chunk(chunk):
+            nonlocal scan_time
+
+            if with_groups:
+                models.prefetch_related_objects(chunk, "contact__groups")
+
+            for message in chunk:
+                scan_start = time.perf_counter()
+                found_keywords = processor.keyword_set.find(normalize(message.text))
+                scan_time += time.perf_counter() - scan_start
+
+                for rule, result in zip(rules, results):
+                    rule_start = time.perf_counter()
+                    matches = rule.matches(message, found_keywords)
+                    result["time"] += time.perf_counter() - rule_start
+
+                    if matches:
+                        result["matches"] += 1
+                        if len(result["samples"]) < num_samples:
+                            result["samples"].append(message)
+
+        chunk = []
+        for message in messages.iterator(chunk_size=chunk_size):
+            chunk.append(message)
+            num_messages += 1
+
+            if len(chunk) == chunk_size:
+                evaluate_chunk(chunk)
+                chunk = []
+
+        evaluate_chunk(chunk)
+
+        return {
+            "messages": num_messages,
+            "time": time.perf_counter() - start,
+            "scan_time": scan_time,
+            "rules": results,
+        }
+
     def get_tests(self):
         return get_obj_cacheable(self, "_tests", lambda: self._get_tests())
 
@@ -422,12 +740,22 @@ class Rule(models.Model):
     def get_actions_description(self):
         return _(" and ").join([a.get_description() for a in self.get_actions()])
 
-    def matches(self, message):
+    def get_keywords(self):
+        """
+        Gets all keywords used by contains tests in this rule
         """
-        Returns whether this rule matches the given message, i.e. all of its tests match the message
+        return [k for t in self.get_tests() if isinstance(t, ContainsTest) for k in t.keywords]
+
+    def matches(self, message, found_keywords=None):
+        """
+        Returns whether this rule matches the given message, i.e. all of its tests match the message. If the keywords in
+        the message text have already been found, then contains tests are evaluated against those.
         """
         for test in self.get_tests():
-            if not test.matches(message):
+            if found_keywords is not None and isinstance(test, ContainsTest):
+                if not test.matches_keywords(found_keywords):
+                    return False
+            elif not test.matches(message):
                 return False
         return True
 
@@ -437,33 +765,99 @@ class Rule(models.Model):
         calls to the backend.
         """
 
-        def __init__(self, org, rules):
+        def __init__(self, org, rules, keyword_set=None):
             self.org = org
             self.rules = rules
             self.messages_by_action = defaultdict(set)
 
-        def include_messages(self, *messages):
+            # smaller batches are matched in-process as starting workers costs more
+            self.parallel_min_messages = getattr(settings, "RULES_PARALLEL_MIN_MESSAGES", 500)
+
+            # compile the keywords of all rules so each message's text only needs to be scanned once
+            if keyword_set is None:
+                keyword_set = KeywordSet([k for rule in self.rules for k in rule.get_keywords()])
+
+            self.keyword_set = keyword_set
+
+        def include_messages(self, *messages, pool=None):
             """
             Includes the given messages in this batch processing
             :param messages: the messages to include
+            :param pool: the matching pool to shard matching across, if there are enough messages
             :return: tuple of the number of rules matched, and the number of actions that will be performed
             """
             num_rules_matched = 0
             num_actions_deferred = 0
 
-            for message in messages:
-                for rule in self.rules:
-                    if rule.matches(message):
-                        num_rules_matched += 1
-                        for action in rule.get_actions():
-                            self.messages_by_action[action].add(message)
-                            num_actions_deferred += 1
+            if pool is not None and pool.is_available() and len(messages) >= self.parallel_min_messages:
+                matches = self.match_in_pool(messages, pool)
+            else:
+                matches = self.match_in_process(messages)
+
+            for message, rules in matches:
+                for rule in rules:
+                    num_rules_matched += 1
+                    for action in rule.get_actions():
+                        self.messages_by_action[action].add(message)
+                        num_actions_deferred += 1
 
             return num_rules_matched, num_actions_deferred
 
+        def match_in_process(self, messages):
+            """
+            Matches messages against the rules in this process
+            :return: list of tuples of message and matching rules
+            """
+            matches = []
+            for message in messages:
+                found_keywords = self.keyword_set.find(normalize(message.text))
+
+                rules = [rule for rule in self.rules if rule.matches(message, found_keywords)]
+                if rules:
+                    matches.append((message, rules))
+
+            return matches
+
+        def match_in_pool(self, messages, pool):
+            """
+            Matches messages against the rules by sharding them across the workers of a matching pool. Workers are only
+            sent the rule tests, the keyword set and compact messages, and only return message ids and rule indexes.
+            :return: list of tuples of message and matching rules
+            """
+            tests_by_rule = [rule.get_tests() for rule in self.rules]
+            all_tests = [t for tests in tests_by_rule for t in tests]
+            with_groups = any(isinstance(t, GroupsTest) for t in all_tests)
+            with_fields = any(isinstance(t, FieldTest) for t in all_tests)
+
+            compacts = [CompactMessage.from_message(m, with_groups, with_fields) for m in messages]
+
+            # one contiguous shard per worker so that the rules are only sent to each worker once
+            shard_size = -(-len(compacts) // pool.processes)
+            shards = [compacts[s : s + shard_size] for s in range(0, len(compacts), shard_size)]
+
+            shard_matches = pool.map(partial(match_compact_messages, tests_by_rule, self.keyword_set), shards)
+            if shard_matches is None:
+                return self.match_in_process(messages)
+
+            messages_by_id = {m.pk: m for m in messages}
+            matches = []
+            for shard in shard_matches:
+                for message_id, rule_indexes in shard:
+                    matches.append((messages_by_id[message_id], [self.rules[r] for r in rule_indexes]))
+
+            return matches
+
         def apply_actions(self):
             """
-            Applies the actions gathered by this processor
+            Applies the actions gathered by this processor locally and then on the backend
             """
+            self.apply_actions_locally()
+            self.apply_actions_on_backend()
+
+        def apply_actions_locally(self):
+            for action, messages in self.messages_by_action.items():
+                action.apply_locally(self.org, messages)
+
+        def apply_actions_on_backend(self):
             for action, messages in self.messages_by_action.items():
-                action.apply_to(self.org, messages)
+                action.apply_on_backend(self.org, messages)
@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from casepro.contacts.models import Group
+from casepro.msgs.models import Label
+
+from .models import Rule
+
+
+@receiver([post_save, post_delete], sender=Rule)
+@receiver([post_save, post_delete], sender=Label)
+@receiver([post_save, post_delete], sender=Group)
+def invalidate_compiled_rules(sender, instance, **kwargs):
+    """
+    Rules, the labels they apply and the groups they test are compiled and cached by workers, so any change to them
+    must invalidate that
+    """
+    Rule.bump_version(instance.org_id)
@@ -1,8 +1,12 @@
-from django.urls import reverse
 from unittest.mock import call, patch
 
+from billiard.exceptions import WorkerLostError
+from billiard.pool import Pool
+from django.urls import reverse
+
 from casepro.msgs.models import Message
 from casepro.test import BaseCasesTest
+from casepro.utils import json_encode, normalize
 
 from .models import (
     Action,
@@ -12,7 +16,9 @@ from .models import (
     FieldTest,
     FlagAction,
     GroupsTest,
+    KeywordSet,
     LabelAction,
+    MatchingPool,
     Quantifier,
     Rule,
     Test,
@@ -132,6 +138,38 @@ class TestsTest(BaseCasesTest):
         self.assertFalse(ContainsTest.is_valid_keyword("kat-"))  # can't end with a dash
 
 
+class KeywordSetTest(BaseCasesTest):
+    def test_find(self):
+        keywords = KeywordSet(["kit", "kit kat", "kat", "kit-kat wrapper", "tú", "kit"])
+        self.assertEqual(keywords.keywords, ["kit-kat wrapper", "kit kat", "kat", "kit", "tú"])
+
+        self.assertEqual(keywords.find(""), set())
+        self.assertEqual(keywords.find("kits and kats"), set())
+        self.assertEqual(keywords.find("kit"), {"kit"})
+        self.assertEqual(keywords.find("a kit kat bar"), {"kit kat", "kit", "kat"})
+        self.assertEqual(keywords.find("kit kats"), {"kit"})
+        self.assertEqual(keywords.find("my kit-kat wrapper"), {"kit-kat wrapper", "kit", "kat"})
+        self.assertEqual(keywords.find("y tú?"), {"tú"})
+
+        self.assertEqual(KeywordSet([]).find("kit"), set())
+
+    def test_matches_per_rule_tests(self):
+        tests = [
+            ContainsTest(["aids", "hiv"], Quantifier.ANY),
+            ContainsTest(["aids", "hiv"], Quantifier.ALL),
+            ContainsTest(["aids", "hiv"], Quantifier.NONE),
+            ContainsTest(["hiv aids", "hiv"], Quantifier.ALL),
+        ]
+        keywords = KeywordSet([k for t in tests for k in t.keywords])
+
+        for text in ("What is AIDS?", "HIV/AIDS", "hiv aids", "barmaids", "HIV+"):
+            found = keywords.find(normalize(text))
+
+            for test in tests:
+                msg = Message(text=text)
+                self.assertEqual(test.matches_keywords(found), test.matches(msg), "mismatch for '%s'" % text)
+
+
 class ActionsTest(BaseCasesTest):
     def setUp(self):
         super(ActionsTest, self).setUp()
@@ -199,6 +237,75 @@ class RuleTest(BaseCasesTest):
         self.assertEqual(rules[1].get_tests(), [ContainsTest(["pregnant", "pregnancy"], Quantifier.ANY)])
         self.assertEqual(rules[1].get_actions(), [LabelAction(self.pregnancy)])
 
+    def test_get_batch_processor(self):
+        def assertCacheStats(hits, misses):
+            self.assertEqual(
+                Rule.get_cache_stats(), {"hits": start["hits"] + hits, "misses": start["misses"] + misses}
+            )
+
+        start = Rule.get_cache_stats()
+
+        processor1 = Rule.get_batch_processor(self.unicef)
+        self.assertEqual(len(processor1.rules), 3)
+        self.assertEqual(processor1.keyword_set.keywords, ["pregnancy", "pregnant", "aids", "chai", "hiv", "tea"])
+        assertCacheStats(hits=0, misses=1)
+
+        # rules are reused until they change
+        with self.assertNumQueries(0):
+            processor2 = Rule.get_batch_processor(self.unicef)
+
+        self.assertEqual(processor2.rules, processor1.rules)
+        self.assertEqual(processor2.keyword_set, processor1.keyword_set)
+        self.assertEqual(len(processor2.messages_by_action), 0)
+        assertCacheStats(hits=1, misses=1)
+
+        # rules of other orgs are cached separately
+        Rule.get_batch_processor(self.nyaruka)
+        Rule.get_batch_processor(self.unicef)
+        assertCacheStats(hits=2, misses=2)
+
+        # changing a rule invalidates the cache for that org
+        self.tea.update_tests([ContainsTest(["tea", "coffee"], Quantifier.ANY)])
+
+        processor3 = Rule.get_batch_processor(self.unicef)
+        self.assertIn("coffee", processor3.keyword_set.keywords)
+        assertCacheStats(hits=2, misses=3)
+
+        Rule.get_batch_processor(self.nyaruka)
+        assertCacheStats(hits=3, misses=3)
+
+        # as does changing a label or adding a new rule
+        self.aids.name = "HIV/AIDS"
+        self.aids.save(update_fields=("name",))
+
+        processor4 = Rule.get_batch_processor(self.unicef)
+        self.assertEqual(processor4.rules[0].get_actions()[0].label.name, "HIV/AIDS")
+        assertCacheStats(hits=3, misses=4)
+
+        self.create_rule(self.unicef, [ContainsTest(["sida"], Quantifier.ANY)], [FlagAction()])
+
+        processor5 = Rule.get_batch_processor(self.unicef)
+        self.assertEqual(len(processor5.rules), 4)
+        assertCacheStats(hits=3, misses=5)
+
+        # and so does changing a group which a rule tests
+        group_rule = self.create_rule(self.unicef, [GroupsTest([self.females], Quantifier.ANY)], [FlagAction()])
+        Rule.get_batch_processor(self.unicef)
+        assertCacheStats(hits=3, misses=6)
+
+        self.females.name = "Women"
+        self.females.save(update_fields=("name",))
+
+        processor6 = Rule.get_batch_processor(self.unicef)
+        group_test = [r for r in processor6.rules if r.pk == group_rule.pk][0].get_tests()[0]
+        self.assertEqual(group_test.groups[0].name, "Women")
+        assertCacheStats(hits=3, misses=7)
+
+        self.females.delete()
+
+        Rule.get_batch_processor(self.unicef)
+        assertCacheStats(hits=3, misses=8)
+
     def test_get_tests_description(self):
         rule = self.create_rule(
             self.unicef,
@@ -245,6 +352,7 @@ class RuleTest(BaseCasesTest):
         )
 
         processor = Rule.BatchProcessor(self.unicef, [rule1, rule2, rule3])
+        self.assertEqual(processor.keyword_set.keywords, ["pregnancy", "pregnant", "aids", "sida", "hiv"])
 
         self.assertEqual(processor.include_messages(*all_messages), (7, 12))
 
@@ -266,6 +374,111 @@ class RuleTest(BaseCasesTest):
 
         self.assertEqual(set(Message.objects.filter(is_archived=True)), {msg3, msg4})
 
+    def test_batch_processor_in_pool(self):
+        bob = self.create_contact(self.unicef, "C-002", "Bob", groups=[self.males], fields={"state": "Kigali"})
+        msg1 = self.create_message(self.unicef, 101, self.ann, "What is AIDS?")
+        msg2 = self.create_message(self.unicef, 102, bob, "What is AIDS?")
+        msg3 = self.create_message(self.unicef, 103, bob, "I'm pregnant, how many words is this")
+        msg4 = self.create_message(self.unicef, 104, self.ann, "Nothing to see here")
+        all_messages = [msg1, msg2, msg3, msg4]
+
+        rule1 = self.create_rule(
+            self.unicef,
+            [ContainsTest(["aids"], Quantifier.ANY), GroupsTest([self.males], Quantifier.ANY)],
+            [LabelAction(self.aids)],
+        )
+        rule2 = self.create_rule(self.unicef, [FieldTest("state", ["kigali"]), WordCountTest(5)], [FlagAction()])
+        rule3 = self.create_rule(self.unicef, [ContainsTest(["pregnant"], Quantifier.ANY)], [ArchiveAction()])
+
+        processor = Rule.BatchProcessor(self.unicef, [rule1, rule2, rule3])
+        processor.parallel_min_messages = 2
+
+        # processes are only used for batches which are large enough
+        with patch("casepro.rules.models.Pool") as mock_pool, MatchingPool(2) as pool:
+            self.assertEqual(processor.include_messages(msg1, pool=pool), (0, 0))
+            self.assertEqual(processor.include_messages(*all_messages), (3, 3))
+            mock_pool.assert_not_called()
+
+        # the same workers are used for every batch until the pool is closed
+        with patch("casepro.rules.models.Pool", wraps=Pool) as mock_pool, MatchingPool(2) as pool:
+            for b in range(2):
+                pooled = Rule.BatchProcessor(self.unicef, [rule1, rule2, rule3])
+                pooled.parallel_min_messages = 2
+
+                self.assertEqual(pooled.include_messages(*all_messages, pool=pool), (3, 3))
+                self.assertEqual(pooled.messages_by_action, processor.messages_by_action)
+
+            mock_pool.assert_called_once_with(processes=2)
+
+        self.assertIsNone(pool.pool)
+
+        # if workers can't be started, matching falls back to in-process for the rest of the run
+        with patch("casepro.rules.models.Pool") as mock_pool, MatchingPool(2) as pool:
+            mock_pool.side_effect = OSError("Cannot allocate memory")
+
+            fallback = Rule.BatchProcessor(self.unicef, [rule1, rule2, rule3])
+            fallback.parallel_min_messages = 2
+
+            with self.assertLogs("casepro.rules.models", level="WARNING"):
+                self.assertEqual(fallback.include_messages(*all_messages, pool=pool), (3, 3))
+
+            self.assertEqual(fallback.messages_by_action, processor.messages_by_action)
+            self.assertFalse(pool.is_available())
+
+            fallback.include_messages(*all_messages, pool=pool)
+
+            mock_pool.assert_called_once_with(processes=2)
+
+        # as does losing a worker
+        with patch("casepro.rules.models.Pool") as mock_pool, MatchingPool(2) as pool:
+            mock_pool.return_value.map.side_effect = WorkerLostError("Worker exited prematurely")
+
+            with self.assertLogs("casepro.rules.models", level="WARNING"):
+                self.assertEqual(fallback.include_messages(*all_messages, pool=pool), (3, 3))
+
+            self.assertFalse(pool.is_available())
+            mock_pool.return_value.terminate.assert_called_once_with()
+
+    def test_backtest(self):
+        bob = self.create_contact(self.unicef, "C-002", "Bob", groups=[self.males])
+        msg1 = self.create_message(self.unicef, 101, self.ann, "What is AIDS?", is_handled=True)
+        msg2 = self.create_message(self.unicef, 102, bob, "I have AIDS", is_handled=True)
+        self.create_message(self.unicef, 103, bob, "I'm pregnant")
+        msg4 = self.create_message(self.unicef, 104, bob, "aids aids aids")
+        self.create_message(self.unicef, 105, bob, "Deleted AIDS", is_active=False)
+        self.create_message(self.nyaruka, 106, self.create_contact(self.nyaruka, "C-003", "Che"), "AIDS")
+
+        rule1 = Rule(org=self.unicef, tests=json_encode([ContainsTest(["aids"], Quantifier.ANY)]), actions="[]")
+        rule2 = self.create_rule(
+            self.unicef,
+            [ContainsTest(["aids"], Quantifier.ANY), GroupsTest([self.males], Quantifier.ANY)],
+            [FlagAction()],
+        )
+
+        # one query to load rule groups, one server-side cursor, and one query per chunk to fetch contact groups
+        with self.assertNumQueries(4):
+            result = Rule.backtest(self.unicef, [rule1, rule2], num_samples=2, chunk_size=2)
+
+        self.assertEqual(result["messages"], 4)
+        self.assertEqual(result["rules"][0]["rule"], rule1)
+        self.assertEqual(result["rules"][0]["matches"], 3)
+        self.assertEqual(result["rules"][0]["samples"], [msg4, msg2])
+        self.assertEqual(result["rules"][1]["matches"], 2)
+        self.assertEqual(result["rules"][1]["samples"], [msg4, msg2])
+
+        # actions aren't applied
+        self.assertFalse(Message.objects.filter(is_flagged=True).exists())
+
+        result = Rule.backtest(self.unicef, [rule1], limit=3, num_samples=5)
+
+        self.assertEqual(result["messages"], 3)
+        self.assertEqual(result["rules"][0]["samples"], [msg4, msg2])
+
+        result = Rule.backtest(self.unicef, [rule1], since=msg1.created_on)
+
+        self.assertEqual(result["messages"], 4)
+        self.assertEqual(result["rules"][0]["matches"], 3)
+
 
 class RuleCRUDLTest(BaseCasesTest):
     def test_list(self):
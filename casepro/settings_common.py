@@ -71,12 +71,23 @@ JUNEBUG_FROM_ADDRESS = None
 JUNEBUG_HUB_BASE_URL = None
 JUNEBUG_HUB_AUTH_TOKEN = None
 
+JUNEBUG_SEND_WORKERS = 8  # number of threads used to send outgoing messages concurrently
+JUNEBUG_SEND_RETRIES = 3  # number of times a send is retried after a timeout, connection error or server error
+JUNEBUG_SEND_TIMEOUT = 10  # seconds to wait for Junebug to accept each outgoing message
+
+JUNEBUG_INBOUND_QUEUED = False  # whether inbound messages are queued and created by a task rather than by the webhook
+JUNEBUG_INBOUND_BATCH_SIZE = 500  # number of queued inbound messages created together
+JUNEBUG_INBOUND_TIME_LIMIT = 5 * 60  # seconds after which an ingest run stops, leaving remaining messages for the next
+
 # identity store configuration
 IDENTITY_API_ROOT = "http://localhost:8081/"
 IDENTITY_AUTH_TOKEN = "replace-with-auth-token"
 IDENTITY_ADDRESS_TYPE = "msisdn"
 IDENTITY_STORE_OPTOUT_URL = r"^junebug/optout$"
 IDENTITY_LANGUAGE_FIELD = "language"
+IDENTITY_CACHE_TTL = 300  # seconds for which identities and their addresses are cached (0 to not cache)
+IDENTITY_CACHE_SIZE = 10000  # maximum number of identities and address lists cached per process
+IDENTITY_RESOLVE_WORKERS = 8  # number of threads used to resolve the addresses of many identities at once
 
 # On Unix systems, a value of None will cause Django to use the same
 # timezone as the operating system.
@@ -426,12 +437,38 @@ CELERYBEAT_SCHEDULE = {
         "schedule": timedelta(minutes=1),
         "args": ("casepro.msgs.tasks.handle_messages", "sync"),
     },
+    "junebug-ingest": {  # only scheduled if JUNEBUG_INBOUND_QUEUED is enabled, see casepro.celery
+        "task": "dash.orgs.tasks.trigger_org_task",
+        "schedule": timedelta(minutes=1),
+        "args": ("casepro.msgs.tasks.ingest_junebug_messages", "sync"),
+    },
+    "outbox-push": {  # only scheduled if OUTBOX_ENABLED is enabled, see casepro.celery
+        "task": "dash.orgs.tasks.trigger_org_task",
+        "schedule": timedelta(minutes=1),
+        "args": ("casepro.msgs.tasks.push_outbox", "sync"),
+    },
     "squash-counts": {"task": "casepro.statistics.tasks.squash_counts", "schedule": timedelta(minutes=5)},
     "send-notifications": {"task": "casepro.profiles.tasks.send_notifications", "schedule": timedelta(minutes=1)},
 }
 
 CELERY_TIMEZONE = "UTC"
 
+HANDLE_MESSAGES_BATCH_SIZE = 500  # number of messages handled and committed together
+HANDLE_MESSAGES_TIME_LIMIT = 60 * 60  # seconds after which a run stops and leaves remaining messages for the next
+HANDLE_MESSAGES_RULE_PROCESSES = 1  # number of worker processes to match rules across for large enough batches
+RULES_PARALLEL_MIN_MESSAGES = 500  # batches smaller than this are matched in-process, so keep <= batch size
+SQUASH_BATCH_SIZE = 100000  # number of count row ids squashed by each statement
+COUNT_BUFFER_SIZE = 1000  # number of distinct daily counts buffered by tasks before they are written
+CHART_CACHE_TTL = 7 * 24 * 60 * 60  # seconds for which chart totals of past days are cached if not invalidated
+OUTBOX_ENABLED = False  # whether outgoing messages are pushed to the backend by a task rather than during the request
+OUTBOX_BATCH_SIZE = 100  # number of outbox messages pushed together, with identical texts pushed as broadcasts
+OUTBOX_MAX_ATTEMPTS = 5  # number of times pushing an outbox message is attempted before it's marked as failed
+PULL_MESSAGES_IN_BULK = True  # whether pulled pages of messages are synced with bulk queries rather than per message
+PULL_CONTACT_GROUPS_IN_BULK = True  # whether group memberships of pulled contacts are reconciled a page at a time
+PULL_PREFETCH_DEPTH = 2  # number of pages fetched ahead in the background during pulls (0 to fetch in turn)
+PULL_SLICE_DAYS = 7  # pull windows longer than this are pulled in slices of this many days, oldest first
+PULL_TIME_LIMIT = 60 * 60  # seconds after which a pull stops starting new slices, leaving the rest to the next run
+
 # -----------------------------------------------------------------------------------
 # Django Compressor configuration
 # -----------------------------------------------------------------------------------
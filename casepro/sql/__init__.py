@@ -5,13 +5,22 @@ from django.db.migrations import RunSQL
 
 class InstallSQL(RunSQL):
     """
-    Migration that reads the SQL from the named file and runs it as a RunSQL migration
+    Migration that reads the SQL from the named file and runs it as a RunSQL migration, optionally only on servers of
+    at least the given PostgreSQL version (e.g. 100000 for 10.0)
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, min_pg_version=None):
         # build the full path to our filename
         sql_path = os.path.join(os.path.dirname(__file__), "%s.sql" % filename)
         with open(sql_path) as sql_file:
             sql = sql_file.read()
 
+        self.min_pg_version = min_pg_version
+
         super(InstallSQL, self).__init__(sql)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if self.min_pg_version and schema_editor.connection.pg_version < self.min_pg_version:
+            return
+
+        super(InstallSQL, self).database_forwards(app_label, schema_editor, from_state, to_state)
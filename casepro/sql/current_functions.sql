@@ -1,4 +1,4 @@
--- Generated by collect_sql on 2017-11-20 15:31 UTC
+-- Generated by collect_sql on 2026-10-18 03:45 UTC
 
 ----------------------------------------------------------------------
 -- Utility function to check whether message belongs in archived folder
@@ -64,6 +64,61 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+----------------------------------------------------------------------
+-- Trigger function to maintain label counts and message.has_labels when labels are removed, with a single count
+-- per label for each statement
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_labels_on_delete() RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE msgs_message m SET has_labels = FALSE
+  FROM (SELECT DISTINCT message_id FROM oldtab) o
+  WHERE m.id = o.message_id AND m.has_labels = TRUE
+    AND NOT EXISTS (SELECT 1 FROM msgs_message_labels ml WHERE ml.message_id = o.message_id);
+
+  INSERT INTO statistics_totalcount("item_type", "scope", "count")
+  SELECT c.item_type, 'label:' || d.label_id, c.delta
+  FROM (
+    SELECT o.label_id,
+           -COUNT(*) FILTER (WHERE msgs_is_inbox(m)) AS inbox_delta,
+           -COUNT(*) FILTER (WHERE msgs_is_archived(m)) AS archived_delta
+    FROM oldtab o
+    INNER JOIN msgs_message m ON m.id = o.message_id
+    GROUP BY o.label_id
+  ) d
+  CROSS JOIN LATERAL (VALUES ('N', d.inbox_delta), ('A', d.archived_delta)) AS c(item_type, delta)
+  WHERE c.delta != 0;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger function to maintain label counts and message.has_labels when labels are applied, with a single count
+-- per label for each statement
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_labels_on_insert() RETURNS TRIGGER AS $$
+BEGIN
+  UPDATE msgs_message m SET has_labels = TRUE
+  FROM (SELECT DISTINCT message_id FROM newtab) n
+  WHERE m.id = n.message_id AND m.has_labels = FALSE;
+
+  INSERT INTO statistics_totalcount("item_type", "scope", "count")
+  SELECT c.item_type, 'label:' || d.label_id, c.delta
+  FROM (
+    SELECT n.label_id,
+           COUNT(*) FILTER (WHERE msgs_is_inbox(m)) AS inbox_delta,
+           COUNT(*) FILTER (WHERE msgs_is_archived(m)) AS archived_delta
+    FROM newtab n
+    INNER JOIN msgs_message m ON m.id = n.message_id
+    GROUP BY n.label_id
+  ) d
+  CROSS JOIN LATERAL (VALUES ('N', d.inbox_delta), ('A', d.archived_delta)) AS c(item_type, delta)
+  WHERE c.delta != 0;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
 ----------------------------------------------------------------------
 -- Trigger function to maintain label counts
 ----------------------------------------------------------------------
@@ -106,3 +161,35 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+----------------------------------------------------------------------
+-- Trigger function to maintain label counts when messages move between folders, with a single count per label for
+-- each statement
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION msgs_message_on_update() RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO statistics_totalcount("item_type", "scope", "count")
+  SELECT c.item_type, 'label:' || d.label_id, c.delta
+  FROM (
+    SELECT ml.label_id,
+           SUM(f.new_inbox::INT - f.old_inbox::INT) AS inbox_delta,
+           SUM(f.new_archived::INT - f.old_archived::INT) AS archived_delta
+    FROM (
+      SELECT n.id,
+             NOT o.is_archived AND o.is_handled AND o.is_active AS old_inbox,
+             NOT n.is_archived AND n.is_handled AND n.is_active AS new_inbox,
+             o.is_archived AND o.is_handled AND o.is_active AS old_archived,
+             n.is_archived AND n.is_handled AND n.is_active AS new_archived
+      FROM newtab n
+      INNER JOIN oldtab o ON o.id = n.id
+    ) f
+    INNER JOIN msgs_message_labels ml ON ml.message_id = f.id
+    WHERE f.old_inbox != f.new_inbox OR f.old_archived != f.new_archived
+    GROUP BY ml.label_id
+  ) d
+  CROSS JOIN LATERAL (VALUES ('N', d.inbox_delta), ('A', d.archived_delta)) AS c(item_type, delta)
+  WHERE c.delta != 0;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
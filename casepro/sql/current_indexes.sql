@@ -1,4 +1,4 @@
--- Generated by collect_sql on 2017-11-20 19:44 UTC
+-- Generated by collect_sql on 2026-10-18 03:45 UTC
 
 CREATE INDEX cases_closed
 ON cases_case(org_id, assignee_id, opened_on DESC)
@@ -39,6 +39,8 @@ CREATE INDEX msgs_messageaction_messages_idx ON msgs_messageaction USING GIN ("m
 CREATE INDEX msgs_outgoing_org_partner_created
 ON msgs_outgoing(org_id, partner_id, created_on DESC);
 
+CREATE INDEX msgs_outgoing_org_pending ON msgs_outgoing(org_id, id) WHERE is_pending = TRUE;
+
 CREATE INDEX msgs_unlabelled_inbox
 ON msgs_message(org_id, created_on DESC)
 WHERE is_active = TRUE AND is_handled = TRUE AND is_archived = FALSE AND "type" = 'I' AND has_labels = FALSE;
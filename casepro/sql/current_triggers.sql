@@ -1,14 +1,18 @@
--- Generated by collect_sql on 2017-11-20 15:31 UTC
+-- Generated by collect_sql on 2026-10-18 03:45 UTC
 
-CREATE TRIGGER msgs_message_labels_on_change_trg
-   AFTER INSERT OR DELETE ON msgs_message_labels
-   FOR EACH ROW EXECUTE PROCEDURE msgs_message_labels_on_change();
+CREATE TRIGGER msgs_message_labels_on_delete_trg
+   AFTER DELETE ON msgs_message_labels REFERENCING OLD TABLE AS oldtab
+   FOR EACH STATEMENT EXECUTE PROCEDURE msgs_message_labels_on_delete();
+
+CREATE TRIGGER msgs_message_labels_on_insert_trg
+   AFTER INSERT ON msgs_message_labels REFERENCING NEW TABLE AS newtab
+   FOR EACH STATEMENT EXECUTE PROCEDURE msgs_message_labels_on_insert();
 
 CREATE TRIGGER msgs_message_labels_on_truncate_trg
   AFTER TRUNCATE ON msgs_message_labels
   EXECUTE PROCEDURE msgs_message_labels_on_change();
 
-CREATE TRIGGER msgs_message_on_change_trg
-   AFTER UPDATE ON msgs_message
-   FOR EACH ROW EXECUTE PROCEDURE msgs_message_on_change();
+CREATE TRIGGER msgs_message_on_update_trg
+   AFTER UPDATE ON msgs_message REFERENCING OLD TABLE AS oldtab NEW TABLE AS newtab
+   FOR EACH STATEMENT EXECUTE PROCEDURE msgs_message_on_update();
 
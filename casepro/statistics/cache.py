@@ -0,0 +1,213 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django_redis import get_redis_connection
+
+from casepro.utils import json_encode
+
+from .models import TotalCount
+
+CHART_CACHE_KEY = "chart:%s:%d:%s"
+CHART_SCOPE_VERSIONS_KEY = "chart-scope-versions"
+CHART_CACHE_STATS_KEY = "chart-cache-stats"
+
+LABEL_TOTALS_KEY = "label-totals"
+LABEL_TOTALS_LOCK_KEY = "lock:label-totals"
+LABEL_TOTALS_LOCK_SECONDS = 60
+LABEL_TOTALS_LOCK_WAIT = 2
+LABEL_TOTALS_SQUASH_LOCK_SECONDS = 600
+LABEL_TOTALS_PENDING_KEY = "label-totals-pending"
+LABEL_TOTALS_RECONCILED_FIELD = "reconciled"
+LABEL_TOTALS_ITEM_TYPES = (TotalCount.TYPE_INBOX, TotalCount.TYPE_ARCHIVED)
+
+
+def get_cached_totals(chart, org, counts, since, until, calculate):
+    """
+    Gets totals calculated over a set of daily counts for a range of past days, which are cached until counts in any of
+    the set's scopes are next squashed
+    :param chart: the name of the chart the totals are for
+    :param counts: the count set, which must be limited to the given range
+    :param calculate: function which calculates the totals from the count set
+    """
+    r = get_redis_connection()
+
+    scopes = sorted(counts.scopes.keys())
+    versions = r.hmget(CHART_SCOPE_VERSIONS_KEY, scopes) if scopes else []
+    versions = [int(v) if v else 0 for v in versions]
+
+    fingerprint = hashlib.md5(json_encode([scopes, versions, str(since), str(until)]).encode("utf-8")).hexdigest()
+    key = CHART_CACHE_KEY % (chart, org.pk, fingerprint)
+
+    totals = cache.get(key)
+    r.hincrby(CHART_CACHE_STATS_KEY, "%s:%s" % (chart, "misses" if totals is None else "hits"))
+
+    if totals is None:
+        totals = calculate(counts)
+        cache.set(key, totals, getattr(settings, "CHART_CACHE_TTL", 7 * 24 * 60 * 60))
+
+    return totals
+
+
+def invalidate_cached_totals(scopes):
+    """
+    Invalidates all cached totals which include any of the given encoded scopes
+    """
+    if not scopes:
+        return
+
+    pipe = get_redis_connection().pipeline()
+    for scope in scopes:
+        pipe.hincrby(CHART_SCOPE_VERSIONS_KEY, scope, 1)
+    pipe.execute()
+
+
+def get_chart_cache_stats():
+    """
+    Gets the number of hits and misses of cached totals for each chart, and its hit rate
+    """
+    counts = {k.decode("utf-8"): int(v) for k, v in get_redis_connection().hgetall(CHART_CACHE_STATS_KEY).items()}
+
+    stats = {}
+    for key, count in counts.items():
+        chart, outcome = key.rsplit(":", 1)
+        stats.setdefault(chart, {"hits": 0, "misses": 0})[outcome] = count
+
+    for chart_stats in stats.values():
+        chart_stats["hit_rate"] = round(float(chart_stats["hits"]) / (chart_stats["hits"] + chart_stats["misses"]), 3)
+
+    return stats
+
+
+def get_label_totals(labels):
+    """
+    Gets the inbox and archived totals of the given labels from the cached label totals, building those from the
+    database if they don't exist. If that can't be done without waiting, e.g. because counts are being squashed, then
+    the totals are aggregated from the database instead.
+    :return: dict of totals by label for each item type
+    """
+    r = get_redis_connection()
+    fields = [LABEL_TOTALS_RECONCILED_FIELD]
+    fields += [_label_totals_field(item_type, label) for item_type in LABEL_TOTALS_ITEM_TYPES for label in labels]
+
+    values = r.hmget(LABEL_TOTALS_KEY, fields)
+
+    if values[0] is None:
+        lock = r.lock(LABEL_TOTALS_LOCK_KEY, timeout=LABEL_TOTALS_LOCK_SECONDS)
+        if not lock.acquire(blocking_timeout=LABEL_TOTALS_LOCK_WAIT):
+            return _get_label_totals_from_db(labels)
+
+        try:
+            if not r.hexists(LABEL_TOTALS_KEY, LABEL_TOTALS_RECONCILED_FIELD):
+                reconcile_label_totals()
+        finally:
+            lock.release()
+
+        values = r.hmget(LABEL_TOTALS_KEY, fields)
+
+    totals = {item_type: {} for item_type in LABEL_TOTALS_ITEM_TYPES}
+    values = iter(values[1:])
+    for item_type in LABEL_TOTALS_ITEM_TYPES:
+        for label in labels:
+            value = next(values)
+            totals[item_type][label] = int(value) if value is not None else 0
+
+    return totals
+
+
+def _get_label_totals_from_db(labels):
+    return {
+        item_type: TotalCount.get_by_label(labels, item_type).scope_totals() for item_type in LABEL_TOTALS_ITEM_TYPES
+    }
+
+
+def update_label_totals():
+    """
+    Adds counts which haven't yet been added to the cached label totals to them. If another process holds the label
+    totals lock, e.g. because it's squashing counts, the update is left to that process once it's done.
+    """
+    r = get_redis_connection()
+    r.set(LABEL_TOTALS_PENDING_KEY, 1)
+
+    while True:
+        lock = r.lock(LABEL_TOTALS_LOCK_KEY, timeout=LABEL_TOTALS_LOCK_SECONDS)
+        if not lock.acquire(blocking=False):
+            return
+
+        try:
+            while r.delete(LABEL_TOTALS_PENDING_KEY):
+                _add_uncached_label_counts()
+        finally:
+            lock.release()
+
+        # an update may have been requested after we last checked but before we released the lock
+        if not r.exists(LABEL_TOTALS_PENDING_KEY):
+            return
+
+
+def update_label_totals_on_commit():
+    """
+    Updates the cached label totals once the current transaction is committed, so that they include its counts
+    """
+    transaction.on_commit(update_label_totals)
+
+
+def _add_uncached_label_counts():
+    """
+    Marks counts which haven't been added to the cached label totals as cached, and adds them. Rows are marked rather
+    than tracked by id, as ids are assigned before rows are committed and so aren't committed in order. Caller must
+    hold the label totals lock.
+    """
+    r = get_redis_connection()
+    if not r.hexists(LABEL_TOTALS_KEY, LABEL_TOTALS_RECONCILED_FIELD):
+        reconcile_label_totals()
+        return
+
+    sql = """
+        WITH cached AS (
+            UPDATE %(table_name)s SET "is_cached" = TRUE WHERE NOT "is_cached" AND "item_type" IN %%(item_types)s
+            RETURNING "item_type", "scope", "count"
+        )
+        SELECT "item_type", "scope", SUM("count") FROM cached GROUP BY "item_type", "scope";"""
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql % {"table_name": TotalCount._meta.db_table}, {"item_types": LABEL_TOTALS_ITEM_TYPES})
+        deltas = cursor.fetchall()
+
+    if deltas:
+        pipe = r.pipeline()
+        for item_type, scope, delta in deltas:
+            pipe.hincrby(LABEL_TOTALS_KEY, "%s:%s" % (item_type, scope), delta)
+        pipe.execute()
+
+
+def reconcile_label_totals():
+    """
+    Rebuilds the cached label totals from the database, which is cheap after counts have been squashed. Counts are
+    marked as cached by the same statement that sums them, so none are added again later. Caller must hold the label
+    totals lock.
+    """
+    sql = """
+        WITH cached AS (
+            UPDATE %(table_name)s SET "is_cached" = TRUE WHERE NOT "is_cached" AND "item_type" IN %%(item_types)s
+            RETURNING 1
+        )
+        SELECT "item_type", "scope", SUM("count") FROM %(table_name)s
+        WHERE "item_type" IN %%(item_types)s GROUP BY "item_type", "scope";"""
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql % {"table_name": TotalCount._meta.db_table}, {"item_types": LABEL_TOTALS_ITEM_TYPES})
+        totals = cursor.fetchall()
+
+    mapping = {"%s:%s" % (item_type, scope): total for item_type, scope, total in totals}
+    mapping[LABEL_TOTALS_RECONCILED_FIELD] = 1
+
+    pipe = get_redis_connection().pipeline()
+    pipe.delete(LABEL_TOTALS_KEY)
+    pipe.hmset(LABEL_TOTALS_KEY, mapping)
+    pipe.execute()
+
+
+def _label_totals_field(item_type, label):
+    return "%s:%s" % (item_type, TotalCount.encode_scope(label))
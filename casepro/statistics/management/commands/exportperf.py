@@ -0,0 +1,148 @@
+import random
+import time
+from datetime import date, timedelta
+
+from dash.orgs.models import Org
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from xlwt import Workbook
+
+from casepro.cases.models import Partner
+from casepro.msgs.models import Label
+from casepro.profiles.models import Profile
+from casepro.statistics.models import DailyCount, DailyCountExport, DailySecondTotalCount
+from casepro.utils import row_to_str, row_width
+
+DEFAULT_NUM_LABELS = 250  # exports have a column per scope and xls sheets are limited to 256 columns
+DEFAULT_NUM_USERS = 200
+DEFAULT_NUM_PARTNERS = 50
+DEFAULT_NUM_DAYS = 90
+
+
+class QueryCounter(object):
+    """
+    Database execute wrapper which just counts queries, so that counting doesn't need DEBUG or keep every query
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = "Benchmarks rendering daily count exports of labels, users and partners"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--labels", type=int, default=DEFAULT_NUM_LABELS, help="The number of labels")
+        parser.add_argument("--users", type=int, default=DEFAULT_NUM_USERS, help="The number of users")
+        parser.add_argument("--partners", type=int, default=DEFAULT_NUM_PARTNERS, help="The number of partners")
+        parser.add_argument("--days", type=int, default=DEFAULT_NUM_DAYS, help="The number of days exported")
+        parser.add_argument("--seed", type=int, default=1234, help="The seed for generating counts")
+
+    def handle(self, *args, **options):
+        header = (("Export", 10), ("Scopes", 10), ("Days", 8), ("Queries", 10), ("Time (secs)", 14))
+        self.stdout.write(row_to_str(header))
+        self.stdout.write("=" * row_width(header))
+
+        for export_type, num_scopes, num_queries, duration in self.time_exports(options):
+            row = (
+                (export_type, 10),
+                (num_scopes, 10),
+                (options["days"], 8),
+                (num_queries, 10),
+                ("%.2f" % duration, 14),
+            )
+            self.stdout.write(row_to_str(row))
+
+    @staticmethod
+    def time_exports(options):
+        """
+        Generates scopes with a squashed count for most days, and renders each type of export of them, in a
+        transaction which is rolled back afterwards
+        :return: list of tuples of export type, number of scopes, number of queries and time taken
+        """
+        rand = random.Random(options["seed"])
+        since = date(2018, 1, 1)
+        until = since + timedelta(days=options["days"])
+        days = [since + timedelta(days=d) for d in range(options["days"])]
+        results = []
+
+        with transaction.atomic():
+            user = User.objects.create(username="exportperf")
+            org = Org.objects.create(name="Benchmark", created_by=user, modified_by=user)
+
+            labels = [Label.objects.create(org=org, name="Label %d" % l) for l in range(options["labels"])]
+            partners = [
+                Partner.create(org, "Partner %d" % p, "", None, False, [], None) for p in range(options["partners"])
+            ]
+            users = [
+                Profile.create_org_user(org, "User %d" % u, "user%d@exportperf.com" % u, None)
+                for u in range(options["users"])
+            ]
+
+            counts = []
+            second_totals = []
+            for day in days:
+                for label in labels:
+                    counts.append((day, DailyCount.TYPE_INCOMING, DailyCount.encode_scope(label)))
+
+                for item_type in (DailyCount.TYPE_REPLIES, DailyCount.TYPE_CASE_OPENED, DailyCount.TYPE_CASE_CLOSED):
+                    for u in users:
+                        counts.append((day, item_type, DailyCount.encode_scope(org, u)))
+                    for partner in partners:
+                        counts.append((day, item_type, DailyCount.encode_scope(partner)))
+
+                for item_type in (DailySecondTotalCount.TYPE_TILL_REPLIED, DailySecondTotalCount.TYPE_TILL_CLOSED):
+                    for partner in partners:
+                        second_totals.append((day, item_type, DailySecondTotalCount.encode_scope(partner)))
+
+            DailyCount.objects.bulk_create(
+                [
+                    DailyCount(day=day, item_type=item_type, scope=scope, count=rand.randint(1, 20))
+                    for day, item_type, scope in counts
+                    if rand.random() < 0.8
+                ],
+                batch_size=10000,
+            )
+            DailySecondTotalCount.objects.bulk_create(
+                [
+                    DailySecondTotalCount(
+                        day=day,
+                        item_type=item_type,
+                        scope=scope,
+                        count=rand.randint(1, 20),
+                        seconds=rand.randint(1, 1000000),
+                    )
+                    for day, item_type, scope in second_totals
+                    if rand.random() < 0.8
+                ],
+                batch_size=10000,
+            )
+
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE statistics_dailycount")
+                cursor.execute("ANALYZE statistics_dailysecondtotalcount")
+
+            exports = (
+                (DailyCountExport.TYPE_LABEL, len(labels)),
+                (DailyCountExport.TYPE_USER, len(users)),
+                (DailyCountExport.TYPE_PARTNER, len(partners)),
+            )
+
+            for export_type, num_scopes in exports:
+                export = DailyCountExport.create(org, user, export_type, since, until)
+                counter = QueryCounter()
+                start = time.time()
+
+                with connection.execute_wrapper(counter):
+                    export.render_book(Workbook())
+
+                results.append((export_type, num_scopes, counter.count, time.time() - start))
+
+            transaction.set_rollback(True)
+
+        return results
@@ -0,0 +1,92 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from casepro.statistics.models import DailyCount
+from casepro.utils import row_to_str, row_width
+
+DEFAULT_NUM_ROWS = 10000000
+DEFAULT_NUM_SCOPES = 1000
+DEFAULT_NUM_DAYS = 365
+DEFAULT_BATCH_SIZE = 100000
+
+INSERT_SQL = """
+    INSERT INTO statistics_dailycount("day", "item_type", "scope", "count")
+    SELECT
+        DATE '2018-01-01' + (random() * %(days)s)::int,
+        (ARRAY['I', 'N', 'A', 'R'])[1 + (random() * 3)::int],
+        'org:' || (1 + (random() * %(scopes)s)::int),
+        CASE WHEN random() < 0.1 THEN -1 ELSE 1 END
+    FROM generate_series(1, %(rows)s);"""
+
+
+class Command(BaseCommand):
+    help = "Benchmarks squashing a table of unsquashed daily counts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=DEFAULT_NUM_ROWS, help="The number of unsquashed rows")
+        parser.add_argument("--scopes", type=int, default=DEFAULT_NUM_SCOPES, help="The number of distinct scopes")
+        parser.add_argument("--days", type=int, default=DEFAULT_NUM_DAYS, help="The number of distinct days")
+        parser.add_argument(
+            "--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="The number of row ids squashed per statement"
+        )
+
+    def handle(self, *args, **options):
+        header = (
+            ("Rows", 12),
+            ("Combinations", 14),
+            ("Statements", 12),
+            ("Collapsed", 12),
+            ("Time (secs)", 14),
+            ("Rows/sec", 12),
+        )
+        self.stdout.write(row_to_str(header))
+        self.stdout.write("=" * row_width(header))
+
+        num_combinations, stats = self.time_squash(options)
+
+        row = (
+            (options["rows"], 12),
+            (num_combinations, 14),
+            (stats["batches"], 12),
+            (stats["collapsed"], 12),
+            ("%.2f" % stats["time"], 14),
+            ("%.1f" % (options["rows"] / stats["time"] if stats["time"] else 0), 12),
+        )
+        self.stdout.write(row_to_str(row))
+
+    @staticmethod
+    def time_squash(options):
+        """
+        Generates unsquashed counts and squashes them, in a transaction which is rolled back afterwards
+        :return: tuple of the number of distinct combinations, which is the number of statements squashing them one
+            combination at a time would take, and the squash stats
+        """
+        last_squash_id = cache.get(DailyCount.last_squash_key)
+
+        try:
+            with transaction.atomic(), override_settings(SQUASH_BATCH_SIZE=options["batch_size"]):
+                # only squash the generated rows
+                max_id = DailyCount.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+                cache.set(DailyCount.last_squash_key, max_id)
+
+                with connection.cursor() as cursor:
+                    params = {"rows": options["rows"], "scopes": options["scopes"], "days": options["days"]}
+                    cursor.execute(INSERT_SQL, params)
+                    cursor.execute("ANALYZE statistics_dailycount")
+
+                num_combinations = (
+                    DailyCount.objects.filter(pk__gt=max_id).values("day", "item_type", "scope").distinct().count()
+                )
+
+                stats = DailyCount.squash()
+
+                transaction.set_rollback(True)
+        finally:
+            if last_squash_id:
+                cache.set(DailyCount.last_squash_key, last_squash_id)
+            else:
+                cache.delete(DailyCount.last_squash_key)
+
+        return num_combinations, stats
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("statistics", "0012_auto_20170904_1408"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MonthlyCount",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("item_type", models.CharField(help_text="The thing being counted", max_length=1)),
+                ("scope", models.CharField(help_text="The scope in which it is being counted", max_length=32)),
+                ("count", models.IntegerField()),
+                ("month", models.DateField(help_text="The first day of the month this count is for")),
+            ],
+        ),
+        migrations.CreateModel(
+            name="MonthlySecondTotalCount",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("item_type", models.CharField(help_text="The thing being counted", max_length=1)),
+                ("scope", models.CharField(help_text="The scope in which it is being counted", max_length=32)),
+                ("count", models.IntegerField()),
+                ("seconds", models.BigIntegerField()),
+                ("month", models.DateField(help_text="The first day of the month this count is for")),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name="monthlysecondtotalcount",
+            index_together={("item_type", "scope", "month")},
+        ),
+        migrations.AlterIndexTogether(
+            name="monthlycount",
+            index_together={("item_type", "scope", "month")},
+        ),
+    ]
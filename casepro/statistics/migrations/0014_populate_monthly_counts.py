@@ -0,0 +1,25 @@
+from django.db import migrations
+
+# monthly counts are read in place of the daily counts of whole months, so they need to exist for all existing daily
+# counts before anything reads them, rather than waiting for the first rollup
+SQL = """
+INSERT INTO statistics_monthlycount("item_type", "scope", "month", "count")
+SELECT "item_type", "scope", DATE_TRUNC('month', "day")::date, SUM("count")
+FROM statistics_dailycount GROUP BY "item_type", "scope", DATE_TRUNC('month', "day");
+
+INSERT INTO statistics_monthlysecondtotalcount("item_type", "scope", "month", "count", "seconds")
+SELECT "item_type", "scope", DATE_TRUNC('month', "day")::date, SUM("count"), SUM("seconds")
+FROM statistics_dailysecondtotalcount GROUP BY "item_type", "scope", DATE_TRUNC('month', "day");
+"""
+
+REVERSE_SQL = """
+DELETE FROM statistics_monthlycount;
+DELETE FROM statistics_monthlysecondtotalcount;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("statistics", "0013_monthlycount")]
+
+    operations = [migrations.RunSQL(SQL, REVERSE_SQL)]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+# counts are inserted by triggers and by squashing without this column, so it needs a database default. Existing rows
+# are marked as cached because the cached label totals are rebuilt from all rows when they are first read.
+SQL = """
+ALTER TABLE statistics_totalcount ALTER COLUMN "is_cached" SET DEFAULT FALSE;
+CREATE INDEX statistics_totalcount_not_cached ON statistics_totalcount("id") WHERE NOT "is_cached";
+"""
+
+REVERSE_SQL = """
+DROP INDEX statistics_totalcount_not_cached;
+ALTER TABLE statistics_totalcount ALTER COLUMN "is_cached" DROP DEFAULT;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("statistics", "0014_populate_monthly_counts")]
+
+    operations = [
+        migrations.AddField(
+            model_name="totalcount",
+            name="is_cached",
+            field=models.BooleanField(
+                default=True, help_text="Whether this count has been added to the cached label totals"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="totalcount",
+            name="is_cached",
+            field=models.BooleanField(
+                default=False, help_text="Whether this count has been added to the cached label totals"
+            ),
+        ),
+        migrations.RunSQL(SQL, REVERSE_SQL),
+    ]
@@ -1,18 +1,29 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
 from math import ceil
 
 from dash.orgs.models import Org
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.db import connection, models
-from django.db.models import Sum
+from django.db import DatabaseError, connection, models
+from django.db.models import Max, Min, Q, Sum
+from django.db.models.functions import TruncMonth
 from django.utils.functional import SimpleLazyObject
 from django.utils.translation import ugettext_lazy as _
+from django_redis import get_redis_connection
 
 from casepro.cases.models import CaseAction, Partner
 from casepro.msgs.models import Label
 from casepro.utils import date_range
 from casepro.utils.export import BaseExport
 
+_active = threading.local()
+
 
 def datetime_to_date(dt, org):
     """
@@ -21,6 +32,87 @@ def datetime_to_date(dt, org):
     return dt.astimezone(org.timezone).date()
 
 
+def to_date(d):
+    """
+    Converts a date or datetime to a date
+    """
+    return d.date() if isinstance(d, datetime) else d
+
+
+class CountBuffer(object):
+    """
+    Accumulates daily count deltas in memory, so that they can be written as a single pre-aggregated row for each
+    model, day, item type and scope rather than as a row for each recorded item
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.deltas = {}
+        self.num_recorded = 0
+        self.num_written = 0
+
+    def add(self, model, day, item_type, scope, count, seconds=0):
+        delta = self.deltas.setdefault((model, day, item_type, scope), [0, 0])
+        delta[0] += count
+        delta[1] += seconds
+        self.num_recorded += 1
+
+        if len(self.deltas) >= self.max_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered deltas which aren't zero with a single insert per model
+        """
+        rows_by_model = defaultdict(list)
+        for (model, day, item_type, scope), (count, seconds) in self.deltas.items():
+            if count or seconds:
+                extra = {"seconds": seconds} if issubclass(model, BaseSecondTotal) else {}
+                rows_by_model[model].append(model(day=day, item_type=item_type, scope=scope, count=count, **extra))
+
+        self.deltas = {}
+
+        for model, rows in rows_by_model.items():
+            model.objects.bulk_create(rows)
+            self.num_written += len(rows)
+
+
+@contextmanager
+def buffered_counts():
+    """
+    Context manager which buffers daily counts recorded in the current thread, writing them when the buffer is full and
+    on exit. If a buffer is already active, then it is reused. Counts are written in the current transaction, even if
+    an exception is raised, so that they are only rolled back along with the changes they count.
+    """
+    previous = getattr(_active, "buffer", None)
+    if previous:
+        yield previous
+        return
+
+    _active.buffer = CountBuffer(getattr(settings, "COUNT_BUFFER_SIZE", 1000))
+    try:
+        yield _active.buffer
+    except Exception:
+        try:
+            _active.buffer.flush()
+        except DatabaseError:
+            pass  # transaction has been aborted so the counted changes won't be committed either
+        raise
+    else:
+        _active.buffer.flush()
+    finally:
+        _active.buffer = None
+
+
+def flush_count_buffer():
+    """
+    Writes any counts buffered in the current thread, so that they are included in subsequent reads
+    """
+    buffer = getattr(_active, "buffer", None)
+    if buffer:
+        buffer.flush()
+
+
 class BaseCount(models.Model):
     """
     Tracks total counts of different items (e.g. replies, messages) in different scopes (e.g. org, user)
@@ -35,12 +127,41 @@ class BaseCount(models.Model):
 
     id = models.BigAutoField(auto_created=True, primary_key=True, verbose_name="ID")
 
+    # squashes every combination with rows in an id range, along with any older rows of those combinations and any rows
+    # newer than the whole squash (e.g. those squashed by earlier ranges), into a single row each
     squash_sql = """
-        WITH removed as (
-            DELETE FROM %(table_name)s WHERE %(delete_cond)s RETURNING "count"
+        WITH pending AS (
+            SELECT DISTINCT %(cols)s FROM %(table_name)s WHERE "id" > %%(start)s AND "id" <= %%(end)s
+        ), removed AS (
+            DELETE FROM %(table_name)s t USING pending p
+            WHERE %(join_cond)s AND NOT (t."id" > %%(end)s AND t."id" <= %%(max_id)s)
+            RETURNING %(removed_cols)s, t."count"
+        ), inserted AS (
+            INSERT INTO %(table_name)s(%(cols)s, "count")
+            SELECT %(cols)s, GREATEST(0, SUM("count")) FROM removed GROUP BY %(cols)s
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM removed), (SELECT COUNT(*) FROM inserted),
+               (SELECT ARRAY_AGG(DISTINCT "scope") FROM pending);"""
+
+    # recalculates the monthly count of every combination with daily rows in an id range, from all of its daily rows
+    rollup_sql = """
+        WITH pending AS (
+            SELECT DISTINCT "item_type", "scope", DATE_TRUNC('month', "day")::date AS "month"
+            FROM %(daily_table_name)s WHERE "id" > %%(start)s AND "id" <= %%(end)s
+        ), removed AS (
+            DELETE FROM %(table_name)s t USING pending p
+            WHERE t."item_type" = p."item_type" AND t."scope" = p."scope" AND t."month" = p."month"
+            RETURNING 1
+        ), inserted AS (
+            INSERT INTO %(table_name)s("item_type", "scope", "month", "count")
+            SELECT p."item_type", p."scope", p."month", SUM(d."count")
+            FROM pending p INNER JOIN %(daily_table_name)s d ON d."item_type" = p."item_type"
+                AND d."scope" = p."scope" AND d."day" >= p."month" AND d."day" < p."month" + INTERVAL '1 month'
+            GROUP BY p."item_type", p."scope", p."month"
+            RETURNING 1
         )
-        INSERT INTO %(table_name)s(%(insert_cols)s, "count")
-        VALUES (%(insert_vals)s, GREATEST(0, (SELECT SUM("count") FROM removed)));"""
+        SELECT (SELECT COUNT(*) FROM removed), (SELECT COUNT(*) FROM inserted);"""
 
     item_type = models.CharField(max_length=1, help_text=_("The thing being counted"))
 
@@ -69,39 +190,138 @@ class BaseCount(models.Model):
         else:  # pragma: no cover
             raise ValueError("Unsupported scope: %s" % ",".join([t.__name__ for t in types]))
 
+    @staticmethod
+    def filter_item_type(counts, item_type):
+        """
+        Filters counts by a single item type or by a list of item types
+        """
+        if isinstance(item_type, (list, tuple)):
+            return counts.filter(item_type__in=item_type)
+        return counts.filter(item_type=item_type)
+
     @classmethod
     def squash(cls):
         """
-        Squashes counts so that there is a single count per item_type + scope combination
+        Squashes counts so that there is a single count per item_type + scope combination. Rows added since the last
+        squash are processed in id ranges, each of which takes a single statement however many combinations it has.
+        :return: dict of the number of rows squashed, the number of rows they were collapsed by, the number of id
+            ranges, the time taken and the set of scopes with changed counts
         """
+        start_time = time.time()
+        batch_size = getattr(settings, "SQUASH_BATCH_SIZE", 100000)
+
         last_squash_id = cache.get(cls.last_squash_key, 0)
-        unsquashed_values = cls.objects.filter(pk__gt=last_squash_id)
-        unsquashed_values = unsquashed_values.values(*cls.squash_over).distinct(*cls.squash_over)
+        id_range = cls.objects.filter(pk__gt=last_squash_id).aggregate(min_id=Min("pk"), max_id=Max("pk"))
+        min_id, max_id = id_range["min_id"] or 1, id_range["max_id"] or 0
+
+        sql = cls.squash_sql % {
+            "table_name": cls._meta.db_table,
+            "cols": ", ".join(['"%s"' % f for f in cls.squash_over]),
+            "join_cond": " AND ".join(['t."%s" = p."%s"' % (f, f) for f in cls.squash_over]),
+            "removed_cols": ", ".join(['t."%s"' % f for f in cls.squash_over]),
+        }
+
+        num_removed, num_inserted, num_batches = 0, 0, 0
+        scopes = set()
 
-        for unsquashed in unsquashed_values:
+        for start in range(min_id - 1, max_id, batch_size):
             with connection.cursor() as cursor:
-                sql = cls.squash_sql % {
-                    "table_name": cls._meta.db_table,
-                    "delete_cond": " AND ".join(['"%s" = %%s' % f for f in cls.squash_over]),
-                    "insert_cols": ", ".join(['"%s"' % f for f in cls.squash_over]),
-                    "insert_vals": ", ".join(["%s"] * len(cls.squash_over)),
-                }
+                cursor.execute(sql, {"start": start, "end": min(start + batch_size, max_id), "max_id": max_id})
+                removed, inserted, batch_scopes = cursor.fetchone()
+
+            num_removed += removed
+            num_inserted += inserted
+            num_batches += 1
+            scopes.update(batch_scopes or ())
+
+        # squashed rows have been given new ids, and rows added since the id range was read won't be squashed by the
+        # next squash either, so their scopes have also changed
+        new_max_id = cls.objects.order_by("-pk").values_list("pk", flat=True).first()
+        if new_max_id:
+            added = cls.objects.filter(pk__gt=max(max_id, last_squash_id), pk__lte=new_max_id)
+            scopes.update(added.values_list("scope", flat=True).distinct())
+
+            cache.set(cls.last_squash_key, new_max_id)
+
+        return {
+            "squashed": num_removed,
+            "collapsed": num_removed - num_inserted,
+            "batches": num_batches,
+            "time": round(time.time() - start_time, 3),
+            "scopes": scopes,
+        }
+
+    @classmethod
+    def rollup(cls):
+        """
+        Updates the monthly counts of every combination with daily counts added since the last rollup, which should
+        be done after squashing the daily counts. Daily counts are processed in id ranges, like squashing.
+        :return: dict of the number of monthly counts updated, the number of id ranges and the time taken
+        """
+        start_time = time.time()
+        batch_size = getattr(settings, "SQUASH_BATCH_SIZE", 100000)
+        daily_model = cls.rollup_of
 
-                params = [unsquashed[f] for f in cls.squash_over]
-                cursor.execute(sql, params + params)
+        last_rollup_id = cache.get(cls.last_rollup_key, 0)
+        id_range = daily_model.objects.filter(pk__gt=last_rollup_id).aggregate(min_id=Min("pk"), max_id=Max("pk"))
+        min_id, max_id = id_range["min_id"] or 1, id_range["max_id"] or 0
+
+        sql = cls.rollup_sql % {"table_name": cls._meta.db_table, "daily_table_name": daily_model._meta.db_table}
+
+        num_updated, num_batches = 0, 0
+
+        for start in range(min_id - 1, max_id, batch_size):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, {"start": start, "end": min(start + batch_size, max_id)})
+                removed, inserted = cursor.fetchone()
+
+            num_updated += inserted
+            num_batches += 1
 
-        max_id = cls.objects.order_by("-pk").values_list("pk", flat=True).first()
         if max_id:
-            cache.set(cls.last_squash_key, max_id)
+            cache.set(cls.last_rollup_key, max_id)
+
+        return {"updated": num_updated, "batches": num_batches, "time": round(time.time() - start_time, 3)}
 
     class CountSet(object):
         """
         A queryset of counts which can be aggregated in different ways
         """
 
-        def __init__(self, counts, scopes):
+        def __init__(self, counts, scopes, monthly_counts=None, since=None, until=None):
             self.counts = counts
             self.scopes = scopes
+            self.monthly_counts = monthly_counts
+            self.since = since
+            self.until = until
+
+        def _split_months(self, today):
+            """
+            Splits this set of daily counts into the monthly counts of the whole months in its range before the current
+            month, and the daily counts of any other days
+            :param today: the current date in the org's timezone
+            :return: tuple of monthly counts and daily counts
+            """
+            rollup_until = today.replace(day=1)
+            if self.until:
+                rollup_until = min(rollup_until, to_date(self.until).replace(day=1))
+
+            rollup_since = None
+            if self.since:
+                rollup_since = to_date(self.since).replace(day=1)
+                if rollup_since < to_date(self.since):
+                    rollup_since += relativedelta(months=1)
+
+                if rollup_since >= rollup_until:
+                    return self.monthly_counts.none(), self.counts
+
+            monthly_counts = self.monthly_counts.filter(month__lt=rollup_until)
+            rolled_up_days = Q(day__lt=rollup_until)
+            if rollup_since:
+                monthly_counts = monthly_counts.filter(month__gte=rollup_since)
+                rolled_up_days &= Q(day__gte=rollup_since)
+
+            return monthly_counts, self.counts.exclude(rolled_up_days)
 
         def total(self):
             """
@@ -136,15 +356,37 @@ class BaseSecondTotal(BaseCount):
     TYPE_TILL_CLOSED = "C"
 
     squash_sql = """
-        WITH removed as (
-            DELETE FROM %(table_name)s WHERE %(delete_cond)s RETURNING "count", "seconds"
+        WITH pending AS (
+            SELECT DISTINCT %(cols)s FROM %(table_name)s WHERE "id" > %%(start)s AND "id" <= %%(end)s
+        ), removed AS (
+            DELETE FROM %(table_name)s t USING pending p
+            WHERE %(join_cond)s AND NOT (t."id" > %%(end)s AND t."id" <= %%(max_id)s)
+            RETURNING %(removed_cols)s, t."count", t."seconds"
+        ), inserted AS (
+            INSERT INTO %(table_name)s(%(cols)s, "count", "seconds")
+            SELECT %(cols)s, GREATEST(0, SUM("count")), COALESCE(SUM("seconds"), 0) FROM removed GROUP BY %(cols)s
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM removed), (SELECT COUNT(*) FROM inserted),
+               (SELECT ARRAY_AGG(DISTINCT "scope") FROM pending);"""
+
+    rollup_sql = """
+        WITH pending AS (
+            SELECT DISTINCT "item_type", "scope", DATE_TRUNC('month', "day")::date AS "month"
+            FROM %(daily_table_name)s WHERE "id" > %%(start)s AND "id" <= %%(end)s
+        ), removed AS (
+            DELETE FROM %(table_name)s t USING pending p
+            WHERE t."item_type" = p."item_type" AND t."scope" = p."scope" AND t."month" = p."month"
+            RETURNING 1
+        ), inserted AS (
+            INSERT INTO %(table_name)s("item_type", "scope", "month", "count", "seconds")
+            SELECT p."item_type", p."scope", p."month", SUM(d."count"), SUM(d."seconds")
+            FROM pending p INNER JOIN %(daily_table_name)s d ON d."item_type" = p."item_type"
+                AND d."scope" = p."scope" AND d."day" >= p."month" AND d."day" < p."month" + INTERVAL '1 month'
+            GROUP BY p."item_type", p."scope", p."month"
+            RETURNING 1
         )
-        INSERT INTO %(table_name)s(%(insert_cols)s, "count", "seconds")
-        VALUES (
-            %(insert_vals)s,
-            GREATEST(0, (SELECT SUM("count") FROM removed)),
-            COALESCE((SELECT SUM("seconds") FROM removed), 0)
-        );"""
+        SELECT (SELECT COUNT(*) FROM removed), (SELECT COUNT(*) FROM inserted);"""
 
     seconds = models.BigIntegerField()
 
@@ -193,14 +435,33 @@ class BaseSecondTotal(BaseCount):
                 self.counts.values_list("day").annotate(cases=Sum("count"), seconds=Sum("seconds")).order_by("day")
             )
 
-        def month_totals(self):
+        def pivot_totals(self):
             """
-            Calculates per-month totals over a set of counts
+            Calculates per-item type, per-scope and per-day totals over a set of counts in a single query
+            :return: dict of tuples of count and seconds totals keyed by tuples of item type, scope and day
             """
-            counts = self.counts.extra(select={"month": 'EXTRACT(month FROM "day")'})
-            return list(
-                counts.values_list("month").annotate(cases=Sum("count"), seconds=Sum("seconds")).order_by("month")
+            if not self.scopes:
+                return {}
+
+            totals = self.counts.values_list("item_type", "scope", "day").annotate(
+                cases=Sum("count"), seconds=Sum("seconds")
             )
+            return {(t[0], self.scopes[t[1]], t[2]): (t[3], t[4]) for t in totals.order_by()}
+
+        def month_totals(self, today):
+            """
+            Calculates per-month totals over a set of counts, reading whole months before the current month from the
+            monthly counts, which are as of the last squash
+            :param today: the current date in the org's timezone
+            :return: list of tuples of the first day of each month, the total count and the total seconds
+            """
+            monthly_counts, daily_counts = self._split_months(today)
+            daily_counts = daily_counts.annotate(month=TruncMonth("day"))
+
+            totals = []
+            for counts in (monthly_counts, daily_counts):
+                totals += counts.values_list("month").annotate(cases=Sum("count"), seconds=Sum("seconds")).order_by()
+            return sorted(totals)
 
     class Meta:
         abstract = True
@@ -214,10 +475,35 @@ class TotalCount(BaseCount):
     squash_over = ("item_type", "scope")
     last_squash_key = "total_count:last_squash"
 
+    is_cached = models.BooleanField(
+        default=False, help_text=_("Whether this count has been added to the cached label totals")
+    )
+
     @classmethod
     def get_by_label(cls, labels, item_type):
         return cls._get_count_set(item_type, {cls.encode_scope(l): l for l in labels})
 
+    @classmethod
+    def squash(cls):
+        """
+        Squashes counts and then reconciles the cached label totals with them. The label totals lock is held throughout
+        so that nothing adds squashed rows to the cached totals before they've been reconciled.
+        """
+        from .cache import (
+            LABEL_TOTALS_LOCK_KEY,
+            LABEL_TOTALS_SQUASH_LOCK_SECONDS,
+            reconcile_label_totals,
+            update_label_totals,
+        )
+
+        with get_redis_connection().lock(LABEL_TOTALS_LOCK_KEY, timeout=LABEL_TOTALS_SQUASH_LOCK_SECONDS):
+            stats = super(TotalCount, cls).squash()
+            reconcile_label_totals()
+
+        # add counts from any updates which were requested while we held the lock
+        update_label_totals()
+        return stats
+
     @classmethod
     def _get_count_set(cls, item_type, scopes):
         counts = cls.objects.filter(item_type=item_type)
@@ -241,11 +527,39 @@ class DailyCount(BaseCount):
 
     @classmethod
     def record_item(cls, day, item_type, *scope_args):
-        cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=1)
+        cls._record(day, item_type, cls.encode_scope(*scope_args), 1)
 
     @classmethod
     def record_removal(cls, day, item_type, *scope_args):
-        cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=-1)
+        cls._record(day, item_type, cls.encode_scope(*scope_args), -1)
+
+    @classmethod
+    def _record(cls, day, item_type, scope, count):
+        buffer = getattr(_active, "buffer", None)
+        if buffer:
+            buffer.add(cls, day, item_type, scope, count)
+        else:
+            cls.objects.create(day=day, item_type=item_type, scope=scope, count=count)
+
+    @classmethod
+    def record_counts(cls, item_type, counts):
+        """
+        Records multiple items (or removals if counts are negative) with a single insert
+        :param counts: dict of counts keyed by tuples of day and scope args tuple
+        """
+        buffer = getattr(_active, "buffer", None)
+        if buffer:
+            for (day, scope_args), count in counts.items():
+                buffer.add(cls, day, item_type, cls.encode_scope(*scope_args), count)
+            return
+
+        cls.objects.bulk_create(
+            [
+                cls(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=count)
+                for (day, scope_args), count in counts.items()
+                if count
+            ]
+        )
 
     @classmethod
     def get_by_org(cls, orgs, item_type, since=None, until=None):
@@ -265,14 +579,21 @@ class DailyCount(BaseCount):
 
     @classmethod
     def _get_count_set(cls, item_type, scopes, since, until):
-        counts = cls.objects.filter(item_type=item_type)
+        flush_count_buffer()
+
+        counts = cls.filter_item_type(cls.objects.all(), item_type)
         if scopes:
             counts = counts.filter(scope__in=scopes.keys())
         if since:
             counts = counts.filter(day__gte=since)
         if until:
             counts = counts.filter(day__lt=until)
-        return DailyCount.CountSet(counts, scopes)
+
+        monthly_counts = cls.filter_item_type(MonthlyCount.objects.all(), item_type)
+        if scopes:
+            monthly_counts = monthly_counts.filter(scope__in=scopes.keys())
+
+        return DailyCount.CountSet(counts, scopes, monthly_counts, since, until)
 
     class CountSet(BaseCount.CountSet):
         """
@@ -285,12 +606,31 @@ class DailyCount(BaseCount):
             """
             return list(self.counts.values_list("day").annotate(total=Sum("count")).order_by("day"))
 
-        def month_totals(self):
+        def pivot_totals(self):
             """
-            Calculates per-month totals over a set of counts
+            Calculates per-item type, per-scope and per-day totals over a set of counts in a single query
+            :return: dict of totals keyed by tuples of item type, scope and day
             """
-            counts = self.counts.extra(select={"month": 'EXTRACT(month FROM "day")'})
-            return list(counts.values_list("month").annotate(replies=Sum("count")).order_by("month"))
+            if not self.scopes:
+                return {}
+
+            totals = self.counts.values_list("item_type", "scope", "day").annotate(total=Sum("count")).order_by()
+            return {(t[0], self.scopes[t[1]], t[2]): t[3] for t in totals}
+
+        def month_totals(self, today):
+            """
+            Calculates per-month totals over a set of counts, reading whole months before the current month from the
+            monthly counts, which are as of the last squash
+            :param today: the current date in the org's timezone
+            :return: list of tuples of the first day of each month and its total
+            """
+            monthly_counts, daily_counts = self._split_months(today)
+            daily_counts = daily_counts.annotate(month=TruncMonth("day"))
+
+            totals = []
+            for counts in (monthly_counts, daily_counts):
+                totals += counts.values_list("month").annotate(total=Sum("count")).order_by()
+            return sorted(totals)
 
     class Meta:
         index_together = ("item_type", "scope", "day")
@@ -324,58 +664,37 @@ class DailyCountExport(BaseExport):
 
             labels = list(Label.get_all(self.org).order_by("name"))
 
-            # get each label's day counts and organise by label and day
-            totals_by_label = {}
-            for label in labels:
-                totals = DailyCount.get_by_label(
-                    [label], DailyCount.TYPE_INCOMING, self.since, self.until
-                ).day_totals()
-                totals_by_label[label] = {t[0]: t[1] for t in totals}
+            # get all day counts for all labels in one query
+            totals = DailyCount.get_by_label(labels, DailyCount.TYPE_INCOMING, self.since, self.until).pivot_totals()
 
             self.write_row(sheet, 0, ["Date"] + [l.name for l in labels])
 
             row = 1
             for day in date_range(self.since, self.until):
-                totals = [totals_by_label.get(l, {}).get(day, 0) for l in labels]
-                self.write_row(sheet, row, [day] + totals)
+                self.write_row(sheet, row, [day] + [totals.get((DailyCount.TYPE_INCOMING, l, day), 0) for l in labels])
                 row += 1
 
         elif self.type == self.TYPE_USER:
-            replies_sheet = book.add_sheet(str(_("Replies Sent")))
-            cases_opened_sheet = book.add_sheet(str(_("Cases Opened")))
-            cases_closed_sheet = book.add_sheet(str(_("Cases Closed")))
+            sheets = (
+                (book.add_sheet(str(_("Replies Sent"))), DailyCount.TYPE_REPLIES),
+                (book.add_sheet(str(_("Cases Opened"))), DailyCount.TYPE_CASE_OPENED),
+                (book.add_sheet(str(_("Cases Closed"))), DailyCount.TYPE_CASE_CLOSED),
+            )
+
+            users = list(self.org.get_org_users().select_related("profile").order_by("profile__full_name"))
 
-            users = self.org.get_org_users().order_by("profile__full_name")
-
-            replies_totals_by_user = {}
-            cases_opened_by_user = {}
-            cases_closed_by_user = {}
-            for user in users:
-                replies_totals = DailyCount.get_by_user(
-                    self.org, [user], DailyCount.TYPE_REPLIES, self.since, self.until
-                ).day_totals()
-                cases_opened_totals = DailyCount.get_by_user(
-                    self.org, [user], DailyCount.TYPE_CASE_OPENED, self.since, self.until
-                ).day_totals()
-                cases_closed_totals = DailyCount.get_by_user(
-                    self.org, [user], DailyCount.TYPE_CASE_CLOSED, self.since, self.until
-                ).day_totals()
-                replies_totals_by_user[user] = {t[0]: t[1] for t in replies_totals}
-                cases_opened_by_user[user] = {t[0]: t[1] for t in cases_opened_totals}
-                cases_closed_by_user[user] = {t[0]: t[1] for t in cases_closed_totals}
-
-            self.write_row(replies_sheet, 0, ["Date"] + [u.get_full_name() for u in users])
-            self.write_row(cases_opened_sheet, 0, ["Date"] + [u.get_full_name() for u in users])
-            self.write_row(cases_closed_sheet, 0, ["Date"] + [u.get_full_name() for u in users])
+            # get all day counts of all types for all users in one query
+            totals = DailyCount.get_by_user(
+                self.org, users, [item_type for sheet, item_type in sheets], self.since, self.until
+            ).pivot_totals()
+
+            for sheet, item_type in sheets:
+                self.write_row(sheet, 0, ["Date"] + [u.get_full_name() for u in users])
 
             row = 1
             for day in date_range(self.since, self.until):
-                replies_totals = [replies_totals_by_user.get(u, {}).get(day, 0) for u in users]
-                cases_opened_totals = [cases_opened_by_user.get(u, {}).get(day, 0) for u in users]
-                cases_closed_totals = [cases_closed_by_user.get(u, {}).get(day, 0) for u in users]
-                self.write_row(replies_sheet, row, [day] + replies_totals)
-                self.write_row(cases_opened_sheet, row, [day] + cases_opened_totals)
-                self.write_row(cases_closed_sheet, row, [day] + cases_closed_totals)
+                for sheet, item_type in sheets:
+                    self.write_row(sheet, row, [day] + [totals.get((item_type, u, day), 0) for u in users])
                 row += 1
 
         elif self.type == self.TYPE_PARTNER:
@@ -385,54 +704,41 @@ class DailyCountExport(BaseExport):
             cases_opened_sheet = book.add_sheet(str(_("Cases Opened")))
             cases_closed_sheet = book.add_sheet(str(_("Cases Closed")))
 
+            count_sheets = (
+                (replies_sheet, DailyCount.TYPE_REPLIES),
+                (cases_opened_sheet, DailyCount.TYPE_CASE_OPENED),
+                (cases_closed_sheet, DailyCount.TYPE_CASE_CLOSED),
+            )
+            average_sheets = (
+                (ave_sheet, DailySecondTotalCount.TYPE_TILL_REPLIED),
+                (ave_closed_sheet, DailySecondTotalCount.TYPE_TILL_CLOSED),
+            )
+
             partners = list(Partner.get_all(self.org).order_by("name"))
 
-            # get each partner's day counts and organise by partner and day
-            replies_totals_by_partner = {}
-            cases_opened_by_partner = {}
-            cases_closed_by_partner = {}
-            replied_averages_by_partner = {}
-            closed_averages_by_partner = {}
-            for partner in partners:
-                replies_totals = DailyCount.get_by_partner(
-                    [partner], DailyCount.TYPE_REPLIES, self.since, self.until
-                ).day_totals()
-                cases_opened_totals = DailyCount.get_by_partner(
-                    [partner], DailyCount.TYPE_CASE_OPENED, self.since, self.until
-                ).day_totals()
-                cases_closed_totals = DailyCount.get_by_partner(
-                    [partner], DailyCount.TYPE_CASE_CLOSED, self.since, self.until
-                ).day_totals()
-                replies_totals_by_partner[partner] = {t[0]: t[1] for t in replies_totals}
-                cases_opened_by_partner[partner] = {t[0]: t[1] for t in cases_opened_totals}
-                cases_closed_by_partner[partner] = {t[0]: t[1] for t in cases_closed_totals}
-                replied_second_totals = DailySecondTotalCount.get_by_partner(
-                    [partner], DailySecondTotalCount.TYPE_TILL_REPLIED, self.since, self.until
-                ).day_totals()
-                replied_averages_by_partner[partner] = {t[0]: (float(t[2]) / t[1]) for t in replied_second_totals}
-                closed_second_totals = DailySecondTotalCount.get_by_partner(
-                    [partner], DailySecondTotalCount.TYPE_TILL_CLOSED, self.since, self.until
-                ).day_totals()
-                closed_averages_by_partner[partner] = {t[0]: (float(t[2]) / t[1]) for t in closed_second_totals}
-
-            self.write_row(replies_sheet, 0, ["Date"] + [p.name for p in partners])
-            self.write_row(cases_opened_sheet, 0, ["Date"] + [p.name for p in partners])
-            self.write_row(cases_closed_sheet, 0, ["Date"] + [p.name for p in partners])
-            self.write_row(ave_sheet, 0, ["Date"] + [p.name for p in partners])
-            self.write_row(ave_closed_sheet, 0, ["Date"] + [p.name for p in partners])
+            # get all day counts and all day second totals for all partners in one query each
+            totals = DailyCount.get_by_partner(
+                partners, [item_type for sheet, item_type in count_sheets], self.since, self.until
+            ).pivot_totals()
+            second_totals = DailySecondTotalCount.get_by_partner(
+                partners, [item_type for sheet, item_type in average_sheets], self.since, self.until
+            ).pivot_totals()
+
+            for sheet in (replies_sheet, cases_opened_sheet, cases_closed_sheet, ave_sheet, ave_closed_sheet):
+                self.write_row(sheet, 0, ["Date"] + [p.name for p in partners])
 
             row = 1
             for day in date_range(self.since, self.until):
-                replies_totals = [replies_totals_by_partner.get(l, {}).get(day, 0) for l in partners]
-                cases_opened_totals = [cases_opened_by_partner.get(l, {}).get(day, 0) for l in partners]
-                cases_closed_totals = [cases_closed_by_partner.get(l, {}).get(day, 0) for l in partners]
-                replied_averages = [replied_averages_by_partner.get(l, {}).get(day, 0) for l in partners]
-                closed_averages = [closed_averages_by_partner.get(l, {}).get(day, 0) for l in partners]
-                self.write_row(replies_sheet, row, [day] + replies_totals)
-                self.write_row(cases_opened_sheet, row, [day] + cases_opened_totals)
-                self.write_row(cases_closed_sheet, row, [day] + cases_closed_totals)
-                self.write_row(ave_sheet, row, [day] + replied_averages)
-                self.write_row(ave_closed_sheet, row, [day] + closed_averages)
+                for sheet, item_type in count_sheets:
+                    self.write_row(sheet, row, [day] + [totals.get((item_type, p, day), 0) for p in partners])
+
+                for sheet, item_type in average_sheets:
+                    averages = []
+                    for p in partners:
+                        cases, seconds = second_totals.get((item_type, p, day), (0, 0))
+                        averages.append(float(seconds) / cases if cases else 0)
+
+                    self.write_row(sheet, row, [day] + averages)
                 row += 1
 
 
@@ -448,7 +754,13 @@ class DailySecondTotalCount(BaseSecondTotal):
 
     @classmethod
     def record_item(cls, day, seconds, item_type, *scope_args):
-        cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=1, seconds=seconds)
+        scope = cls.encode_scope(*scope_args)
+
+        buffer = getattr(_active, "buffer", None)
+        if buffer:
+            buffer.add(cls, day, item_type, scope, 1, seconds)
+        else:
+            cls.objects.create(day=day, item_type=item_type, scope=scope, count=1, seconds=seconds)
 
     @classmethod
     def get_by_org(cls, orgs, item_type, since=None, until=None):
@@ -464,14 +776,49 @@ class DailySecondTotalCount(BaseSecondTotal):
 
     @classmethod
     def _get_count_set(cls, item_type, scopes, since, until):
-        counts = cls.objects.filter(item_type=item_type)
+        flush_count_buffer()
+
+        counts = cls.filter_item_type(cls.objects.all(), item_type)
         if scopes:
             counts = counts.filter(scope__in=scopes.keys())
         if since:
             counts = counts.filter(day__gte=since)
         if until:
             counts = counts.filter(day__lt=until)
-        return DailySecondTotalCount.CountSet(counts, scopes)
+
+        monthly_counts = cls.filter_item_type(MonthlySecondTotalCount.objects.all(), item_type)
+        if scopes:
+            monthly_counts = monthly_counts.filter(scope__in=scopes.keys())
+
+        return DailySecondTotalCount.CountSet(counts, scopes, monthly_counts, since, until)
+
+
+class MonthlyCount(BaseCount):
+    """
+    Tracks per-month totals of daily counts, which are updated after daily counts are squashed
+    """
+
+    month = models.DateField(help_text=_("The first day of the month this count is for"))
+
+    rollup_of = DailyCount
+    last_rollup_key = "monthly_count:last_rollup"
+
+    class Meta:
+        index_together = ("item_type", "scope", "month")
+
+
+class MonthlySecondTotalCount(BaseSecondTotal):
+    """
+    Tracks per-month totals of daily second totals, which are updated after daily second totals are squashed
+    """
+
+    month = models.DateField(help_text=_("The first day of the month this count is for"))
+
+    rollup_of = DailySecondTotalCount
+    last_rollup_key = "monthly_second_total_count:last_rollup"
+
+    class Meta:
+        index_together = ("item_type", "scope", "month")
 
 
 def record_case_closed_time(close_action):
@@ -7,13 +7,37 @@ logger = get_task_logger(__name__)
 @shared_task
 def squash_counts():
     """
-    Task to squash all daily counts
+    Task to squash all daily counts, and then update monthly counts and invalidate cached chart totals of them
     """
-    from .models import TotalCount, DailyCount, DailySecondTotalCount
+    from .cache import get_chart_cache_stats, invalidate_cached_totals
+    from .models import TotalCount, DailyCount, DailySecondTotalCount, MonthlyCount, MonthlySecondTotalCount
 
-    TotalCount.squash()
-    DailyCount.squash()
-    DailySecondTotalCount.squash()
+    for model in (TotalCount, DailyCount, DailySecondTotalCount):
+        stats = model.squash()
+
+        if model == DailyCount:
+            changed_scopes = stats["scopes"]
+
+        logger.info(
+            "Squashed %d %s rows by %d in %d batches (%.3f secs)"
+            % (stats["squashed"], model.__name__, stats["collapsed"], stats["batches"], stats["time"])
+        )
+
+    for model in (MonthlyCount, MonthlySecondTotalCount):
+        stats = model.rollup()
+
+        logger.info(
+            "Updated %d %s rows in %d batches (%.3f secs)"
+            % (stats["updated"], model.__name__, stats["batches"], stats["time"])
+        )
+
+    invalidate_cached_totals(changed_scopes)
+
+    for chart, stats in sorted(get_chart_cache_stats().items()):
+        logger.info(
+            "Chart cache for %s has %d hits and %d misses (hit rate %.3f)"
+            % (chart, stats["hits"], stats["misses"], stats["hit_rate"])
+        )
 
 
 @shared_task
@@ -3,17 +3,35 @@ from datetime import date, datetime, time
 
 import pytz
 from dash.orgs.models import Org
+from django.db import transaction
 from django.urls import reverse
 from django.test.utils import override_settings
 from django.utils import timezone
+from django_redis import get_redis_connection
 from unittest.mock import patch
 
 from casepro.cases.models import Case
-from casepro.msgs.models import Outgoing
+from casepro.msgs.models import Message, Outgoing
 from casepro.test import BaseCasesTest
 from casepro.utils import date_to_milliseconds
 
-from .models import DailyCount, DailyCountExport, DailySecondTotalCount
+from .cache import (
+    CHART_CACHE_STATS_KEY,
+    LABEL_TOTALS_KEY,
+    LABEL_TOTALS_LOCK_KEY,
+    LABEL_TOTALS_PENDING_KEY,
+    get_chart_cache_stats,
+    get_label_totals,
+    update_label_totals,
+)
+from .models import (
+    DailyCount,
+    DailyCountExport,
+    DailySecondTotalCount,
+    TotalCount,
+    buffered_counts,
+    datetime_to_date,
+)
 from .tasks import squash_counts
 
 
@@ -125,11 +143,6 @@ class DailyCountsTest(BaseStatsTest):
                 [(date(2015, 1, 1), 1), (date(2015, 1, 2), 2)],
             )
 
-            # check monthly totals
-            self.assertEqual(DailyCount.get_by_org([self.unicef], "R").month_totals(), [(1, 7), (2, 4), (3, 1)])
-            self.assertEqual(DailyCount.get_by_partner([self.moh], "R").month_totals(), [(1, 4)])
-            self.assertEqual(DailyCount.get_by_user(self.unicef, [self.admin], "R").month_totals(), [(1, 2)])
-
             # check org totals
             self.assertEqual(
                 DailyCount.get_by_org(Org.objects.all(), "R").scope_totals(), {self.unicef: 12, self.nyaruka: 1}
@@ -149,12 +162,22 @@ class DailyCountsTest(BaseStatsTest):
         check_counts()
         self.assertEqual(DailyCount.objects.count(), 37)
 
+        # past months aren't included in monthly totals until they've been rolled up
+        today = datetime_to_date(timezone.now(), self.unicef)
+        self.assertEqual(DailyCount.get_by_org([self.unicef], "R").month_totals(today), [])
+
         # squash all daily counts
         squash_counts()
 
         check_counts()
         self.assertEqual(DailyCount.objects.count(), 26)
 
+        # check monthly totals
+        jan, feb, mar = date(2015, 1, 1), date(2015, 2, 1), date(2015, 3, 1)
+        self.assertEqual(DailyCount.get_by_org([self.unicef], "R").month_totals(today), [(jan, 7), (feb, 4), (mar, 1)])
+        self.assertEqual(DailyCount.get_by_partner([self.moh], "R").month_totals(today), [(jan, 4)])
+        self.assertEqual(DailyCount.get_by_user(self.unicef, [self.admin], "R").month_totals(today), [(jan, 2)])
+
         # add new count on day that already has a squashed value
         self.new_outgoing(self.admin, date(2015, 1, 1), 1)
 
@@ -166,6 +189,157 @@ class DailyCountsTest(BaseStatsTest):
         self.assertEqual(DailyCount.objects.count(), 26)
         self.assertEqual(DailyCount.get_by_org([self.unicef], "R").total(), 13)
 
+        # the same month in different years is kept apart
+        self.new_outgoing(self.admin, date(2016, 1, 5), 1)
+        squash_counts()
+
+        self.assertEqual(
+            DailyCount.get_by_org([self.unicef], "R").month_totals(today),
+            [(jan, 8), (feb, 4), (mar, 1), (date(2016, 1, 1), 1)],
+        )
+
+        # partial months come from daily counts
+        self.assertEqual(
+            DailyCount.get_by_org([self.unicef], "R", date(2015, 1, 2), date(2015, 3, 1)).month_totals(today),
+            [(jan, 4), (feb, 4)],
+        )
+        self.assertEqual(
+            DailyCount.get_by_org([self.unicef], "R", date(2015, 2, 2), date(2015, 2, 28)).month_totals(today),
+            [(feb, 2)],
+        )
+
+        # as does the org's current month
+        DailyCount.record_item(today, "R", self.unicef)
+
+        self.assertEqual(
+            DailyCount.get_by_org([self.unicef], "R", date(2016, 1, 1)).month_totals(today),
+            [(date(2016, 1, 1), 1), (today.replace(day=1), 1)],
+        )
+
+        # which is the month of the given date, so a count not yet rolled up is only included if it's in that month
+        DailyCount.record_item(date(2015, 2, 3), "R", self.unicef)
+
+        counts = DailyCount.get_by_org([self.unicef], "R", date(2015, 1, 1), date(2015, 4, 1))
+        self.assertEqual(counts.month_totals(date(2015, 2, 28)), [(jan, 8), (feb, 5), (mar, 1)])
+        self.assertEqual(counts.month_totals(date(2015, 3, 1)), [(jan, 8), (feb, 4), (mar, 1)])
+
+    @override_settings(SQUASH_BATCH_SIZE=3)
+    def test_squash_in_batches(self):
+        DailyCount.squash()
+        DailySecondTotalCount.squash()
+
+        d1, d2 = date(2015, 1, 1), date(2015, 1, 2)
+        for d, item_type, count in ((d1, "I", 1), (d1, "I", 1), (d1, "I", -1), (d1, "I", 1), (d2, "I", 1)):
+            DailyCount.record_counts(item_type, {(d, (self.unicef,)): count})
+        DailyCount.record_item(d2, "I", self.unicef)
+        DailyCount.record_item(d1, "R", self.unicef)
+        DailyCount.record_item(d1, "R", self.nyaruka)
+
+        # each batch is one statement which also re-squashes rows squashed by earlier batches
+        stats = DailyCount.squash()
+        self.assertEqual((stats["squashed"], stats["collapsed"], stats["batches"]), (9, 4, 3))
+        self.assertEqual(stats["scopes"], {"org:%d" % self.unicef.pk, "org:%d" % self.nyaruka.pk})
+
+        self.assertEqual(DailyCount.objects.count(), 4)
+        self.assertEqual(DailyCount.get_by_org([self.unicef], "I").day_totals(), [(d1, 2), (d2, 2)])
+        self.assertEqual(DailyCount.get_by_org([self.unicef], "R").total(), 1)
+
+        # nothing to do if there are no new rows
+        stats = DailyCount.squash()
+        self.assertEqual((stats["batches"], stats["scopes"]), (0, set()))
+
+        for seconds in (10, 20, 30, 40):
+            DailySecondTotalCount.record_item(d1, seconds, "A", self.unicef)
+
+        stats = DailySecondTotalCount.squash()
+        self.assertEqual((stats["squashed"], stats["collapsed"], stats["batches"]), (5, 3, 2))
+
+        counts = DailySecondTotalCount.get_by_org([self.unicef], "A")
+        self.assertEqual((counts.total(), counts.seconds()), (4, 100))
+        self.assertEqual(DailySecondTotalCount.objects.count(), 1)
+
+    @override_settings(COUNT_BUFFER_SIZE=5)
+    def test_buffered_counts(self):
+        d1, d2 = date(2015, 1, 1), date(2015, 1, 2)
+
+        with buffered_counts() as buffer:
+            with buffered_counts() as nested:
+                self.assertEqual(nested, buffer)
+
+                DailyCount.record_item(d1, "I", self.unicef)
+                DailyCount.record_item(d1, "I", self.unicef)
+                DailyCount.record_removal(d1, "I", self.aids)
+                DailyCount.record_counts("I", {(d1, (self.aids,)): 1, (d2, (self.unicef,)): 2})
+                DailySecondTotalCount.record_item(d1, 10, "A", self.unicef)
+                DailySecondTotalCount.record_item(d1, 20, "A", self.unicef)
+
+            # nothing written yet, and the cancelled out label count won't be
+            self.assertEqual(DailyCount.objects.count(), 0)
+
+            # until a fifth distinct count fills the buffer
+            DailyCount.record_item(d2, "R", self.unicef)
+
+            self.assertEqual(DailyCount.objects.count(), 3)
+            self.assertEqual(DailySecondTotalCount.objects.count(), 1)
+
+            # reads include anything still buffered
+            DailyCount.record_item(d2, "I", self.unicef)
+
+            self.assertEqual(DailyCount.get_by_org([self.unicef], "I").day_totals(), [(d1, 2), (d2, 3)])
+            self.assertEqual(DailySecondTotalCount.get_by_org([self.unicef], "A").seconds(), 30)
+
+            DailyCount.record_item(d2, "I", self.unicef)
+
+        self.assertEqual(DailyCount.get_by_org([self.unicef], "I").total(), 6)
+        self.assertEqual((buffer.num_recorded, buffer.num_written), (10, 6))
+
+        # counts are rolled back along with the changes they count
+        with self.assertRaises(ValueError):
+            with transaction.atomic(), buffered_counts():
+                DailyCount.record_item(d2, "I", self.unicef)
+                raise ValueError("Boom")
+
+        # but written if those changes have been committed
+        with self.assertRaises(ValueError):
+            with buffered_counts():
+                DailyCount.record_item(d2, "I", self.unicef)
+                raise ValueError("Boom")
+
+        self.assertEqual(DailyCount.get_by_org([self.unicef], "I").total(), 7)
+
+    def test_pivot_totals(self):
+        d1, d2 = date(2015, 1, 1), date(2015, 1, 2)
+        DailyCount.record_counts("R", {(d1, (self.moh,)): 2, (d2, (self.moh,)): 1, (d2, (self.who,)): 3})
+        DailyCount.record_counts("C", {(d1, (self.moh,)): 1, (d2, (self.moh,)): -1})
+        DailyCount.record_counts("D", {(d1, (self.who,)): 4})
+        DailySecondTotalCount.record_item(d1, 10, "A", self.moh)
+        DailySecondTotalCount.record_item(d1, 20, "A", self.moh)
+        DailySecondTotalCount.record_item(d2, 30, "C", self.who)
+
+        with self.assertNumQueries(1):
+            totals = DailyCount.get_by_partner([self.moh, self.who], ["R", "C"], d1, d2).pivot_totals()
+
+        self.assertEqual(totals, {("R", self.moh, d1): 2, ("C", self.moh, d1): 1})
+
+        self.assertEqual(
+            DailyCount.get_by_partner([self.moh, self.who], ["R", "C", "D"]).pivot_totals(),
+            {
+                ("R", self.moh, d1): 2,
+                ("R", self.moh, d2): 1,
+                ("R", self.who, d2): 3,
+                ("C", self.moh, d1): 1,
+                ("C", self.moh, d2): -1,
+                ("D", self.who, d1): 4,
+            },
+        )
+        self.assertEqual(
+            DailySecondTotalCount.get_by_partner([self.moh, self.who], ["A", "C"]).pivot_totals(),
+            {("A", self.moh, d1): (2, 30), ("C", self.who, d2): (1, 30)},
+        )
+
+        # no scopes means nothing to pivot on
+        self.assertEqual(DailyCount.get_by_partner([], "R").pivot_totals(), {})
+
     def test_incoming_counts(self):
         self.new_messages(date(2015, 1, 1), 2)
         self.new_messages(date(2015, 1, 2), 1)
@@ -190,6 +364,92 @@ class DailyCountsTest(BaseStatsTest):
         self.assertEqual(DailyCount.get_by_label([self.aids], "I").day_totals(), [(date(2015, 1, 1), 0)])
         self.assertEqual(DailyCount.get_by_label([self.tea], "I").day_totals(), [(date(2015, 1, 1), 0)])
 
+    def test_label_totals(self):
+        r = get_redis_connection()
+        r.delete(LABEL_TOTALS_KEY)
+
+        msg1, msg2, msg3 = [
+            self.create_message(self.unicef, 301 + m, self.ann, "Hi", is_handled=True) for m in range(3)
+        ]
+        msg1.label(self.aids, self.tea)
+        msg2.label(self.aids)
+
+        # cached totals are built from the database when they don't exist
+        self.assertEqual(
+            get_label_totals([self.aids, self.tea]),
+            {"N": {self.aids: 2, self.tea: 1}, "A": {self.aids: 0, self.tea: 0}},
+        )
+        self.assertFalse(TotalCount.objects.filter(is_cached=False).exists())
+
+        # and counts added since are added to them when they're updated
+        Message.bulk_archive(self.unicef, self.admin, Message.objects.filter(pk=msg2.pk))
+        msg3.label(self.tea)
+
+        self.assertEqual(get_label_totals([self.aids]), {"N": {self.aids: 2}, "A": {self.aids: 0}})
+
+        update_label_totals()
+
+        self.assertEqual(
+            get_label_totals([self.aids, self.tea]),
+            {"N": {self.aids: 1, self.tea: 2}, "A": {self.aids: 1, self.tea: 0}},
+        )
+
+        # reading them doesn't need the database
+        with self.assertNumQueries(0):
+            self.assertEqual(get_label_totals([self.aids]), {"N": {self.aids: 1}, "A": {self.aids: 1}})
+
+        # counts are added once each, regardless of the order of their ids, e.g. from a transaction which committed late
+        TotalCount.objects.create(pk=-1, item_type="N", scope="label:%d" % self.tea.pk, count=1)
+        update_label_totals()
+        update_label_totals()
+
+        self.assertEqual(get_label_totals([self.tea]), {"N": {self.tea: 3}, "A": {self.tea: 0}})
+
+        # squashing reconciles them with the database, without re-adding the squashed counts
+        r.hset(LABEL_TOTALS_KEY, "N:label:%d" % self.aids.pk, 10)
+        squash_counts()
+
+        self.assertEqual(
+            get_label_totals([self.aids, self.tea]),
+            {"N": {self.aids: 1, self.tea: 3}, "A": {self.aids: 1, self.tea: 0}},
+        )
+
+        # both counts of a label are read together
+        with self.assertNumQueries(0):
+            self.assertEqual(self.aids.get_inbox_count(), 1)
+            self.assertEqual(self.aids.get_archived_count(), 1)
+
+        # while another process holds the lock, e.g. to squash counts, updates are left to it and reads don't wait
+        msg3.label(self.aids)
+        lock = r.lock(LABEL_TOTALS_LOCK_KEY, timeout=10)
+        lock.acquire()
+        try:
+            update_label_totals()
+
+            with self.assertNumQueries(0):
+                self.assertEqual(get_label_totals([self.aids]), {"N": {self.aids: 1}, "A": {self.aids: 1}})
+        finally:
+            lock.release()
+
+        self.assertTrue(r.exists(LABEL_TOTALS_PENDING_KEY))
+
+        update_label_totals()
+
+        self.assertEqual(get_label_totals([self.aids]), {"N": {self.aids: 2}, "A": {self.aids: 1}})
+        self.assertFalse(r.exists(LABEL_TOTALS_PENDING_KEY))
+
+        # if they don't exist and building them would mean waiting for the lock for too long, totals are aggregated
+        # from the database instead
+        r.delete(LABEL_TOTALS_KEY)
+        lock.acquire()
+        try:
+            with patch("casepro.statistics.cache.LABEL_TOTALS_LOCK_WAIT", 0.1):
+                self.assertEqual(get_label_totals([self.aids]), {"N": {self.aids: 2}, "A": {self.aids: 1}})
+        finally:
+            lock.release()
+
+        self.assertFalse(r.exists(LABEL_TOTALS_KEY))
+
     def test_case_counts_opened(self):
         d1 = self.anytime_on_day(date(2015, 1, 1), pytz.timezone("Africa/Kampala"))
         msg2 = self.create_message(self.unicef, 234, self.ann, "Hello again", [self.aids], created_on=d1)
@@ -431,6 +691,38 @@ class ChartsTest(BaseStatsTest):
             self.assertEqual(series[4], [date_to_milliseconds(date(2016, 1, 15)), 1])
             self.assertEqual(series[5], [date_to_milliseconds(date(2016, 1, 16)), 0])
 
+    def test_chart_caching(self):
+        url = reverse("statistics.incoming_chart")
+        get_redis_connection().delete(CHART_CACHE_STATS_KEY)
+
+        msgs = self.new_messages(date(2016, 3, 1), 2)
+        self.login(self.admin)
+
+        def get_series():
+            series = self.url_get("unicef", url).json["series"]
+            return series[50][1], series[59][1]  # March 1st and March 10th
+
+        with patch.object(timezone, "now", return_value=datetime(2016, 3, 10, 9, 0, tzinfo=pytz.UTC)):
+            self.assertEqual(get_series(), (2, 0))
+
+            # new counts for past days aren't included until they're squashed, but today's counts always are
+            self.new_messages(date(2016, 3, 1), 1)
+            self.new_messages(date(2016, 3, 10), 1)
+
+            self.assertEqual(get_series(), (2, 1))
+
+            squash_counts()
+
+            self.assertEqual(get_series(), (3, 1))
+
+            # squashing new counts of other scopes doesn't invalidate the org's totals
+            msgs[0].label(self.tea)
+            squash_counts()
+
+            self.assertEqual(get_series(), (3, 1))
+
+        self.assertEqual(get_chart_cache_stats(), {"IncomingPerDayChart": {"hits": 2, "misses": 2, "hit_rate": 0.5}})
+
     def test_replies_chart(self):
         url = reverse("statistics.replies_chart")
 
@@ -442,6 +734,9 @@ class ChartsTest(BaseStatsTest):
         self.new_outgoing(self.user2, date(2016, 2, 1), 1)  # Feb 1st
         self.new_outgoing(self.user3, date(2016, 2, 1), 1)  # different partner
 
+        # past months are read from monthly counts
+        squash_counts()
+
         self.login(self.user3)
 
         # simulate making requests in April
@@ -554,6 +849,16 @@ class ChartsTest(BaseStatsTest):
             self.assertEqual(series[8], {"y": 1, "name": "Label #6"})
             self.assertEqual(series[9], {"y": 3, "name": "Other"})
 
+        # the last 30 days are those of the org's timezone, so when it's already March 11th in Kampala, Feb 9th is
+        # no longer included
+        self.new_messages(date(2016, 2, 9), 1)[0].label(self.aids)
+        squash_counts()
+
+        with patch.object(timezone, "now", return_value=datetime(2016, 3, 10, 22, 0, tzinfo=pytz.UTC)):
+            response = self.url_get("unicef", url)
+
+            self.assertEqual(response.json["series"][1], {"y": 1, "name": "AIDS"})
+
 
 class SecondTotalCountsTest(BaseStatsTest):
     def test_first_reply_counts(self):
@@ -644,10 +949,10 @@ class SecondTotalCountsTest(BaseStatsTest):
         self.assertEqual(DailySecondTotalCount.get_by_partner([self.moh], "C").seconds(), 1)
 
         # check month totals
-        today = datetime.today()
-        current_month = today.month
+        today = datetime_to_date(timezone.now(), self.unicef)
+        this_month = today.replace(day=1)
         self.assertEqual(
-            DailySecondTotalCount.get_by_partner([self.moh], "C").month_totals(), [(float(current_month), 1, 1)]
+            DailySecondTotalCount.get_by_partner([self.moh], "C").month_totals(today), [(this_month, 1, 1)]
         )
 
         # check user totals are empty as we are recording those
@@ -11,9 +11,10 @@ from temba_client.utils import parse_iso8601
 
 from casepro.cases.models import Partner
 from casepro.msgs.models import Label
-from casepro.utils import JSONEncoder, date_to_milliseconds, month_range
+from casepro.utils import JSONEncoder, date_to_milliseconds
 from casepro.utils.export import BaseDownloadView
 
+from .cache import get_cached_totals
 from .models import DailyCount, DailyCountExport, datetime_to_date
 from .tasks import daily_count_export
 
@@ -44,6 +45,21 @@ class BaseChart(OrgPermsMixin, SmartTemplateView):
         Subclasses override this to provide data for the chart
         """
 
+    def get_counts(self, request, since, until):
+        """
+        Subclasses override this to provide the daily counts of the chart between since and until
+        """
+
+    def get_totals(self, request, since, until, today, calculate):
+        """
+        Calculates totals over the chart's counts from since, caching the totals of days before today
+        :return: tuple of the totals of days before today, and of today onwards
+        """
+        past = get_cached_totals(
+            self.__class__.__name__, request.org, self.get_counts(request, since, today), since, today, calculate
+        )
+        return past, calculate(self.get_counts(request, today, until))
+
 
 class BasePerDayChart(BaseChart):
     num_days = 60
@@ -52,8 +68,8 @@ class BasePerDayChart(BaseChart):
         today = datetime_to_date(timezone.now(), self.request.org)
 
         since = today - relativedelta(days=self.num_days - 1)
-        totals = self.get_day_totals(request, since)
-        totals_by_day = {t[0]: t[1] for t in totals}
+        past, current = self.get_totals(request, since, None, today, lambda counts: counts.day_totals())
+        totals_by_day = {t[0]: t[1] for t in past + current}
 
         series = []
 
@@ -66,54 +82,43 @@ class BasePerDayChart(BaseChart):
 
         return {"series": series}
 
-    def get_day_totals(self, request, since):
-        """
-        Subclasses override this to provide a list of day/value tuples
-        """
-
 
 class BasePerMonthChart(BaseChart):
     num_months = 12
 
     def get_data(self, request):
-        now = timezone.now()
+        today = datetime_to_date(timezone.now(), request.org)
+        this_month = today.replace(day=1)
+        since = this_month - relativedelta(months=self.num_months - 1)  # last X months including this month
 
-        since = month_range(-(self.num_months - 1))[0]  # last X months including this month
-        totals = self.get_month_totals(request, since)
-        totals_by_month = {t[0]: t[1] for t in totals}
+        # totals of whole months are cached, and of this month are calculated from daily counts
+        past, current = self.get_totals(request, since, None, this_month, lambda counts: counts.month_totals(today))
+        totals_by_month = {t[0]: t[1] for t in past + current}
 
         # generate category labels and series over last X months
         categories = []
         series = []
-        this_month = now.date().month
         for m in reversed(range(0, -self.num_months, -1)):
-            month = this_month + m
-            if month < 1:
-                month += 12
-            categories.append(str(MONTH_NAMES[month - 1]))
+            month = this_month + relativedelta(months=m)
+            categories.append(str(MONTH_NAMES[month.month - 1]))
             series.append(totals_by_month.get(month, 0))
 
         return {"categories": categories, "series": series}
 
-    def get_month_totals(self, request, since):
-        """
-        Subclasses override this to provide a list of month/value tuples
-        """
-
 
 class IncomingPerDayChart(BasePerDayChart):
     """
     Chart of incoming per day for either the current org or a given label
     """
 
-    def get_day_totals(self, request, since):
+    def get_counts(self, request, since, until):
         label_id = request.GET.get("label")
 
         if label_id:
             label = Label.get_all(org=request.org).get(pk=label_id)
-            return DailyCount.get_by_label([label], DailyCount.TYPE_INCOMING, since).day_totals()
+            return DailyCount.get_by_label([label], DailyCount.TYPE_INCOMING, since, until)
         else:
-            return DailyCount.get_by_org([self.request.org], DailyCount.TYPE_INCOMING, since).day_totals()
+            return DailyCount.get_by_org([self.request.org], DailyCount.TYPE_INCOMING, since, until)
 
 
 class RepliesPerMonthChart(BasePerMonthChart):
@@ -121,18 +126,18 @@ class RepliesPerMonthChart(BasePerMonthChart):
     Chart of replies per month for either the current org, a given partner, or a given user
     """
 
-    def get_month_totals(self, request, since):
+    def get_counts(self, request, since, until):
         partner_id = request.GET.get("partner")
         user_id = request.GET.get("user")
 
         if partner_id:
             partner = Partner.objects.get(org=request.org, pk=partner_id)
-            return DailyCount.get_by_partner([partner], DailyCount.TYPE_REPLIES, since).month_totals()
+            return DailyCount.get_by_partner([partner], DailyCount.TYPE_REPLIES, since, until)
         elif user_id:
             user = request.org.get_users().get(pk=user_id)
-            return DailyCount.get_by_user(self.request.org, [user], DailyCount.TYPE_REPLIES, since).month_totals()
+            return DailyCount.get_by_user(self.request.org, [user], DailyCount.TYPE_REPLIES, since, until)
         else:
-            return DailyCount.get_by_org([self.request.org], DailyCount.TYPE_REPLIES, since).month_totals()
+            return DailyCount.get_by_org([self.request.org], DailyCount.TYPE_REPLIES, since, until)
 
 
 class MostUsedLabelsChart(BaseChart):
@@ -144,10 +149,15 @@ class MostUsedLabelsChart(BaseChart):
     num_days = 30
 
     def get_data(self, request):
-        since = timezone.now() - relativedelta(days=self.num_days)
-        labels = Label.get_all(request.org, request.user)
+        today = datetime_to_date(timezone.now(), request.org)
+        since = today - relativedelta(days=self.num_days)
 
-        counts_by_label = DailyCount.get_by_label(labels, DailyCount.TYPE_INCOMING, since).scope_totals()
+        # totals are cached by label id so that label names are always current
+        past, current = self.get_totals(
+            request, since, None, today, lambda counts: {l.pk: t for l, t in counts.scope_totals().items()}
+        )
+        labels = Label.get_all(request.org, request.user)
+        counts_by_label = {l: past.get(l.pk, 0) + current.get(l.pk, 0) for l in labels}
 
         # sort by highest count DESC, label name ASC
         by_usage = sorted(counts_by_label.items(), key=lambda c: (-c[1], c[0].name))
@@ -168,6 +178,11 @@ class MostUsedLabelsChart(BaseChart):
 
         return {"series": series}
 
+    def get_counts(self, request, since, until):
+        labels = Label.get_all(request.org, request.user)
+
+        return DailyCount.get_by_label(labels, DailyCount.TYPE_INCOMING, since, until)
+
 
 class DailyCountExportCRUDL(SmartCRUDL):
     model = DailyCountExport
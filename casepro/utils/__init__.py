@@ -82,6 +82,28 @@ def safe_max(*args, **kwargs):
         return max(*non_nones, **kwargs)
 
 
+def bulk_update(objs, fields):
+    """
+    Updates the given fields of the given model instances with a single UPDATE statement, like QuerySet.bulk_update in
+    later versions of Django. As with other bulk operations, no model signals are sent.
+    """
+    from django.db.models import Case, Value, When
+
+    objs = list(objs)
+    if not objs:
+        return 0
+
+    model = type(objs[0])
+    updates = {}
+    for name in fields:
+        field = model._meta.get_field(name)
+        output_field = field.target_field if field.is_relation else field
+        whens = [When(pk=o.pk, then=Value(getattr(o, field.attname), output_field=output_field)) for o in objs]
+        updates[field.name] = Case(*whens, output_field=output_field)
+
+    return model.objects.filter(pk__in=[o.pk for o in objs]).update(**updates)
+
+
 def normalize(text):
     """
     Normalizes text before keyword matching. Converts to lowercase, performs KD unicode normalization and replaces
@@ -214,3 +236,17 @@ def is_valid_language_code(code):
 def humanize_seconds(seconds):
     now = timezone.now()
     return timeuntil(now + timedelta(seconds=seconds), now)
+
+
+def row_to_str(row):
+    """
+    Formats a row of (value, width) cells as a line of a fixed width text table, e.g. in management command output
+    """
+    return "".join([str(cell[0]).ljust(cell[1]) for cell in row])
+
+
+def row_width(row):
+    """
+    Gets the total width of a row of (value, width) cells
+    """
+    return sum([cell[1] for cell in row])
@@ -0,0 +1,357 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from queue import Full, Queue
+
+from django_redis import get_redis_connection
+from temba_client.utils import parse_iso8601
+
+from casepro.utils import json_decode, json_encode
+
+PULL_CHECKPOINT_KEY = "pull-checkpoint:%d:%s"
+
+_active = threading.local()
+
+
+class SyncSession(object):
+    """
+    Memoizes lookups of an org's labels, groups and contacts for the duration of a single sync run, so that the save
+    signal handlers of synced objects don't have to repeat them for every object
+    """
+
+    def __init__(self, org):
+        self.org = org
+        self.contacts_by_uuid = {}
+        self.pipelines = {}
+        self.checkpoint = None
+        self._labels = None
+        self._groups = None
+
+    def get_labels(self):
+        """
+        Gets all of the org's labels, including inactive ones
+        """
+        if self._labels is None:
+            self._labels = list(self.org.labels.all())
+        return self._labels
+
+    def add_label(self, label):
+        """
+        Records a label created during this session, e.g. a stub
+        """
+        self.get_labels().append(label)
+
+    def get_groups(self):
+        """
+        Gets all of the org's groups, including inactive ones
+        """
+        if self._groups is None:
+            self._groups = list(self.org.groups.all())
+        return self._groups
+
+    def add_group(self, group):
+        """
+        Records a group created during this session, e.g. a stub
+        """
+        self.get_groups().append(group)
+
+    def get_contact(self, uuid, name=None):
+        """
+        Equivalent to Contact.get_or_create but only hits the database for contacts not already seen in this session
+        """
+        from casepro.contacts.models import Contact
+
+        contact = self.contacts_by_uuid.get(uuid)
+        if not contact:
+            contact = Contact.get_or_create(self.org, uuid, name)
+            self.contacts_by_uuid[uuid] = contact
+        return contact
+
+    def get_contacts(self, uuid_names):
+        """
+        Equivalent to Contact.bulk_get_or_create but only hits the database for contacts not already seen in this session
+        :return: dict of contacts by UUID
+        """
+        from casepro.contacts.models import Contact
+
+        uuid_names = dict(uuid_names)
+        missing = {uuid: name for uuid, name in uuid_names.items() if uuid not in self.contacts_by_uuid}
+        if missing:
+            self.contacts_by_uuid.update(Contact.bulk_get_or_create(self.org, missing.items()))
+
+        return {uuid: self.contacts_by_uuid[uuid] for uuid in uuid_names.keys()}
+
+    def pipeline(self, name, fetches, depth):
+        """
+        Wraps the given fetches in a fetch pipeline whose stats will be included in this session's stats
+        """
+        pipeline = FetchPipeline(fetches, depth)
+        self.pipelines.setdefault(name, []).append(pipeline)
+        return pipeline
+
+    def get_pipeline_stats(self):
+        """
+        Gets the stats of all fetch pipelines used in this session, combining those with the same name, e.g. from
+        different time slices of a pull
+        """
+        stats = {}
+        for name, pipelines in self.pipelines.items():
+            stats[name] = pipelines[0].get_stats()
+            for pipeline in pipelines[1:]:
+                more = pipeline.get_stats()
+                stats[name]["fetches"] += more["fetches"]
+                stats[name]["max_queue_depth"] = max(stats[name]["max_queue_depth"], more["max_queue_depth"])
+                stats[name]["network_wait"] = round(stats[name]["network_wait"] + more["network_wait"], 3)
+                stats[name]["db_wait"] = round(stats[name]["db_wait"] + more["db_wait"], 3)
+        return stats
+
+
+class FetchPipeline(object):
+    """
+    Iterates over fetches of remote objects, with a background thread fetching up to depth fetches ahead into a bounded
+    queue, so that waiting on the network for the next fetches overlaps with writing the current fetch to the database.
+    Only the fetching happens in the background thread, so it never touches the database.
+    """
+
+    DONE = object()
+
+    def __init__(self, fetches, depth):
+        self.fetches = fetches
+        self.depth = depth
+        self.num_fetches = 0
+        self.max_queue_depth = 0
+        self.network_wait = 0.0  # time spent waiting for the next fetch to arrive
+        self.db_wait = 0.0  # time spent by the fetcher waiting for the queue to have room
+
+    def __iter__(self):
+        if self.depth <= 0:
+            # no background fetching so fetching and writing just take turns
+            fetches = iter(self.fetches)
+            while True:
+                start = time.perf_counter()
+                fetch = next(fetches, self.DONE)
+                self.network_wait += time.perf_counter() - start
+
+                if fetch is self.DONE:
+                    return
+
+                self.num_fetches += 1
+
+                start = time.perf_counter()
+                yield fetch
+                self.db_wait += time.perf_counter() - start
+
+        queue = Queue(maxsize=self.depth)
+        stopped = threading.Event()
+
+        thread = threading.Thread(target=self._fetch_all, args=(queue, stopped), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                self.max_queue_depth = max(self.max_queue_depth, queue.qsize())
+
+                start = time.perf_counter()
+                fetch, error = queue.get()
+                self.network_wait += time.perf_counter() - start
+
+                if error:
+                    raise error
+                if fetch is self.DONE:
+                    break
+
+                self.num_fetches += 1
+                yield fetch
+        finally:
+            # let the fetcher know that it can stop, e.g. if the consumer failed part way through
+            stopped.set()
+
+    def _fetch_all(self, queue, stopped):
+        try:
+            for fetch in self.fetches:
+                if not self._put(queue, (fetch, None), stopped):
+                    return
+        except Exception as e:
+            self._put(queue, (None, e), stopped)
+            return
+
+        self._put(queue, (self.DONE, None), stopped)
+
+    def _put(self, queue, item, stopped):
+        start = time.perf_counter()
+        try:
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+        finally:
+            self.db_wait += time.perf_counter() - start
+
+    def get_stats(self):
+        return {
+            "fetches": self.num_fetches,
+            "depth": self.depth,
+            "max_queue_depth": self.max_queue_depth,
+            "network_wait": round(self.network_wait, 3),
+            "db_wait": round(self.db_wait, 3),
+        }
+
+
+class PullCheckpoint(object):
+    """
+    The progress of a pull task through its time window, stored in Redis so that a run which fails or stops part way
+    through can be resumed by a later run. Everything modified before the watermark has been pulled, and while the
+    time slice after it is being pulled, the fetch cursor of each stage of that slice (e.g. active and deleted
+    contacts) is recorded after every page which has been synced.
+    """
+
+    def __init__(self, org, task_key, watermark, slice_until=None, cursors=None, done_stages=None):
+        self.org = org
+        self.task_key = task_key
+        self.watermark = watermark
+        self.slice_until = slice_until
+        self.cursors = cursors or {}
+        self.done_stages = done_stages or []
+
+    @classmethod
+    def load(cls, org, task_key):
+        """
+        Loads the stored checkpoint of the given task for the given org, if there is one
+        """
+        stored = get_redis_connection().get(cls._get_key(org, task_key))
+        if not stored:
+            return None
+
+        stored = json_decode(stored)
+        return cls(
+            org,
+            task_key,
+            parse_iso8601(stored["watermark"]),
+            parse_iso8601(stored["slice_until"]),
+            stored["cursors"],
+            stored["done_stages"],
+        )
+
+    def begin_slice(self, until):
+        self.slice_until = until
+        self.cursors = {}
+        self.done_stages = []
+        self.save()
+
+    def get_cursor(self, stage):
+        return self.cursors.get(stage)
+
+    def save_cursor(self, stage, cursor):
+        self.cursors[stage] = cursor
+        self.save()
+
+    def is_stage_done(self, stage):
+        return stage in self.done_stages
+
+    def complete_stage(self, stage):
+        self.done_stages.append(stage)
+        self.save()
+
+    def end_slice(self):
+        self.watermark = self.slice_until
+        self.slice_until = None
+        self.cursors = {}
+        self.done_stages = []
+        self.save()
+
+    def save(self):
+        state = {
+            "watermark": self.watermark,
+            "slice_until": self.slice_until,
+            "cursors": self.cursors,
+            "done_stages": self.done_stages,
+        }
+        get_redis_connection().set(self._get_key(self.org, self.task_key), json_encode(state))
+
+    def clear(self):
+        get_redis_connection().delete(self._get_key(self.org, self.task_key))
+
+    @staticmethod
+    def _get_key(org, task_key):
+        return PULL_CHECKPOINT_KEY % (org.pk, task_key)
+
+
+def pull_in_slices(org, task_key, since, until, pull, slice_days=None, time_limit=None):
+    """
+    Pulls objects modified in the given time window by calling pull(since, until) for each of its time slices, oldest
+    first, with a checkpoint active in the sync session. If a previous run left a checkpoint, then this resumes from
+    that instead of since. If the time limit is reached before the window is complete, the remaining slices are left
+    for the next run.
+    :param slice_days: the length of each slice in days, or None to pull the window as a single slice. A window with no
+        start gets a first slice which ends when the org was created.
+    :param time_limit: the number of seconds after which no new slices are started, or None for no limit
+    :return: tuple of the summed counts returned by pull, the number of slices pulled, whether the window was
+        completed, and whether a previous checkpoint was resumed
+    """
+    checkpoint = PullCheckpoint.load(org, task_key)
+    resumed = checkpoint is not None
+    if not checkpoint:
+        checkpoint = PullCheckpoint(org, task_key, since)
+
+    start = time.time()
+    totals = None
+    num_slices = 0
+
+    with sync_session(org) as session:
+        session.checkpoint = checkpoint
+        try:
+            while True:
+                if not checkpoint.slice_until:
+                    if not slice_days:
+                        slice_until = until
+                    elif checkpoint.watermark:
+                        slice_until = min(checkpoint.watermark + timedelta(days=slice_days), until)
+                    else:
+                        slice_until = min(org.created_on, until)
+
+                    checkpoint.begin_slice(slice_until)
+
+                counts = pull(checkpoint.watermark, checkpoint.slice_until)
+                totals = [t + c for t, c in zip(totals, counts)] if totals else list(counts)
+                num_slices += 1
+
+                checkpoint.end_slice()
+
+                if checkpoint.watermark >= until:
+                    checkpoint.clear()
+                    return tuple(totals), num_slices, True, resumed
+
+                if time_limit is not None and time.time() - start >= time_limit:
+                    return tuple(totals), num_slices, False, resumed
+        finally:
+            session.checkpoint = None
+
+
+@contextmanager
+def sync_session(org):
+    """
+    Context manager which makes a sync session active for the given org in the current thread. If one is already active
+    for that org, then it is reused.
+    """
+    previous = getattr(_active, "session", None)
+    if previous and previous.org.pk == org.pk:
+        yield previous
+        return
+
+    _active.session = SyncSession(org)
+    try:
+        yield _active.session
+    finally:
+        _active.session = previous
+
+
+def get_sync_session(org):
+    """
+    Gets the sync session active for the given org in the current thread, if there is one
+    """
+    session = getattr(_active, "session", None)
+    return session if session and session.org.pk == org.pk else None
@@ -1,4 +1,5 @@
-from datetime import date, datetime
+import time
+from datetime import date, datetime, timedelta
 from enum import Enum
 from uuid import UUID
 
@@ -23,6 +24,8 @@ from . import (
     microseconds_to_datetime,
     month_range,
     normalize,
+    row_to_str,
+    row_width,
     safe_max,
     str_to_bool,
     truncate,
@@ -30,6 +33,7 @@ from . import (
 )
 from .email import send_email
 from .middleware import JSONMiddleware
+from .sync import FetchPipeline, PullCheckpoint, get_sync_session, pull_in_slices, sync_session
 
 
 class UtilsTest(BaseCasesTest):
@@ -173,6 +177,12 @@ class UtilsTest(BaseCasesTest):
         self.assertEqual(humanize_seconds(93600), "1\xa0day, 2\xa0hours")
         self.assertEqual(humanize_seconds(180000), "2\xa0days, 2\xa0hours")
 
+    def test_row_to_str(self):
+        row = (("Rows", 6), (123, 5), ("1.50", 4))
+
+        self.assertEqual(row_to_str(row), "Rows  123  1.50")
+        self.assertEqual(row_width(row), 15)
+
 
 class EmailTest(BaseCasesTest):
     @override_settings(SEND_EMAILS=True)
@@ -215,6 +225,198 @@ class MiddlewareTest(BaseCasesTest):
         self.assertFalse(hasattr(request, "json"))
 
 
+class SyncSessionTest(BaseCasesTest):
+    def test_sync_session(self):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+
+        self.assertIsNone(get_sync_session(self.unicef))
+
+        with sync_session(self.unicef) as session:
+            self.assertEqual(get_sync_session(self.unicef), session)
+            self.assertIsNone(get_sync_session(self.nyaruka))
+
+            # nested sessions for the same org reuse the active session
+            with sync_session(self.unicef) as nested:
+                self.assertEqual(nested, session)
+
+            with sync_session(self.nyaruka) as other:
+                self.assertNotEqual(other, session)
+                self.assertEqual(get_sync_session(self.nyaruka), other)
+                self.assertIsNone(get_sync_session(self.unicef))
+
+            self.assertEqual(get_sync_session(self.unicef), session)
+
+            # one query to fetch existing contacts, then one to lock-check and one to create missing stubs
+            with self.assertNumQueries(3):
+                contacts = session.get_contacts([("C-001", "Ann"), ("C-002", "Bob"), ("C-003", "Cat")])
+
+            self.assertEqual(set(contacts.keys()), {"C-001", "C-002", "C-003"})
+            self.assertEqual(contacts["C-001"], ann)
+            self.assertTrue(contacts["C-002"].is_stub)
+
+            with self.assertNumQueries(0):
+                self.assertEqual(session.get_contact("C-002", "Bob"), contacts["C-002"])
+                self.assertEqual(session.get_contacts([("C-003", "Cat")]), {"C-003": contacts["C-003"]})
+
+            dan = session.get_contact("C-004", "Dan")
+            self.assertTrue(dan.is_stub)
+
+            with self.assertNumQueries(2):
+                labels = session.get_labels()
+                groups = session.get_groups()
+
+            self.assertEqual(set(labels), set(self.unicef.labels.all()))
+            self.assertEqual(set(groups), set(self.unicef.groups.all()))
+
+            stub = self.unicef.labels.create(uuid="L-009", name="Stub", is_active=False)
+
+            with self.assertNumQueries(0):
+                session.add_label(stub)
+                self.assertIn(stub, session.get_labels())
+
+        self.assertIsNone(get_sync_session(self.unicef))
+
+
+class FetchPipelineTest(BaseCasesTest):
+    def test_iteration(self):
+        def slow_fetches():
+            for f in range(5):
+                time.sleep(0.01)
+                yield [f * 2, f * 2 + 1]
+
+        for depth in (0, 1, 3):
+            pipeline = FetchPipeline(slow_fetches(), depth)
+            fetches = []
+            for fetch in pipeline:
+                time.sleep(0.01)
+                fetches.append(fetch)
+
+            self.assertEqual(fetches, [[0, 1], [2, 3], [4, 5], [6, 7], [8, 9]])
+
+            stats = pipeline.get_stats()
+            self.assertEqual(stats["fetches"], 5)
+            self.assertEqual(stats["depth"], depth)
+            self.assertLessEqual(stats["max_queue_depth"], depth)
+            self.assertGreater(stats["network_wait"], 0)
+            self.assertGreaterEqual(stats["db_wait"], 0)
+
+    def test_fetch_error(self):
+        def failing_fetches():
+            yield [1, 2]
+            raise ValueError("API down")
+
+        pipeline = FetchPipeline(failing_fetches(), 2)
+        fetches = []
+
+        with self.assertRaises(ValueError):
+            for fetch in pipeline:
+                fetches.append(fetch)
+
+        self.assertEqual(fetches, [[1, 2]])
+
+    def test_consumer_error(self):
+        fetched = []
+
+        def fetches():
+            for f in range(100):
+                fetched.append(f)
+                yield [f]
+
+        with self.assertRaises(ValueError):
+            for fetch in FetchPipeline(fetches(), 2):
+                raise ValueError("DB down")
+
+        # fetcher should stop rather than fetching everything
+        time.sleep(0.3)
+        self.assertLess(len(fetched), 10)
+
+    def test_session_stats(self):
+        with sync_session(self.unicef) as session:
+            self.assertEqual(session.get_pipeline_stats(), {})
+
+            list(session.pipeline("messages", [[1], [2]], 2))
+
+        stats = session.get_pipeline_stats()
+        self.assertEqual(set(stats.keys()), {"messages"})
+        self.assertEqual(stats["messages"]["fetches"], 2)
+        self.assertEqual(
+            set(stats["messages"].keys()), {"fetches", "depth", "max_queue_depth", "network_wait", "db_wait"}
+        )
+
+
+class PullCheckpointTest(BaseCasesTest):
+    def test_pull_in_slices(self):
+        d1 = datetime(2016, 1, 1, 0, 0, tzinfo=pytz.UTC)
+        d2 = datetime(2016, 1, 8, 0, 0, tzinfo=pytz.UTC)
+        d3 = datetime(2016, 1, 15, 0, 0, tzinfo=pytz.UTC)
+        d4 = datetime(2016, 1, 20, 0, 0, tzinfo=pytz.UTC)
+
+        pulled = []
+
+        def pull(since, until):
+            checkpoint = get_sync_session(self.unicef).checkpoint
+            self.assertEqual((checkpoint.watermark, checkpoint.slice_until), (since, until))
+
+            pulled.append((since, until))
+            return 1, 2, 3, 4
+
+        self.assertEqual(
+            pull_in_slices(self.unicef, "test-pull", d1, d4, pull, slice_days=7), ((3, 6, 9, 12), 3, True, False)
+        )
+        self.assertEqual(pulled, [(d1, d2), (d2, d3), (d3, d4)])
+
+        # checkpoint is cleared once the window is complete
+        self.assertIsNone(PullCheckpoint.load(self.unicef, "test-pull"))
+
+        # a window without a start is first pulled up to when the org was created
+        pulled = []
+        until = self.unicef.created_on + timedelta(days=1)
+        pull_in_slices(self.unicef, "test-pull", None, until, pull, slice_days=7)
+        self.assertEqual(pulled, [(None, self.unicef.created_on), (self.unicef.created_on, until)])
+
+        # without a slice length, a window is pulled as a single slice
+        pulled = []
+        self.assertEqual(pull_in_slices(self.unicef, "test-pull", d1, d4, pull), ((1, 2, 3, 4), 1, True, False))
+        self.assertEqual(pulled, [(d1, d4)])
+
+        # a run which fails part way through a slice leaves its cursors for the next run
+        def pull_and_fail(since, until):
+            if since == d2:
+                get_sync_session(self.unicef).checkpoint.save_cursor("messages", "cursor-1")
+                raise ValueError("API down")
+            return pull(since, until)
+
+        pulled = []
+        with self.assertRaises(ValueError):
+            pull_in_slices(self.unicef, "test-pull", d1, d4, pull_and_fail, slice_days=7)
+
+        self.assertEqual(pulled, [(d1, d2)])
+
+        checkpoint = PullCheckpoint.load(self.unicef, "test-pull")
+        self.assertEqual((checkpoint.watermark, checkpoint.slice_until), (d2, d3))
+        self.assertEqual(checkpoint.get_cursor("messages"), "cursor-1")
+
+        # which resumes from the failed slice, ignoring its own start, and stops when it reaches the time limit
+        def pull_and_check(since, until):
+            self.assertEqual(get_sync_session(self.unicef).checkpoint.get_cursor("messages"), "cursor-1")
+            return pull(since, until)
+
+        pulled = []
+        self.assertEqual(
+            pull_in_slices(self.unicef, "test-pull", d1, d4, pull_and_check, slice_days=7, time_limit=0),
+            ((1, 2, 3, 4), 1, False, True),
+        )
+        self.assertEqual(pulled, [(d2, d3)])
+
+        # the next run continues from there
+        pulled = []
+        self.assertEqual(
+            pull_in_slices(self.unicef, "test-pull", d4, d4, pull, slice_days=7), ((1, 2, 3, 4), 1, True, True)
+        )
+        self.assertEqual(pulled, [(d3, d4)])
+        self.assertIsNone(PullCheckpoint.load(self.unicef, "test-pull"))
+
+
 class ViewsTest(BaseCasesTest):
     def test_partials(self):
         response = self.url_get("unicef", "/partials/modal_confirm.html")